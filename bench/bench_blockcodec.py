@@ -0,0 +1,71 @@
+"""
+Microbenchmark comparing the execnet and compact block encodings.
+
+Encodes and decodes typical peer chain blocks (Autocrypt message
+entries with and without inline keydata, gossip entries) and prints
+throughput and serialized sizes for both encodings::
+
+    python bench/bench_blockcodec.py [--number N]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import hashlib
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from muacrypt import blockcodec  # noqa: E402
+
+
+def make_blocks(num, keysize):
+    blocks = []
+    parent = None
+    for i in range(num):
+        cid = hashlib.sha256(str(i).encode("ascii")).hexdigest()
+        meta = dict(height=i + 1, root=cid if i else None,
+                    skip=[cid] * (i.bit_length()))
+        keydata = os.urandom(keysize) if i % 2 else hashlib.sha256(b"k").hexdigest()
+        blocks.append([meta, u"msg", parent, time.time(),
+                       u"<{}@example.org>".format(i), float(i), u"mutual",
+                       keydata, u"ABCDEF0123456789"])
+        parent = cid
+    return blocks
+
+
+def bench(encoding, blocks, number):
+    encoded = [blockcodec.encode(b, encoding) for b in blocks]
+    start = time.time()
+    for i in range(number):
+        for b in blocks:
+            blockcodec.encode(b, encoding)
+    encode_time = time.time() - start
+    start = time.time()
+    for i in range(number):
+        for data in encoded:
+            blockcodec.decode(data)
+    decode_time = time.time() - start
+    count = number * len(blocks)
+    size = sum(len(x) for x in encoded)
+    print("{:8s} encode {:9.0f} blocks/s  decode {:9.0f} blocks/s  "
+          "size {:7d} bytes ({:.0f} bytes/block)".format(
+              encoding, count / encode_time, count / decode_time,
+              size, size / float(len(blocks))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--number", type=int, default=20,
+                        help="number of rounds over the blocks")
+    parser.add_argument("--keysize", type=int, default=2000,
+                        help="size of inline keydata in every other block")
+    args = parser.parse_args()
+    blocks = make_blocks(500, args.keysize)
+    for encoding in blockcodec.ENCODINGS:
+        bench(encoding, blocks, args.number)
+
+
+if __name__ == "__main__":
+    main()
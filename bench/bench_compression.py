@@ -0,0 +1,92 @@
+"""
+Benchmark of zlib compression of stored blocks and blobs.
+
+Builds keydata blobs from the Autocrypt headers of the test messages
+and keygen blocks with inline secret keys and prints, for several
+"compress_min_size" settings, the stored size compared to uncompressed
+storage and the cost of reading the data back::
+
+    python bench/bench_compression.py [--number N]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import glob
+import base64
+import argparse
+
+basedir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, basedir)
+
+from muacrypt import blockcodec, mime  # noqa: E402
+
+datadir = os.path.join(basedir, "test_muacrypt", "data")
+
+
+def dearmor(text):
+    lines = text.strip().splitlines()
+    body = lines[lines.index("") + 1:-1]
+    return base64.b64decode("".join(line for line in body if not line.startswith("=")))
+
+
+def load_keydata():
+    public_keys = []
+    for path in sorted(glob.glob(os.path.join(datadir, "*.eml"))):
+        with open(path) as f:
+            msg = mime.parse_message_from_file(f)
+        header = mime.parse_one_ac_header_from_msg(msg)
+        if header.keydata:
+            public_keys.append(header.keydata)
+    with open(os.path.join(datadir, "test1_autocrypt_org.key")) as f:
+        public_keys.append(dearmor(f.read()))
+    with open(os.path.join(datadir, "testbot.secretkey")) as f:
+        secret_key = dearmor(f.read())
+    return public_keys, secret_key
+
+
+def make_items(public_keys, secret_key):
+    """ return (kind, serialized) pairs of blobs and keygen blocks. """
+    items = [("blob", keydata) for keydata in public_keys]
+    cid = "0" * 64
+    meta = dict(height=2, root=cid, skip=[cid])
+    block = [meta, u"keygen", cid, time.time(), secret_key, u"ABCDEF0123456789"]
+    items.append(("block", blockcodec.encode(block, "compact")))
+    return items
+
+
+def read(kind, stored):
+    if kind == "block":
+        return blockcodec.decode(stored)
+    return blockcodec.decompress(stored)
+
+
+def bench(items, min_size, number):
+    stored = [(kind, blockcodec.compress(data, min_size)) for kind, data in items]
+    start = time.time()
+    for i in range(number):
+        for kind, data in stored:
+            read(kind, data)
+    duration = time.time() - start
+    size = sum(len(data) for kind, data in stored)
+    raw_size = sum(len(data) for kind, data in items)
+    compressed = sum(1 for kind, data in stored if data[:2] == blockcodec.COMPRESSED)
+    print("compress_min_size {:5d}: {:6d} of {:6d} bytes ({:5.1f}%), {:2d}/{:2d} "
+          "compressed, read {:6.1f} us/item".format(
+              min_size, size, raw_size, 100.0 * size / raw_size, compressed,
+              len(items), duration * 1e6 / (number * len(items))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--number", type=int, default=1000,
+                        help="number of rounds over the items")
+    args = parser.parse_args()
+    items = make_items(*load_keydata())
+    for min_size in (0, 4096, 1024, 256):
+        bench(items, min_size, args.number)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Benchmark of importing keys with one gpg invocation per key compared
+to a single batched invocation.
+
+Imports the keys from the Autocrypt headers of the test messages into
+fresh gpg home directories and prints the imported keys per second
+for separate and batched imports::
+
+    python bench/bench_gpg.py [--rounds N] [--gpgbin PATH]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import glob
+import time
+import shutil
+import tempfile
+import argparse
+
+basedir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, basedir)
+
+from muacrypt import mime  # noqa: E402
+from muacrypt.bingpg import BinGPG  # noqa: E402
+
+datadir = os.path.join(basedir, "test_muacrypt", "data")
+
+
+def load_keydata():
+    keydatas = []
+    for path in sorted(glob.glob(os.path.join(datadir, "*.eml"))):
+        with open(path) as f:
+            msg = mime.parse_message_from_file(f)
+        header = mime.parse_one_ac_header_from_msg(msg)
+        if header.keydata:
+            keydatas.append(header.keydata)
+    return keydatas
+
+
+def import_separately(bingpg, keydatas):
+    return [bingpg.import_keydata(keydata) for keydata in keydatas]
+
+
+def import_batched(bingpg, keydatas):
+    return bingpg.import_keydata_many(keydatas)
+
+
+def bench(name, func, keydatas, rounds, gpgbin):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        duration = 0.0
+        for i in range(rounds):
+            homedir = os.path.join(tmpdir, str(i))
+            os.mkdir(homedir, 0o700)
+            bingpg = BinGPG(homedir=homedir, gpgpath=gpgbin)
+            start = time.time()
+            keyhandles = func(bingpg, keydatas)
+            duration += time.time() - start
+            assert None not in keyhandles
+            bingpg.killagent()
+    finally:
+        shutil.rmtree(tmpdir)
+    print("{:9s}: {:7.1f} keys/s".format(name, rounds * len(keydatas) / duration))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rounds", type=int, default=10,
+                        help="number of fresh keyrings to import into")
+    parser.add_argument("--gpgbin", default="gpg", help="gpg binary to use")
+    args = parser.parse_args()
+    keydatas = load_keydata()
+    for name, func in (("separate", import_separately), ("batched", import_batched)):
+        bench(name, func, keydatas, args.rounds, args.gpgbin)
+
+
+if __name__ == "__main__":
+    main()
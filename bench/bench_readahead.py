@@ -0,0 +1,82 @@
+"""
+Benchmark of walking chains with and without read-ahead.
+
+Stores interleaved peer chains in the "pack" and "sqlite" block storages
+and walks each chain from its head to the root through a block service
+without a block cache, once with read-ahead disabled and once with
+the given window::
+
+    python bench/bench_readahead.py [--chains N] [--length N] [--window N]
+
+The storage files stay in the operating system's page cache so the
+numbers show the saved reads and queries; drop the page cache between
+the runs to see the effect of read-ahead on cold full scans.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from muacrypt.packstore import PackBlockService  # noqa: E402
+from muacrypt.sqlitestore import SQLiteStore, SQLiteBlockService  # noqa: E402
+
+
+def make_pack(tmpdir, readahead):
+    return PackBlockService(os.path.join(tmpdir, "pack"), encoding="compact",
+                            readahead=readahead)
+
+
+def make_sqlite(tmpdir, readahead):
+    store = SQLiteStore(os.path.join(tmpdir, "states.sqlite"))
+    return SQLiteBlockService(store, encoding="compact", readahead=readahead)
+
+
+def fill(bs, chains, length):
+    heads = [None] * chains
+    with bs.transaction():
+        for i in range(chains * length):
+            heads[i % chains] = bs.store_block(
+                "msg", [u"<{}@example.org>".format(i), float(i), u"mutual",
+                        u"0" * 64, u"ABCDEF0123456789"],
+                parent=heads[i % chains]).cid
+    return heads
+
+
+def walk(bs, heads):
+    start = time.time()
+    count = 0
+    for head in heads:
+        for block in bs.get_block(head):
+            count += 1
+    return count, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--chains", type=int, default=10,
+                        help="number of interleaved chains")
+    parser.add_argument("--length", type=int, default=1000,
+                        help="number of blocks per chain")
+    parser.add_argument("--window", type=int, default=64,
+                        help="read-ahead window in blocks")
+    args = parser.parse_args()
+    for name, make in (("pack", make_pack), ("sqlite", make_sqlite)):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            heads = fill(make(tmpdir, 1), args.chains, args.length)
+            for readahead in (1, args.window):
+                count, duration = walk(make(tmpdir, readahead), heads)
+                print("{:6s} readahead {:4d}: {:9.0f} blocks/s".format(
+                      name, readahead, count / duration))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -16,7 +16,7 @@ import email
 import uuid
 import time
 from .bingpg import cached_property, BinGPG
-from . import mime
+from . import mime, openpgp
 from .states import States
 from .recommendation import Recommendation
 from .myattr import attrib_text, attrib_float
@@ -68,7 +68,7 @@ class AccountExists(AccountException):
 
 class AccountManager(object):
     """ Manage multiple accounts and route in/out messages to the appropriate account. """
-    def __init__(self, dir, plugin_manager):
+    def __init__(self, dir, plugin_manager, storage=None):
         """ Initialize multi-account configuration.
 
         :type dir: unicode
@@ -77,9 +77,15 @@ class AccountManager(object):
         :type plugin_manager: pluggy.PluginManager
         :param plugin_manager:
              a plugin manager instance with hooks registered
+        :type storage: unicode, dict or None
+        :param storage:
+             storage backend ("files", "pack" or "sqlite") for a new
+             directory or a dict of storage options (see States).
+             An existing directory must use the same backend while
+             tunable options are changed for it.
         """
         self.dir = dir
-        self._states = States(dir)
+        self._states = States(dir, storage=storage)
         self.accountmanager_state = self._states.get_accountmanager_state()
         self.plugin_manager = plugin_manager
 
@@ -180,12 +186,62 @@ class AccountManager(object):
         delivto = mime.get_delivered_to(msg)
         return self.get_account_from_emailadr(delivto, raising=True)
 
+    @property
+    def storage(self):
+        """ dict of storage options used by the state directory. """
+        return self._states.storage
+
+    def migrate_storage(self, backend=None, heads=None, layout=None):
+        """ convert stored blocks and heads to the specified storage options.
+
+        :param backend: name of the storage backend ("files", "pack" or "sqlite")
+                        or None to keep the current one.
+        :param heads: head tracking mode ("file" or "journal")
+                      or None to keep the current one.
+        :param layout: block layout of the "files" backend ("flat" or
+                       "fanout") or None to keep the current one.
+        :returns: number of converted blocks
+        """
+        return self._states.migrate_storage(backend=backend, heads=heads,
+                                            layout=layout)
+
+    def collect_garbage(self, dry_run=False, archive=False, progress=None):
+        """ remove blocks which are not reachable from any account's state.
+
+        :param dry_run: only count unreachable blocks.
+        :param archive: keep a copy of removed blocks in the "gc-archive"
+                        directory.
+        :param progress: callable receiving the phase name and the
+                         number of processed blocks.
+        :returns: dict with "reachable", "garbage" and "removed" counts
+        """
+        return self._states.collect_garbage(dry_run=dry_run, archive=archive,
+                                            progress=progress)
+
+    def fsck(self, repair=False, processes=None, progress=None):
+        """ check that stored blocks match their content addresses and
+        that all chains consist of valid entries.
+
+        :param repair: truncate broken chains to their last valid block
+                       and remove corrupted blocks.
+        :param processes: number of processes for hashing blocks.
+        :param progress: callable receiving the phase name and the
+                         number of processed items.
+        :returns: dict with "blocks", "chains", "problems", "repaired"
+                  and "skipped"
+        """
+        return self._states.fsck(repair=repair, processes=processes,
+                                 progress=progress)
+
     def remove(self):
         """ remove the account directory and re-reset all muacrypt state.
-        You need to add accounts to get working again.
+        You need to add accounts to get working again.  The state directory
+        is recreated with the storage options it used before.
         """
+        storage = self._states.storage
+        self._states.close()
         shutil.rmtree(self.dir, ignore_errors=True)
-        self._states = States(self.dir)
+        self._states = States(self.dir, storage=storage)
         self.accountmanager_state = self._states.get_accountmanager_state()
 
 
@@ -217,8 +273,26 @@ class Account:
         return Recommendation(peerstates, self.ownstate.prefer_encrypt,
                               reply_to_enc=reply_to_enc)
 
-    def get_peername_list(self):
-        return self._states.get_peername_list(self.name)
+    def get_peername_list(self, after=None, limit=None):
+        return self._states.get_peername_list(self.name, after=after, limit=limit)
+
+    def iter_peernames(self):
+        """ yield sorted peer addresses without loading all at once. """
+        return self._states.iter_peernames(self.name)
+
+    def get_msgid_filter(self):
+        """ return Bloom filter of the Message-IDs of processed messages. """
+        return self._states.get_msgid_filter(self.name)
+
+    def compact(self, archive=False):
+        """ shrink each peer chain to a snapshot plus the entries which
+        determine the current peer state.
+
+        :param archive: if True the compacted history stays referenced
+                        from the snapshot instead of becoming garbage.
+        :returns: number of blocks removed from peer chains
+        """
+        return self._states.compact_peer_chains(self.name, archive=archive)
 
     def create(self, name, email_regex, keyhandle, gpgbin, gpgmode):
         """ create all settings, keyrings etc for this account.
@@ -296,11 +370,25 @@ class Account:
         :rtype: unicode
         :returns: Autocrypt header value (or empty string)
         """
-        return mime.make_ac_header_value(
-            addr=emailadr,
-            keydata=self.bingpg.get_public_keydata(self.ownstate.keyhandle),
-            prefer_encrypt=self.ownstate.prefer_encrypt,
-        )
+        ownstate = self.ownstate
+        name = "ac_header:" + emailadr
+        header = ownstate.get_export(name)
+        if header is None:
+            header = mime.make_ac_header_value(
+                addr=emailadr,
+                keydata=self._get_own_public_keydata(),
+                prefer_encrypt=ownstate.prefer_encrypt,
+            )
+            ownstate.set_export(name, header)
+        return header
+
+    def _get_own_public_keydata(self):
+        ownstate = self.ownstate
+        keydata = ownstate.get_export("public_keydata")
+        if keydata is None:
+            keydata = self.bingpg.get_public_keydata(ownstate.keyhandle)
+            ownstate.set_export("public_keydata", keydata)
+        return keydata
 
     def exists(self):
         """ return True if the account exists. """
@@ -331,8 +419,12 @@ class Account:
         peerstate = self.get_peerstate(From)
         msg_date = effective_date(parse_date_to_float(msg.get("Date")))
         msg_id = six.text_type(msg["Message-Id"])
-        if ignore_existing and peerstate.has_message(msg_id):
-            return
+        msgid_filter = self.get_msgid_filter()
+        # only ask the peer chain if the filter can't rule out the message
+        if ignore_existing and msgid_filter.check(msg_id):
+            if peerstate.has_message(msg_id):
+                return
+            msgid_filter.record_false_positive()
         pah = self.process_autocrypt_header(msg, From, peerstate, msg_date, msg_id)
         if mime.is_encrypted(msg):
             dec_msg = self.decrypt_mime(msg).dec_msg
@@ -344,6 +436,7 @@ class Account:
             )
         else:
             gossip_pahs = {}
+        msgid_filter.add(msg_id)
 
         return ProcessIncomingResult(
             msg_id=msg_id,
@@ -382,28 +475,43 @@ class Account:
         """
         if hasattr(prefer_encrypt, "decode"):
             prefer_encrypt = prefer_encrypt.decode("ascii")
-        kh = self.bingpg.import_keydata(keydata)
         uid_addrs = []
         if addr is not None:
             uid_addrs.append(mime.parse_email_addr(addr))
+        # minimize the key in-process and read the UIDs from its packets,
+        # gpg only needs to import the minimized key
+        try:
+            minimized = openpgp.minimize_keydata(keydata, uid_addrs)
+            keyinfos = openpgp.parse_keyinfos(minimized)
+        except openpgp.ParseError:
+            minimized = None
+            if addr is None:
+                kh = self.bingpg.import_keydata(keydata)
+                keyinfos = [k for k in self.bingpg.list_public_keyinfos(kh) if k.id == kh]
+        if addr is None:
+            for keyinfo in keyinfos[:1]:
+                uid_addrs.extend(map(mime.parse_email_addr, keyinfo.uids))
+
+        if minimized is not None:
+            keydata = minimized
+            kh = self.bingpg.import_keydata(keydata)
         else:
-            for keyinfo in self.bingpg.list_public_keyinfos(kh):
-                if keyinfo.id == kh:
-                    uid_addrs.extend(map(mime.parse_email_addr, keyinfo.uids))
-                    break
-
-        kh = self.bingpg.import_keydata(keydata, minimize=True)
-        for addr in uid_addrs:
-            peerstate = self.get_peerstate(addr)
-            peerstate.update_from_msg(
-                msg_id='', effective_date=time.time(),
-                prefer_encrypt=prefer_encrypt,
-                keydata=self.bingpg.get_public_keydata(kh), keyhandle=kh
-            )
+            kh = self.bingpg.import_keydata(keydata, minimize=True)
+            keydata = self.bingpg.get_public_keydata(kh)
+
+        def update():
+            for addr in uid_addrs:
+                peerstate = self.get_peerstate(addr)
+                peerstate.update_from_msg(
+                    msg_id='', effective_date=time.time(),
+                    prefer_encrypt=prefer_encrypt,
+                    keydata=keydata, keyhandle=kh
+                )
+        self._states.run_transaction(update)
         return ImportKeyResult(account=self.name,
                                prefer_encrypt=prefer_encrypt,
                                addrs=uid_addrs,
-                               keydata=self.bingpg.get_public_keydata(kh),
+                               keydata=keydata,
                                keyhandle=kh)
 
     def process_gossip_headers(self, msg, msg_date, msg_id):
@@ -416,26 +524,48 @@ class Account:
         :rtype: ProcessIncomingResult
         """
         recipients = mime.get_target_emailadr(msg)
-        processed = {}
         addr2pah = mime.get_gossip_headers_from_msg(msg)
-        for recipient in recipients:
-            pah = addr2pah.get(recipient)
-            if pah is not None:
+        processed = dict((recipient, addr2pah[recipient])
+                         for recipient in recipients if recipient in addr2pah)
+        keyhandles = dict(zip(processed, self._import_keys(list(processed.values()))))
+
+        def update():
+            for recipient, pah in processed.items():
                 peerstate = self.get_peerstate(recipient)
-                keyhandle = self._import_key(pah)
                 peerstate.update_from_msg_gossip(
                     msg_id=msg_id, effective_date=msg_date,
-                    keydata=pah.keydata, keyhandle=keyhandle,
+                    keydata=pah.keydata, keyhandle=keyhandles[recipient],
                 )
-                processed[recipient] = pah
+        # commit the entries for all recipients together
+        self._states.run_transaction(update)
         return processed
 
     def _import_key(self, pah):
-        try:
-            return self.bingpg.import_keydata(pah.keydata)
-        except self.bingpg.InvocationFailure:
-            pah.error = "failed to import key"
-            return None
+        return self._import_keys([pah])[0]
+
+    def _import_keys(self, pahs):
+        # skip the gpg invocation for keydata which we imported before
+        # if the keyring was not modified since and import the remaining
+        # keys with a single gpg invocation
+        if not pahs:
+            return []
+        keyring = self.bingpg.get_keyring_signature()
+        keyhandles = [self._states.get_imported_keyhandle(self.name, pah.keydata, keyring)
+                      for pah in pahs]
+        missing = [i for i, keyhandle in enumerate(keyhandles) if keyhandle is None]
+        if not missing:
+            return keyhandles
+        imported = self.bingpg.import_keydata_many([pahs[i].keydata for i in missing])
+        after = self.bingpg.get_keyring_signature()
+        for i, keyhandle in zip(missing, imported):
+            if keyhandle is None:
+                pahs[i].error = "failed to import key"
+                continue
+            self._states.set_imported_keyhandle(self.name, pahs[i].keydata, keyhandle,
+                                                keyring, after)
+            keyring = after
+            keyhandles[i] = keyhandle
+        return keyhandles
 
     def process_outgoing(self, msg):
         """ add Autocrypt header to outgoing message.
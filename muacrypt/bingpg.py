@@ -17,6 +17,8 @@ from subprocess import Popen, PIPE
 from contextlib import contextmanager
 import tempfile
 import re
+from . import openpgp
+from .openpgp import KeyInfo
 iswin32 = sys.platform == "win32" or (getattr(os, '_name', False) == 'nt')
 
 
@@ -257,16 +259,26 @@ class BinGPG(object):
                     last_main_type_keyinfo = keyinfos[-1]
             elif parts[0] == "uid":
                 last_main_type_keyinfo.uids.append(parts[9])
+            elif parts[0] == "fpr" and keyinfos:
+                keyinfos[-1].fingerprint = parts[9]
         return keyinfos
 
-    def _find_keyhandle(self, string, _pattern=re.compile("key (?:ID )?([0-9A-F]+)")):
+    def _find_keyhandle(self, string, keydata=None,
+                        _pattern=re.compile("key (?:ID )?([0-9A-F]+)")):
         m = _pattern.search(string)
         assert m and len(m.groups()) == 1, string
         x = m.groups()[0]
 
         # now search the fingerprint if we only have a shortid
         if len(x) <= 8:   # keyid has 8 hex bytes
-            keyinfos = self.list_public_keyinfos(x)
+            keyinfos = []
+            if keydata is not None:
+                try:
+                    keyinfos = openpgp.parse_keyinfos(keydata)
+                except openpgp.ParseError:
+                    pass
+            if not any(k.match(x) for k in keyinfos):
+                keyinfos = self.list_public_keyinfos(x)
             for k in keyinfos:
                 if k.match(x):
                     return k.id
@@ -357,35 +369,64 @@ class BinGPG(object):
         return out, keyinfos
 
     def import_keydata(self, keydata, minimize=False):
+        if minimize:
+            # import a key minimized in-process if we can select its packets
+            try:
+                keydata = openpgp.minimize_keydata(keydata)
+            except openpgp.ParseError:
+                pass
+            else:
+                minimize = False
         out, err = self._gpg_outerr(["--skip-verify", "--import"], input=keydata)
-        kh = self._find_keyhandle(err)
+        kh = self._find_keyhandle(err, keydata)
         if minimize:
             # get_public_keydata gets us a minimized key
             minimized_keydata = self.get_public_keydata(kh)
             self._gpg_outerr(["--yes", "--delete-key", kh])
             _, err = self._gpg_outerr(["--skip-verify", "--import"], input=minimized_keydata)
-            min_kh = self._find_keyhandle(err)
+            min_kh = self._find_keyhandle(err, minimized_keydata)
             assert min_kh == kh
         return kh
 
-
-class KeyInfo:
-    def __init__(self, type, bits, id, uid, date_created):
-        self.type = type
-        self.bits = int(bits)
-        self.id = id
-        self.uids = [uid] if uid else []
-        self.date_created = date_created
-
-    def match(self, other_id):
-        i = min(len(other_id), len(self.id))
-        return self.id[-i:].lower() == other_id[-i:].lower()
-
-    def __str__(self):
-        return "KeyInfo(id={id!r}, uids={uids!r}, bits={bits}, type={type})".format(
-            **self.__dict__)
-
-    __repr__ = __str__
+    def import_keydata_many(self, keydatas):
+        """ import several keys with a single gpg invocation and return
+        their keyhandles in the same order.  If gpg fails or its status
+        output does not report exactly one key per keydata, the keys are
+        imported separately and None is returned for keys which fail. """
+        if len(keydatas) > 1:
+            try:
+                _, err = self._gpg_outerr(["--status-fd", "2", "--skip-verify", "--import"],
+                                          input=b"".join(keydatas))
+            except InvocationFailure:
+                fingerprints = []
+            else:
+                fingerprints = [line.split()[3] for line in err.splitlines()
+                                if line.startswith("[GNUPG:] IMPORT_OK ")]
+            if len(fingerprints) == len(keydatas):
+                # v4 key ids are the low 64 bits of the fingerprint, v5 the high ones
+                return [fpr[-16:] if len(fpr) == 40 else fpr[:16] for fpr in fingerprints]
+        keyhandles = []
+        for keydata in keydatas:
+            try:
+                keyhandles.append(self.import_keydata(keydata))
+            except InvocationFailure:
+                keyhandles.append(None)
+        return keyhandles
+
+    def get_keyring_signature(self):
+        """ return a list which changes whenever the public keyring files
+        of the gpg home directory are written, without invoking gpg. """
+        homedir = self.homedir or os.environ.get("GNUPGHOME") or \
+            os.path.expanduser("~/.gnupg")
+        signature = []
+        for name in ("pubring.kbx", "pubring.gpg"):
+            try:
+                st = os.stat(os.path.join(homedir, name))
+            except OSError:
+                continue
+            signature.append([name, st.st_ino, st.st_size,
+                              getattr(st, "st_mtime_ns", st.st_mtime)])
+        return signature
 
 
 def find_executable(name):
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+"""
+Compact binary encoding for blocks.
+
+Blocks were originally serialized with execnet's ``dumps`` which spends
+five bytes of length and type information on every value.  The compact
+encoding starts with a magic byte and a version byte followed by the
+encoded block data where each value is a one byte tag followed by:
+
+- ``N``, ``t``, ``f``: nothing (None, True, False)
+- ``I``: a zigzag varint
+- ``F``: an 8 byte big-endian double
+- ``B``: a varint length and the raw bytes
+- ``T``: a varint length and the utf8 encoded text
+- ``C``: the 32 raw bytes of a 64 character lowercase hex text
+  (content addresses) which is decoded back to text
+- ``L``, ``U``, ``D``: a varint number of items followed by the items
+  of a list, tuple or the keys and values of a dict
+
+decode() transparently reads both encodings.
+
+Independently of the encoding, stored blocks and blobs can be zlib
+compressed by compress().  Compressed data starts with the magic byte
+and the version byte with its high bit set.  Content addresses are
+always computed over the uncompressed data so that they don't depend
+on whether and how the data is stored compressed.
+"""
+from __future__ import unicode_literals, print_function
+
+import re
+import zlib
+import struct
+from binascii import hexlify, unhexlify
+import six
+from execnet.gateway_base import dumps, loads
+
+ENCODINGS = ("execnet", "compact")
+
+MAGIC = b"\xb1"
+VERSION = 1
+COMPRESSED = MAGIC + six.int2byte(0x80 | VERSION)
+
+_float = struct.Struct(">d")
+_is_cid = re.compile("[0-9a-f]{64}\\Z").match
+
+
+def encode(obj, encoding="compact"):
+    """ return serialized obj in the given encoding. """
+    if encoding == "execnet":
+        return dumps(obj)
+    assert encoding == "compact", encoding
+    out = [MAGIC, six.int2byte(VERSION)]
+    _encode(obj, out)
+    return b"".join(out)
+
+
+def compress(data, min_size):
+    """ return data zlib-compressed behind the COMPRESSED header if it is
+    at least min_size bytes long and compression makes it smaller.
+    Otherwise data is returned unchanged unless it starts with the
+    COMPRESSED header itself in which case it is always compressed so
+    that decompress() can't mistake it for compressed data. """
+    if data[:2] == COMPRESSED or (min_size and len(data) >= min_size):
+        compressed = COMPRESSED + zlib.compress(data)
+        if len(compressed) < len(data) or data[:2] == COMPRESSED:
+            return compressed
+    return data
+
+
+def decompress(data):
+    """ return uncompressed data from data which was possibly
+    compressed by compress(). """
+    if data[:2] == COMPRESSED:
+        return zlib.decompress(data[2:])
+    return data
+
+
+def decode(serialized):
+    """ return object from data serialized in any of the encodings
+    and possibly compressed. """
+    serialized = decompress(serialized)
+    if serialized[:1] != MAGIC:
+        return loads(serialized)
+    version = bytearray(serialized[1:2])[0]
+    if version != VERSION:
+        raise ValueError("unknown block encoding version {}".format(version))
+    obj, pos = _decode(serialized, 2)
+    if pos != len(serialized):
+        raise ValueError("{} trailing bytes".format(len(serialized) - pos))
+    return obj
+
+
+def _varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _encode(obj, out):
+    try:
+        encoder = _encoders[type(obj)]
+    except KeyError:
+        raise TypeError("can not encode {!r}".format(obj))
+    encoder(obj, out)
+
+
+def _encode_text(obj, out):
+    if len(obj) == 64 and _is_cid(obj):
+        out.extend((b"C", unhexlify(obj)))
+    else:
+        data = obj.encode("utf8")
+        out.extend((b"T", _varint(len(data)), data))
+
+
+def _encode_int(obj, out):
+    out.extend((b"I", _varint(obj << 1 if obj >= 0 else (-obj << 1) - 1)))
+
+
+def _encode_sequence(obj, out):
+    out.extend((b"L" if isinstance(obj, list) else b"U", _varint(len(obj))))
+    for item in obj:
+        _encode(item, out)
+
+
+def _encode_dict(obj, out):
+    out.extend((b"D", _varint(len(obj))))
+    for key in sorted(obj):
+        _encode(key, out)
+        _encode(obj[key], out)
+
+
+_encoders = {
+    type(None): lambda obj, out: out.append(b"N"),
+    bool: lambda obj, out: out.append(b"t" if obj else b"f"),
+    bytes: lambda obj, out: out.extend((b"B", _varint(len(obj)), obj)),
+    six.text_type: _encode_text,
+    float: lambda obj, out: out.extend((b"F", _float.pack(obj))),
+    list: _encode_sequence,
+    tuple: _encode_sequence,
+    dict: _encode_dict,
+}
+for _type in six.integer_types:
+    _encoders[_type] = _encode_int
+
+
+def _read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = bytearray(data[pos:pos + 1])[0]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def _decode(data, pos):
+    tag = data[pos:pos + 1]
+    pos += 1
+    if tag in (b"T", b"B"):
+        length, pos = _read_varint(data, pos)
+        value = data[pos:pos + length]
+        return (value.decode("utf8") if tag == b"T" else value), pos + length
+    elif tag == b"C":
+        return hexlify(data[pos:pos + 32]).decode("ascii"), pos + 32
+    elif tag == b"F":
+        return _float.unpack_from(data, pos)[0], pos + 8
+    elif tag == b"I":
+        value, pos = _read_varint(data, pos)
+        return (value >> 1 if not value & 1 else -((value + 1) >> 1)), pos
+    elif tag in (b"L", b"U"):
+        num, pos = _read_varint(data, pos)
+        items = []
+        for i in range(num):
+            item, pos = _decode(data, pos)
+            items.append(item)
+        return (items if tag == b"L" else tuple(items)), pos
+    elif tag == b"D":
+        num, pos = _read_varint(data, pos)
+        d = {}
+        for i in range(num):
+            key, pos = _decode(data, pos)
+            d[key], pos = _decode(data, pos)
+        return d, pos
+    elif tag == b"N":
+        return None, pos
+    elif tag in (b"t", b"f"):
+        return tag == b"t", pos
+    raise ValueError("invalid tag {!r} at position {}".format(tag, pos - 1))
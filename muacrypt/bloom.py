@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+"""
+Persistent Bloom filter for quickly telling that a key
+(e.g. a Message-ID) was never added.
+
+The filter is a file consisting of a fixed size header and a bit array
+which is mmapped and modified in place so that adding a key costs a few
+byte writes independently of the filter size.  A negative lookup is
+definitive while a positive one may be false with the configured
+probability.  Concurrent writers may lose each other's bit updates
+which can only produce (harmless) negative answers for added keys
+if callers treat the filter as a performance hint.
+"""
+from __future__ import unicode_literals, print_function
+
+import os
+import math
+import mmap
+import struct
+import hashlib
+
+# fp_rate, num_hashes, num_bits, capacity, count,
+# negatives, positives, false_positives
+_header = struct.Struct(">dIQQQQQQ")
+_counters = ("count", "negatives", "positives", "false_positives")
+
+
+def optimal_params(capacity, fp_rate):
+    """ return (num_bits, num_hashes) for a filter which holds capacity
+    keys with a false-positive probability of fp_rate. """
+    num_bits = int(math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+    num_bits = max(8, (num_bits + 7) // 8 * 8)
+    num_hashes = max(1, int(round(num_bits / float(capacity) * math.log(2))))
+    return num_bits, num_hashes
+
+
+class BloomFilter:
+    """ Bloom filter stored in a file.  Use create() for writing
+    a new filter file. """
+    def __init__(self, path):
+        self.path = path
+        self._map = None
+        self._ident = None
+
+    @classmethod
+    def create(cls, path, capacity, fp_rate, keys=()):
+        """ atomically write a new filter file which contains keys
+        and return a BloomFilter instance for it. """
+        num_bits, num_hashes = optimal_params(capacity, fp_rate)
+        bits = bytearray(num_bits // 8)
+        count = 0
+        for key in keys:
+            if _set_bits(bits, _positions(key, num_bits, num_hashes)):
+                count += 1
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_header.pack(fp_rate, num_hashes, num_bits, capacity, count, 0, 0, 0))
+            f.write(bytes(bits))
+        os.rename(tmp_path, path)
+        return cls(path)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _refresh(self):
+        """ (re-)map the filter file if it was replaced. """
+        st = os.stat(self.path)
+        ident = (st.st_dev, st.st_ino)
+        if ident != self._ident:
+            self.close()
+            with open(self.path, "r+b") as f:
+                self._map = mmap.mmap(f.fileno(), 0)
+            self._ident = ident
+        return self._map
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._ident = None
+
+    def _read_header(self):
+        return _header.unpack_from(self._refresh(), 0)
+
+    @property
+    def fp_rate(self):
+        return self._read_header()[0]
+
+    @property
+    def capacity(self):
+        return self._read_header()[3]
+
+    def get_stats(self):
+        """ return dict with size and usage statistics. """
+        (fp_rate, num_hashes, num_bits, capacity,
+         count, negatives, positives, false_positives) = self._read_header()
+        return dict(fp_rate=fp_rate, num_hashes=num_hashes, size=num_bits // 8,
+                    capacity=capacity, count=count, negatives=negatives,
+                    positives=positives, false_positives=false_positives)
+
+    def _incr(self, name):
+        m = self._refresh()
+        offset = _header.size - 8 * (len(_counters) - _counters.index(name))
+        value, = struct.unpack_from(">Q", m, offset)
+        struct.pack_into(">Q", m, offset, value + 1)
+
+    def add(self, key):
+        """ add key to the filter. """
+        m = self._refresh()
+        fp_rate, num_hashes, num_bits = _header.unpack_from(m, 0)[:3]
+        changed = False
+        for pos in _positions(key, num_bits, num_hashes):
+            i = _header.size + pos // 8
+            byte = bytearray(m[i:i + 1])[0]
+            mask = 1 << (pos % 8)
+            if not byte & mask:
+                m[i:i + 1] = bytes(bytearray([byte | mask]))
+                changed = True
+        if changed:
+            self._incr("count")
+
+    def __contains__(self, key):
+        m = self._refresh()
+        fp_rate, num_hashes, num_bits = _header.unpack_from(m, 0)[:3]
+        for pos in _positions(key, num_bits, num_hashes):
+            i = _header.size + pos // 8
+            if not bytearray(m[i:i + 1])[0] & (1 << (pos % 8)):
+                return False
+        return True
+
+    def check(self, key):
+        """ return False if key was definitely not added and True if it
+        might have been added and record the answer in the statistics.
+        Call record_false_positive() if an exact check disagrees. """
+        if key in self:
+            self._incr("positives")
+            return True
+        self._incr("negatives")
+        return False
+
+    def record_false_positive(self):
+        self._incr("false_positives")
+
+
+def _positions(key, num_bits, num_hashes):
+    digest = hashlib.sha256(key.encode("utf8")).digest()
+    h1, h2 = struct.unpack(">QQ", digest[:16])
+    return [(h1 + i * h2) % num_bits for i in range(num_hashes)]
+
+
+def _set_bits(bits, positions):
+    changed = False
+    for pos in positions:
+        mask = 1 << (pos % 8)
+        if not bits[pos // 8] & mask:
+            bits[pos // 8] |= mask
+            changed = True
+    return changed
@@ -6,43 +6,388 @@ which consist of hash-linked entries.
 
 The HeadTracker keeps track of named "heads" which can be queried
 through the States class.  Both the current BlockService and the
-HeadTracker use the file system for persistent storage.
+HeadTracker use the file system for persistent storage.  See the
+packstore module for a BlockService which stores blocks in packfiles.
 """
 from __future__ import unicode_literals, print_function
 
 import os
 import time
-from execnet.gateway_base import load, dump, dumps
+import random
+import struct
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from itertools import islice
+from contextlib import contextmanager
+from execnet.gateway_base import load, loads, dump, dumps
 import hashlib
 from pprint import pprint
 import attr
+import six
+from . import blockcodec
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+class BlockCache:
+    """ size-bounded LRU cache of decoded blocks.
+
+    Blocks are immutable and addressed by their content so cached
+    blocks never need to be invalidated.  The cache is bounded both
+    by the number of blocks and by the sum of their serialized sizes.
+    """
+    def __init__(self, max_entries=10000, max_bytes=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size_bytes = 0
+        # cid -> (block, serialized size), least recently used first
+        self._blocks = OrderedDict()
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def get(self, cid):
+        try:
+            item = self._blocks.pop(cid)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._blocks[cid] = item
+        self.hits += 1
+        return item[0]
+
+    def put(self, block, size):
+        old = self._blocks.pop(block.cid, None)
+        if old is not None:
+            self.size_bytes -= old[1]
+        if size > self.max_bytes:
+            return
+        self._blocks[block.cid] = (block, size)
+        self.size_bytes += size
+        while len(self._blocks) > self.max_entries or self.size_bytes > self.max_bytes:
+            _, (_, oldsize) = self._blocks.popitem(last=False)
+            self.size_bytes -= oldsize
+
+    def discard(self, cid):
+        item = self._blocks.pop(cid, None)
+        if item is not None:
+            self.size_bytes -= item[1]
+
+    def clear(self):
+        self._blocks.clear()
+        self.size_bytes = 0
+
+    def stats(self):
+        return dict(entries=len(self), size_bytes=self.size_bytes,
+                    hits=self.hits, misses=self.misses)
+
+
+FSYNC_POLICIES = ("none", "commit", "always")
+BLOCK_LAYOUTS = ("flat", "fanout")
+
+# how often run_transaction() retries after a HeadConflict
+MAX_CONFLICT_RETRIES = 20
+
+# marker for upserts which move a head regardless of its current cid
+_anycid = object()
+
+
+class HeadConflict(Exception):
+    """ raised when a head was moved by another writer since it
+    was read by a compare-and-swap upsert. """
+
+
+@contextmanager
+def locked(path):
+    """ hold an exclusive lock on the given lock file which serializes
+    writers from different processes (where fcntl is available). """
+    with open(path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def run_transaction(transaction, func, *args, **kwargs):
+    """ call func within the transaction() context and return its result.
+    If committing fails with a HeadConflict because another writer moved
+    a head in the meantime, func is called again in a new transaction
+    so that it works from the current heads instead of losing the other
+    writer's update. """
+    for attempt in range(MAX_CONFLICT_RETRIES):
+        try:
+            with transaction():
+                return func(*args, **kwargs)
+        except HeadConflict:
+            time.sleep(random.uniform(0, 0.002 * (attempt + 1)))
+    with transaction():
+        return func(*args, **kwargs)
+
+
+def fsync_path(path):
+    """ flush file or directory contents to stable storage. """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 class BlockService:
     """ Filesystem Blockservice for storing and getting immutable blocks
-    for use from Chain instances. """
-    def __init__(self, basedir):
+    for use from Chain instances.  If a BlockCache is specified
+    decoded blocks are kept in memory.
+
+    The fsync policy determines when written blocks are flushed to stable
+    storage: "none" leaves it to the operating system, "commit" flushes
+    all blocks written in a transaction when it finishes and "always"
+    flushes each block when it is written.
+
+    New blocks are serialized in the given blockcodec encoding while
+    blocks in any encoding can be read.
+
+    With fanout=True blocks are stored in subdirectories named after
+    the first two characters of their content address ("ab/cdef...")
+    instead of all in one directory.  Blocks are found in either layout
+    so that a store can be converted while it is in use.
+
+    Blocks and blobs of at least compress_min_size bytes (if not 0) are
+    stored zlib compressed when that saves space.  Their content address
+    is computed over the uncompressed data and compressed data is read
+    transparently whatever the setting.
+
+    Iterating over a chain asks for up to readahead blocks at a time.
+    Storages which keep blocks in write order (see the packstore and
+    sqlitestore modules) then read the blocks stored before a requested
+    one in the same read so that parents are usually found in memory.
+    Here every block is a file of its own and is read on its own.
+    """
+    fsync = "none"
+    encoding = "execnet"
+    fanout = False
+    readahead = 64
+    compress_min_size = 0
+    _depth = 0
+
+    def __init__(self, basedir, cache=None, fsync="none", encoding="execnet",
+                 fanout=False, readahead=64, compress_min_size=0):
         self._basedir = basedir
+        self._cache = cache
+        self.fsync = fsync
+        self.encoding = encoding
+        self.fanout = fanout
+        self.readahead = readahead
+        self.compress_min_size = compress_min_size
+        self._unsynced = set()
+
+    def close(self):
+        """ release open files.  Blocks are written when stored so
+        there is nothing to flush here. """
+
+    @contextmanager
+    def transaction(self):
+        """ context for writing several blocks.  With the "commit" fsync
+        policy they are flushed together when the outermost transaction
+        finishes without error. """
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+        if not self._depth:
+            self._sync()
+
+    def _written(self, key):
+        """ register data written under key for flushing according
+        to the fsync policy. """
+        if self.fsync == "always" or (self.fsync == "commit" and not self._depth):
+            self._sync_keys([key])
+        elif self.fsync == "commit":
+            self._unsynced.add(key)
+
+    def _sync(self):
+        if self._unsynced:
+            keys, self._unsynced = self._unsynced, set()
+            self._sync_keys(keys)
+
+    def _sync_keys(self, keys):
+        dirs = set([self._basedir])
+        for cid in keys:
+            path = self._block_path(cid)
+            fsync_path(path)
+            dirs.add(os.path.dirname(path))
+        for path in dirs:
+            fsync_path(path)
 
     def store_block(self, type, args, parent=None):
         # we choose the simplest data structure to create a block for a states_fs
         # each block references a parent block (or None if it's the
         # genesis block) and a timestamp.
-        data = [type, parent, time.time()] + list(args)
-        serialized = dumps(data)
+        data = [self._make_meta(parent), type, parent, time.time()] + list(args)
+        serialized = blockcodec.encode(data, self.encoding)
         cid = hashlib.sha256(serialized).hexdigest()
-        path = os.path.join(self._basedir, cid)
-        with open(path, "wb") as f:
-            f.write(serialized)
-        return Block(cid, data, bs=self)
+        self._store_serialized(cid, blockcodec.compress(serialized, self.compress_min_size))
+        block = Block(cid, data, bs=self)
+        if self._cache is not None:
+            self._cache.put(block, len(serialized))
+        return block
 
-    def get_block(self, cid):
+    def _make_meta(self, parent_cid):
+        """ return height, root and skip list of ancestors at distance
+        1, 2, 4, ... for a new block with the given parent. """
+        if parent_cid is None:
+            return dict(height=1, root=None, skip=[])
+        parent = self.get_block(parent_cid)
+        height = parent.height + 1
+        skip = [parent_cid]
+        while 2 ** len(skip) < height:
+            # the ancestor at distance 2**i is at distance 2**(i-1)
+            # from the ancestor at distance 2**(i-1)
+            prev = self.get_block(skip[-1])
+            skip.append(prev.get_ancestor(2 ** (len(skip) - 1)).cid)
+        return dict(height=height, root=parent.root_cid, skip=skip)
+
+    def get_block(self, cid, readahead=1):
+        """ return the block with the given cid or None.  With readahead
+        greater than one up to that many blocks stored before it may be
+        read along with it to serve subsequent requests. """
         fn_cid = cid if not isinstance(cid, bytes) else cid.decode("ascii")
-        path = os.path.join(self._basedir, fn_cid)
-        if os.path.exists(path):
+        if self._cache is not None:
+            block = self._cache.get(fn_cid)
+            if block is not None:
+                return block
+        serialized = self._get_serialized(fn_cid, readahead)
+        if serialized is not None:
+            block = Block(fn_cid, blockcodec.decode(serialized), bs=self)
+            if self._cache is not None:
+                self._cache.put(block, len(serialized))
+            return block
+
+    def store_blob(self, data):
+        """ store bytes under their content address and return it.
+        Storing the same bytes again does not take up more space. """
+        cid = six.text_type(hashlib.sha256(data).hexdigest())
+        self._store_serialized(cid, blockcodec.compress(data, self.compress_min_size))
+        return cid
+
+    def get_blob(self, cid):
+        """ return bytes stored with store_blob() or None. """
+        data = self._get_serialized(cid)
+        if data is not None:
+            return blockcodec.decompress(data)
+
+    def iter_cids(self):
+        """ yield the content addresses of all stored blocks and blobs. """
+        for name in os.listdir(self._basedir):
+            if len(name) == 2:
+                for rest in os.listdir(os.path.join(self._basedir, name)):
+                    if not rest.endswith(".tmp"):
+                        yield name + rest
+            elif not name.endswith(".tmp"):
+                yield name
+
+    def remove_blocks(self, cids):
+        """ remove the blocks and blobs with the given content addresses
+        and return the number of removed ones. """
+        count = 0
+        for cid in cids:
+            if self._cache is not None:
+                self._cache.discard(cid)
+            path = self._find_path(cid)
+            if path is not None:
+                os.remove(path)
+                count += 1
+        return count
+
+    def convert_layout(self):
+        """ move blocks stored in the other layout into the layout of
+        this block service and return the number of moved blocks. """
+        count = 0
+        with self.transaction():
+            for cid in list(self.iter_cids()):
+                old_path = self._block_path(cid, not self.fanout)
+                if not os.path.exists(old_path):
+                    continue
+                path = self._block_path(cid)
+                if os.path.exists(path):
+                    # stored by another process in the meantime
+                    os.remove(old_path)
+                else:
+                    self._make_dir(path)
+                    os.rename(old_path, path)
+                    self._written(cid)
+                count += 1
+        if not self.fanout:
+            for name in os.listdir(self._basedir):
+                path = os.path.join(self._basedir, name)
+                if len(name) == 2 and not os.listdir(path):
+                    os.rmdir(path)
+        return count
+
+    def _block_path(self, cid, fanout=None):
+        if fanout is None:
+            fanout = self.fanout
+        if fanout:
+            return os.path.join(self._basedir, cid[:2], cid[2:])
+        return os.path.join(self._basedir, cid)
+
+    def _find_path(self, cid):
+        # a concurrent convert_layout() may move the block after the
+        # first lookup so we look into this service's layout once more
+        for fanout in (self.fanout, not self.fanout, self.fanout):
+            path = self._block_path(cid, fanout)
+            if os.path.exists(path):
+                return path
+
+    def _make_dir(self, path):
+        dirpath = os.path.dirname(path)
+        if not os.path.isdir(dirpath):
+            try:
+                os.mkdir(dirpath)
+            except OSError:
+                # created by another process
+                if not os.path.isdir(dirpath):
+                    raise
+
+    def _store_serialized(self, cid, serialized):
+        for fanout in (self.fanout, not self.fanout):
+            if os.path.exists(self._block_path(cid, fanout)):
+                # content addressed data never changes
+                return
+        path = self._block_path(cid)
+        self._make_dir(path)
+        # write to a temporary file so that a crash can not leave
+        # a truncated file under the content address
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(serialized)
+        os.rename(tmp_path, path)
+        self._written(cid)
+
+    def _get_serialized(self, cid, readahead=1):
+        path = self._find_path(cid)
+        if path is not None:
             with open(path, "rb") as f:
-                data = load(f)
-            return Block(cid, data, bs=self)
+                return f.read()
+
+
+def copy_blocks(source, target):
+    """ copy all blocks from the source to the target block service
+    and return the number of copied blocks.  Block content is copied
+    verbatim so that all content addresses remain valid. """
+    count = 0
+    for cid in source.iter_cids():
+        target._store_serialized(cid, source._get_serialized(cid))
+        count += 1
+    return count
 
 
 class Block:
@@ -52,15 +397,55 @@ class Block:
     - parent_cid: the parent content address or None
     - timestamp: when this block was created in seconds since epoch
     - args: the block-specific payload
+    - height: the number of blocks from the root up to this block
     """
     def __init__(self, cid, data, bs):
         self.cid = cid
+        if isinstance(data[0], dict):
+            self._meta = data[0]
+            data = data[1:]
+        else:
+            # blocks written before heights and skip lists were introduced
+            self._meta = None
         self.type = data[0]
         self.parent_cid = data[1]
         self.timestamp = data[2]
         self.args = data[3:]
         self._bs = bs
 
+    @property
+    def height(self):
+        if self._meta is None:
+            blocks = list(self)
+            root = blocks[-1].cid if len(blocks) > 1 else None
+            self._meta = dict(height=len(blocks), root=root, skip=None)
+        return self._meta["height"]
+
+    @property
+    def root_cid(self):
+        """ cid of the first block of the chain. """
+        if self._meta is None:
+            self.height
+        return self._meta["root"] or self.cid
+
+    def get_ancestor(self, distance):
+        """ return the block distance steps towards the root
+        or None if the chain is not that long. """
+        if distance >= self.height:
+            return None
+        current = self
+        while distance:
+            skip = current._meta and current._meta["skip"]
+            if not skip:
+                # blocks written without metadata have no skip list
+                current = current.parent
+                distance -= 1
+                continue
+            i = min(len(skip), distance.bit_length()) - 1
+            current = self._bs.get_block(skip[i])
+            distance -= 2 ** i
+        return current
+
     @property
     def parent(self):
         """ parent block or None. """
@@ -71,54 +456,474 @@ class Block:
         return self.cid == other.cid
 
     def __iter__(self):
+        # parents are requested with a read-ahead window which doubles
+        # up to the block service's limit so that walking a long chain
+        # takes few reads while short walks read little more than needed
         current = self
+        window = 1
         while current:
             yield current
-            current = current.parent
+            if not current.parent_cid:
+                return
+            window = min(window * 2, max(self._bs.readahead, 1))
+            current = self._bs.get_block(current.parent_cid, readahead=window)
 
     def contains_cid(self, cid):
-        for x in self:
-            if x.cid == cid:
-                return True
+        """ return True if the block with the given cid is
+        this block or one of its ancestors. """
+        other = self._bs.get_block(cid)
+        if other is None or other.height > self.height:
+            return False
+        ancestor = self.get_ancestor(self.height - other.height)
+        return ancestor.cid == other.cid
 
     def get_last_parent(self):
+        if self._meta is not None:
+            return self._bs.get_block(self.root_cid)
         for current in self:
             pass
         return current
 
 
 class HeadTracker:
-    """ Filesystem implementation for the mutable ID->HEAD mappings """
-    def __init__(self, path):
+    """ Filesystem implementation for the mutable ID->HEAD mappings.
+
+    Head moves within a transaction are collected in memory and written
+    together when the outermost transaction finishes without error.
+    With an fsync policy other than "none" written heads are flushed
+    to stable storage.
+
+    Head names are listed from a sorted list of names so that listing
+    the names with a prefix costs a binary search plus the number of
+    listed names.
+
+    Writes happen under an fcntl lock on a ".lock" file next to the
+    heads file and replace the file atomically by renaming so that
+    several processes can move heads of the same state directory.
+    An upsert with an expected cid only moves the head if no other
+    writer moved it in the meantime and raises HeadConflict otherwise.
+    """
+    fsync = "none"
+    _names_page_size = 100
+
+    def __init__(self, path, fsync="none"):
         self._path = path
+        self.fsync = fsync
+        # name -> cid (None for removed heads) of the current transaction
+        self._pending = None
+        # name -> cid which heads must still have when the transaction commits
+        self._expected = None
+        # sorted head names and the signature of the file they were read from
+        self._names = []
+        self._names_sig = None
 
     def get_head_cid(self, account):
-        heads = self._getheads()
-        return heads.get(account)
+        if self._pending is not None and account in self._pending:
+            return self._pending[account]
+        return self._get(account)
 
     def _getheads(self, prefix=""):
+        d = self._load()
+        if self._pending:
+            d.update(self._pending)
+        return dict((x[len(prefix):], y) for x, y in d.items()
+                    if x.startswith(prefix) and y is not None)
+
+    def remove_if(self, cal):
+        self._update((x, None) for x, y in self._getheads().items() if cal(x, y))
+
+    def get_names(self, prefix="", after=None, limit=None):
+        """ return sorted list of head names starting with prefix
+        (with the prefix stripped).  With after and limit only a page
+        of at most limit names which sort after the given name is
+        returned. """
+        names = self.iter_names(prefix, after=after)
+        if limit is not None:
+            names = islice(names, limit)
+        return list(names)
+
+    def iter_names(self, prefix="", after=None):
+        """ yield sorted head names starting with prefix (with the
+        prefix stripped) page by page, optionally starting after the
+        given name. """
+        last = prefix + after if after is not None else None
+        while True:
+            page = self._names_page(prefix, last, self._names_page_size)
+            for name in page:
+                yield name[len(prefix):]
+            if len(page) < self._names_page_size:
+                return
+            last = page[-1]
+
+    def _names_page(self, prefix, last, limit):
+        """ return up to limit sorted full head names starting with
+        prefix which sort after last (or from the start if None). """
+        names = self._sorted_names()
+        if last is None:
+            i = bisect_left(names, prefix)
+        else:
+            i = bisect_right(names, last)
+        page = names[i:i + limit]
+        # names after the prefix range sort behind all names in it
+        while page and not page[-1].startswith(prefix):
+            page.pop()
+        return page
+
+    def _sorted_names(self):
+        if self._pending:
+            return sorted(self._getheads())
+        try:
+            st = os.stat(self._path)
+        except OSError:
+            return []
+        sig = (st.st_ino, st.st_size, st.st_mtime)
+        if sig != self._names_sig:
+            self._names = sorted(self._load())
+            self._names_sig = sig
+        return self._names
+
+    def upsert(self, account, cid, expected_cid=_anycid):
+        """ move the head to cid.  If expected_cid is given (None for
+        a head which does not exist yet) the head is only moved if it
+        still points to expected_cid and HeadConflict is raised otherwise.
+        Within a transaction the check happens when it commits. """
+        expected = None if expected_cid is _anycid else {account: expected_cid}
+        self._update([(account, cid.cid if isinstance(cid, Block) else cid)], expected)
+
+    def upsert_many(self, items):
+        """ set heads from a list of (name, cid) pairs. """
+        self._update((account, cid.cid if isinstance(cid, Block) else cid)
+                     for account, cid in items)
+
+    def _update(self, items, expected=None):
+        if self._pending is not None:
+            for name, cid in (expected or {}).items():
+                # later expectations refer to moves of this transaction
+                if name not in self._pending and name not in self._expected:
+                    self._expected[name] = cid
+            self._pending.update(items)
+        else:
+            self._write(list(items), expected)
+
+    @contextmanager
+    def transaction(self):
+        """ context for reading and moving heads atomically if the
+        underlying storage supports it. """
+        if self._pending is not None:
+            yield
+            return
+        self._pending, self._expected = {}, {}
+        try:
+            yield
+        except BaseException:
+            self._pending = self._expected = None
+            raise
+        pending, expected = self._pending, self._expected
+        self._pending = self._expected = None
+        if pending:
+            self._write(list(pending.items()), expected)
+
+    # storage specific methods
+
+    def _get(self, name):
+        return self._load().get(name)
+
+    def _load(self):
         if os.path.exists(self._path):
             with open(self._path, "rb") as f:
-                d = load(f)
-                if prefix:
-                    d = dict((x[len(prefix):], y) for x, y in d.items()
-                             if x.startswith(prefix))
-                return d
+                return load(f)
         return {}
 
-    def remove_if(self, cal):
-        heads = self._getheads()
-        filtered = dict((x, y) for x, y in heads.items() if not cal(x, y))
-        with open(self._path, "wb") as f:
-            dump(f, filtered)
+    def _write(self, items, expected=None):
+        """ apply (name, cid) items where a cid of None removes the head
+        after checking that the heads in the expected dict still point
+        to the given cids. """
+        with locked(self._path + ".lock"):
+            heads = self._load()
+            _check_expected(heads.get, expected)
+            for name, cid in items:
+                if cid is None:
+                    heads.pop(name, None)
+                else:
+                    heads[name] = cid
+            tmp_path = self._path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                dump(f, heads)
+                if self.fsync != "none":
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.rename(tmp_path, self._path)
+            if self.fsync != "none":
+                fsync_path(os.path.dirname(os.path.abspath(self._path)))
+
+
+# header of journal files followed by random bytes which
+# identify the generation of the journal
+_JOURNAL_MAGIC = b"muajrnl1"
+_JOURNAL_GENERATION_SIZE = 8
+
+
+class JournalMap:
+    """ Persistent mapping which appends each modification to a journal
+    file and periodically compacts the journal into a snapshot file.
+
+    All items are kept in an in-memory dict which is rebuilt from the
+    snapshot plus the journal.  A modification costs one small append
+    independently of the number of items.  Compaction happens when the
+    journal grows larger than the snapshot so that its cost is amortized
+    over the modifications which caused it.  Modifications appended by
+    other instances are picked up on read.  Modifications and compactions
+    happen under an fcntl lock on a ".lock" file next to the snapshot so
+    that several processes can modify the same map.
+    """
+    _rec_len = struct.Struct(">I")
+
+    def __init__(self, path, min_compact_size=64 * 1024, fsync=False):
+        self._path = path
+        self._journal_path = path + ".journal"
+        self._min_compact_size = min_compact_size
+        self._fsync = fsync
+        self._items = None
+        # sorted list of keys, maintained once it was requested
+        self._sorted = None
+        self._snapshot_size = 0
+        self._journal_id = None
+        self._journal_end = 0
+        self._locked = False
+
+    @contextmanager
+    def locked(self):
+        """ hold the lock which serializes modifications of the map
+        from different processes.  It may be acquired again while held. """
+        if self._locked:
+            yield
+            return
+        with locked(self._path + ".lock"):
+            self._locked = True
+            try:
+                yield
+            finally:
+                self._locked = False
+
+    def _stat_journal(self):
+        """ return the generation and size of the journal.  Journals
+        written by earlier versions have no header and generation b"". """
+        try:
+            f = open(self._journal_path, "rb")
+        except (IOError, OSError):
+            return None, 0
+        with f:
+            return self._read_generation(f), os.fstat(f.fileno()).st_size
+
+    def _read_generation(self, f):
+        header = f.read(len(_JOURNAL_MAGIC) + _JOURNAL_GENERATION_SIZE)
+        if len(header) == len(_JOURNAL_MAGIC) + _JOURNAL_GENERATION_SIZE and \
+                header.startswith(_JOURNAL_MAGIC):
+            return header
+        return b""
+
+    def _refresh(self):
+        journal_id, size = self._stat_journal()
+        if self._items is None or journal_id != self._journal_id or size < self._journal_end:
+            self._items = {}
+            self._sorted = None
+            self._snapshot_size = 0
+            if os.path.exists(self._path):
+                with open(self._path, "rb") as f:
+                    serialized = f.read()
+                self._items.update(loads(serialized))
+                self._snapshot_size = len(serialized)
+            self._journal_id = journal_id
+            self._journal_end = len(journal_id or b"")
+        if size > self._journal_end:
+            self._read_journal()
+        return self._items
+
+    def _read_journal(self):
+        with open(self._journal_path, "rb") as f:
+            if self._read_generation(f) != self._journal_id:
+                # the journal was replaced by a compaction, the next
+                # refresh reads the new snapshot
+                return
+            f.seek(self._journal_end)
+            data = f.read()
+        pos = 0
+        hsize = self._rec_len.size
+        while pos + hsize <= len(data):
+            length, = self._rec_len.unpack_from(data, pos)
+            if pos + hsize + length > len(data):
+                # incomplete record of a crashed or concurrent writer
+                break
+            key, value = loads(data[pos + hsize:pos + hsize + length])
+            if value is None:
+                if self._items.pop(key, None) is not None and self._sorted is not None:
+                    del self._sorted[bisect_left(self._sorted, key)]
+            else:
+                if key not in self._items and self._sorted is not None:
+                    insort(self._sorted, key)
+                self._items[key] = value
+            pos += hsize + length
+        self._journal_end += pos
+
+    def get(self, key, default=None):
+        return self._refresh().get(key, default)
+
+    def items(self):
+        return list(self._refresh().items())
+
+    def sorted_keys(self):
+        """ return the sorted list of keys.  It is kept up to date
+        incrementally and must not be modified. """
+        items = self._refresh()
+        if self._sorted is None:
+            self._sorted = sorted(items)
+        return self._sorted
+
+    def update(self, items):
+        """ set or (for None values) delete keys according to
+        the (key, value) pairs in items. """
+        records = []
+        for key, value in items:
+            serialized = dumps((key, value))
+            records.append(self._rec_len.pack(len(serialized)) + serialized)
+        with self.locked():
+            self._refresh()
+            if self._journal_id is None:
+                self._new_journal()
+                self._refresh()
+            journal_id, size = self._stat_journal()
+            if size > self._journal_end:
+                # cut off an incomplete record left over from a crashed writer
+                with open(self._journal_path, "r+b") as f:
+                    f.truncate(self._journal_end)
+            with open(self._journal_path, "ab") as f:
+                f.write(b"".join(records))
+                if self._fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            self._read_journal()
+            if self._journal_end > max(self._snapshot_size, self._min_compact_size):
+                self.compact()
+
+    def _new_journal(self):
+        """ replace the journal by an empty one with a new generation.
+        Readers recognize the new journal by its generation as the file
+        might reuse the inode of an earlier journal.  Must be called
+        with the lock held. """
+        tmp_path = self._journal_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_JOURNAL_MAGIC + os.urandom(_JOURNAL_GENERATION_SIZE))
+            if self._fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.rename(tmp_path, self._journal_path)
+
+    def compact(self):
+        """ write all items to a new snapshot and start an empty journal. """
+        with self.locked():
+            items = self._refresh()
+            serialized = dumps(items)
+            tmp_path = self._path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(serialized)
+                if self._fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.rename(tmp_path, self._path)
+            self._new_journal()
+            if self._fsync:
+                fsync_path(os.path.dirname(os.path.abspath(self._path)))
+            self._snapshot_size = len(serialized)
+            self._journal_id, self._journal_end = self._stat_journal()
+
+
+class ShardedMap:
+    """ Persistent mapping which distributes its items over a fixed
+    number of JournalMap shards so that reading an item only loads the
+    shard which contains it instead of all items.  Keys which share the
+    part before the first newline (e.g. the name of a chain) are kept
+    in the same shard which shard() returns for use on its own.
+    """
+    def __init__(self, dirpath, num_shards=256, fsync=False):
+        self._dirpath = dirpath
+        self._num_shards = num_shards
+        self._fsync = fsync
+        # shard number -> JournalMap
+        self._shards = {}
+        if not os.path.exists(dirpath):
+            os.makedirs(dirpath)
 
-    def upsert(self, account, cid):
-        if isinstance(cid, Block):
-            cid = cid.cid
-        heads = self._getheads()
-        heads[account] = cid
-        with open(self._path, "wb") as f:
-            dump(f, heads)
+    def _shard_num(self, key):
+        shardkey = key.split("\n", 1)[0].encode("utf-8")
+        return int(hashlib.sha256(shardkey).hexdigest()[:8], 16) % self._num_shards
+
+    def _get_shard(self, num):
+        shard = self._shards.get(num)
+        if shard is None:
+            path = os.path.join(self._dirpath, "{:03d}".format(num))
+            shard = self._shards[num] = JournalMap(path, fsync=self._fsync)
+        return shard
+
+    def shard(self, key):
+        """ return the JournalMap which holds key. """
+        return self._get_shard(self._shard_num(key))
+
+    def get(self, key, default=None):
+        return self.shard(key).get(key, default)
+
+    def items(self):
+        items = []
+        for num in range(self._num_shards):
+            items.extend(self._get_shard(num).items())
+        return items
+
+    def update(self, items):
+        """ set or (for None values) delete keys according to
+        the (key, value) pairs in items. """
+        by_shard = {}
+        for key, value in items:
+            by_shard.setdefault(self._shard_num(key), []).append((key, value))
+        for num, shard_items in sorted(by_shard.items()):
+            self._get_shard(num).update(shard_items)
+
+    def compact(self):
+        for num in range(self._num_shards):
+            if os.path.exists(self._get_shard(num)._journal_path):
+                self._get_shard(num).compact()
+
+
+class JournalHeadTracker(HeadTracker):
+    """ HeadTracker which appends head updates to a journal so that the
+    cost of an update does not grow with the number of heads.  The
+    snapshot file uses the same format as the plain HeadTracker's file. """
+    def __init__(self, path, min_compact_size=64 * 1024, fsync="none"):
+        HeadTracker.__init__(self, path, fsync=fsync)
+        self._map = JournalMap(path, min_compact_size=min_compact_size,
+                               fsync=fsync != "none")
+
+    def _get(self, name):
+        return self._map.get(name)
+
+    def _load(self):
+        return dict(self._map.items())
+
+    def _sorted_names(self):
+        if self._pending:
+            return sorted(self._getheads())
+        return self._map.sorted_keys()
+
+    def _write(self, items, expected=None):
+        with self._map.locked():
+            _check_expected(self._map.get, expected)
+            self._map.update(items)
+
+
+def _check_expected(get, expected):
+    for name, cid in (expected or {}).items():
+        current = get(name)
+        if current != cid:
+            raise HeadConflict("head {!r} was moved from {} to {}".format(
+                name, cid, current))
 
 
 class ChainStates(object):
@@ -140,14 +945,25 @@ class ChainStates(object):
                 if type is None or x.type == type:
                     yield x
 
-    def new_head_block(self, type, args):
-        head = self.get_head_block()
-        if head:
-            head = head.cid
-        block = self._bs.store_block(type, args, parent=head)
-        self._ht.upsert(self.head_name, block.cid)
+    def new_head_block(self, type, args, root=False):
+        """ store a block on top of the head (or as the root of a new
+        chain if root is True) and move the head to it.  If another
+        writer moves the head concurrently the block is stored on
+        top of the new head instead. """
+        return run_transaction(self.transaction, self._new_head_block, type, args, root)
+
+    def _new_head_block(self, type, args, root):
+        head = self._ht.get_head_cid(self.head_name)
+        block = self._bs.store_block(type, args, parent=None if root else head)
+        self._ht.upsert(self.head_name, block.cid, expected_cid=head)
         return block
 
+    @contextmanager
+    def transaction(self):
+        # blocks are flushed before the head is moved to them
+        with self._ht.transaction(), self._bs.transaction():
+            yield
+
     def get_head_block(self):
         head_cid = self._ht.get_head_cid(self.head_name)
         if head_cid:
@@ -161,16 +977,147 @@ class Chain(object):
     carries a timestamp and a parent CID (block hash) and Entry-specific
     extra data.
     """
-    def __init__(self, blockservice, headtracker, chain_name):
+    def __init__(self, blockservice, headtracker, chain_name, views=None,
+                 index=None, index_keyfunc=None):
         self._chainstore = ChainStates(blockservice, headtracker, chain_name)
+        self._views = views
+        self._index = index
+        self._index_keyfunc = index_keyfunc
         self.name = chain_name
 
     def __len__(self):
-        return len(list(self.iter_entries()))
+        head = self._chainstore.get_head_block()
+        return head.height if head else 0
 
     def append_entry(self, entry):
-        args = attr.astuple(entry)
-        self._chainstore.new_head_block(entry.TAG, args)
+        """ append entry and return the new head block.  Non-empty values
+        of the fields listed in the BLOB_FIELDS attribute of the entry class
+        are stored as blobs which the block references by content address. """
+        block = self._chainstore.new_head_block(entry.TAG, self._entry_args(entry))
+        self.update_index()
+        return block
+
+    def reset(self, entries):
+        """ start the chain anew with the given entries and return the
+        new head block.  Blocks of the previous chain are left in the
+        block service but are no longer reachable from the head. """
+        with self.transaction():
+            for i, entry in enumerate(entries):
+                block = self._chainstore.new_head_block(
+                    entry.TAG, self._entry_args(entry), root=(i == 0))
+        self.update_index()
+        return block
+
+    def _entry_args(self, entry):
+        args = list(attr.astuple(entry))
+        for i in self._blob_indexes(type(entry)):
+            if args[i]:
+                args[i] = self._chainstore._bs.store_blob(args[i])
+        return args
+
+    def _blob_indexes(self, entryclass):
+        names = [a.name for a in attr.fields(entryclass)]
+        return [names.index(name) for name in getattr(entryclass, "BLOB_FIELDS", ())]
+
+    def _make_entry(self, entryclass, args):
+        args = list(args)
+        for i in self._blob_indexes(entryclass):
+            # blocks written before blobs were introduced contain the bytes
+            if isinstance(args[i], six.text_type):
+                args[i] = self._chainstore._bs.get_blob(args[i])
+        return entryclass(*args)
+
+    @contextmanager
+    def transaction(self):
+        """ return a context manager within which reading and appending
+        entries happens atomically.  Blocks and head moves are committed
+        together at the end of the outermost transaction. """
+        with self._chainstore.transaction():
+            yield
+
+    def run_transaction(self, func, *args, **kwargs):
+        """ call func within a transaction and call it again if another
+        writer moved the head before the transaction could commit. """
+        return run_transaction(self.transaction, func, *args, **kwargs)
+
+    def get_head_cid(self):
+        return self._chainstore._ht.get_head_cid(self.name)
+
+    def get_view(self):
+        """ return the view dict which was stored for the current head
+        or None if no view was stored or it belongs to another head. """
+        if self._views is not None:
+            view = self._views.get(self.name)
+            if view is not None and view["head"] == self.get_head_cid():
+                return view
+
+    def set_view(self, view):
+        """ store a view dict which must contain the cid of the head block
+        it was computed for under the "head" key. """
+        if self._views is not None:
+            self._views.update([(self.name, view)])
+
+    def _index_keys(self, block):
+        # every block is indexed by its type so that the latest
+        # entry of a type is found without walking the chain and
+        # additionally under each key which index_keyfunc returns for it
+        yield "type:" + block.type
+        if self._index_keyfunc is not None:
+            for key in self._index_keyfunc(block):
+                yield key
+
+    def update_index(self):
+        """ add blocks appended since the last update to the index.
+        Later blocks replace earlier ones with the same key. """
+        if self._index is None:
+            return
+        head = self.get_head_cid()
+        indexed = self._index.get(self.name)
+        if head == indexed:
+            return
+        items = []
+        seen = set()
+        for block in self.iter_blocks():
+            if block.cid == indexed:
+                break
+            for key in self._index_keys(block):
+                if key not in seen:
+                    seen.add(key)
+                    items.append((self.name + "\n" + key, block.cid))
+        else:
+            # the chain was removed and started anew after the last update
+            # (chains are append-only otherwise) so remove stale keys
+            if indexed is not None:
+                seen = set(self.name + "\n" + key for key in seen)
+                items.extend((key, None) for key, cid in self._index.items()
+                             if key.startswith(self.name + "\n") and key not in seen)
+        items.append((self.name, head))
+        self._index.update(items)
+
+    def lookup(self, key):
+        """ return the cid of the latest block for which the index keyfunc
+        returns key or None. """
+        if self._index is None:
+            for block in self.iter_blocks():
+                if key in self._index_keys(block):
+                    return block.cid
+            return None
+        self.update_index()
+        return self._index.get(self.name + "\n" + key)
+
+    def iter_blocks(self):
+        """ yield blocks from head to root. """
+        return self._chainstore.iter_blocks()
+
+    def get_block(self, cid):
+        """ return the block with the given cid. """
+        return self._chainstore._bs.get_block(cid)
+
+    def get_entry(self, cid, entryclass):
+        """ return entry for the block with the given cid. """
+        block = self.get_block(cid)
+        assert block.type == entryclass.TAG, (block.type, entryclass)
+        return self._make_entry(entryclass, block.args)
 
     def iter_entries(self, entryclass=None):
         assert entryclass is None or hasattr(entryclass, "TAG")
@@ -178,13 +1125,14 @@ class Chain(object):
         for block in self._chainstore.iter_blocks():
             if block and (tag is None or block.type == tag):
                 if entryclass:
-                    yield entryclass(*block.args)
+                    yield self._make_entry(entryclass, block.args)
                 else:
                     yield block.args
 
     def latest_entry_of(self, entryclass):
-        for entry in self.iter_entries(entryclass):
-            return entry
+        cid = self.lookup("type:" + entryclass.TAG)
+        if cid is not None:
+            return self.get_entry(cid, entryclass)
 
 
 def shortrepr(obj):
@@ -20,21 +20,47 @@ from .cmdline_utils import (
 )
 from .account import AccountManager, AccountNotFound, effective_date, parse_date_to_float
 from .bingpg import find_executable
+from .states import (
+    STORAGE_BACKENDS, HEAD_TRACKERS, BLOCK_LAYOUTS, TUNABLE_STORAGE, parse_storage_option,
+)
 from . import mime, hookspec
 from .bot import bot_reply
 
 
+def _parse_storage_options(ctx, param, values):
+    try:
+        return [parse_storage_option(value) for value in values]
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
 @click.command(cls=MyGroup, context_settings=dict(help_option_names=["-h", "--help"]))
 @click.option("--basedir", type=click.Path(),
               default=click.get_app_dir("muacrypt"),
               envvar="MUACRYPT_BASEDIR",
               help="directory where muacrypt state is stored")
+@click.option("--storage", type=click.Choice(STORAGE_BACKENDS), default=None,
+              envvar="MUACRYPT_STORAGE",
+              help="storage backend for a new state directory: one file per block "
+                   "('files', the default), packfiles ('pack') or a "
+                   "sqlite database ('sqlite') which supports concurrent access.")
+@click.option("--storage-option", "storage_options", multiple=True, metavar="NAME=VALUE",
+              envvar="MUACRYPT_STORAGE_OPTIONS", callback=_parse_storage_options,
+              help="set a tunable storage option of the state directory ({}). "
+                   "May be given several times.".format(", ".join(TUNABLE_STORAGE)))
 @click.version_option()
 @click.pass_context
-def muacrypt_main(context, basedir):
+def muacrypt_main(context, basedir, storage, storage_options):
     """access and manage Autocrypt keys, options, headers."""
     basedir = os.path.abspath(os.path.expanduser(basedir))
-    context.account_manager = AccountManager(basedir, _pluginmanager)
+    storage_options = dict(storage_options)
+    if storage is not None:
+        storage_options["backend"] = storage
+    try:
+        context.account_manager = AccountManager(basedir, _pluginmanager,
+                                                 storage=storage_options)
+    except ValueError as e:
+        raise click.ClickException(str(e))
     context.plugin_manager = _pluginmanager
 
 
@@ -104,6 +130,36 @@ option_reparse = click.option(
     help="force reparsing message even if it is already known")
 
 
+@mycommand("migrate-storage")
+@click.argument("backend", type=click.Choice(STORAGE_BACKENDS), required=False)
+@click.option("--heads", default=None, type=click.Choice(HEAD_TRACKERS),
+              help="convert head tracking to this mode.")
+@click.option("--layout", default=None, type=click.Choice(BLOCK_LAYOUTS),
+              help="convert the block directory of the files backend to this layout.")
+@click.pass_context
+def migrate_storage(ctx, backend, heads, layout):
+    """convert the storage of all accounts to a storage backend.
+
+    The "files" backend stores each block in its own file while the
+    "pack" backend appends blocks to a few large packfiles with an
+    offset index, which avoids huge block directories.  The "sqlite"
+    backend stores blocks and heads in a sqlite database and is best
+    suited for concurrent access from several processes.
+    With "--heads=journal" head updates are appended to a journal
+    instead of rewriting the whole heads file for each update.
+    With "--layout=fanout" the blocks of the "files" backend are moved
+    into subdirectories named after the first two characters of their
+    hash which keeps directories small.
+    Make sure no other muacrypt process runs while migrating; only
+    layout conversions may run while muacrypt is in use.
+    """
+    account_manager = get_account_manager(ctx)
+    num = account_manager.migrate_storage(backend=backend, heads=heads, layout=layout)
+    storage = account_manager.storage
+    click.echo("migrated {} blocks to {!r} storage, heads: {!r}, layout: {!r}".format(
+               num, storage["backend"], storage["heads"], storage["layout"]))
+
+
 @mycommand("add-account")
 @account_option
 @option_use_key
@@ -471,6 +527,92 @@ def export_secret_key(ctx, account_name):
     click.echo(data)
 
 
+@mycommand("gc")
+@click.option("--dry-run", default=False, is_flag=True,
+              help="only count unreachable blocks, don't remove them.")
+@click.option("--archive", default=False, is_flag=True,
+              help="copy removed blocks to the gc-archive directory.")
+@click.pass_context
+def gc(ctx, dry_run, archive):
+    """remove blocks which are no longer referenced.
+
+    Blocks of deleted accounts and of compacted peer history which
+    was not archived are kept on disk until they are removed by this
+    command.  It is safe to run while other muacrypt processes read
+    the state directory but no other process may write to it.
+    """
+    account_manager = get_account_manager(ctx)
+
+    def progress(phase, num):
+        click.echo("{}: {} blocks".format(phase, num))
+
+    stats = account_manager.collect_garbage(dry_run=dry_run, archive=archive,
+                                            progress=progress)
+    click.echo("{reachable} reachable, {garbage} unreachable, "
+               "{removed} removed".format(**stats))
+
+
+@mycommand()
+@click.option("--repair", default=False, is_flag=True,
+              help="truncate broken chains to their last valid block.")
+@click.option("--processes", type=int, default=None,
+              help="number of processes for hashing blocks (default: number of CPUs).")
+@click.pass_context
+def fsck(ctx, repair, processes):
+    """check the integrity of the state directory.
+
+    Verifies that each stored block matches its content address and
+    that every chain only references existing, intact blocks with valid
+    entries.  Exits with an error if problems were found and not
+    repaired, e.g. because another process kept appending to a broken
+    chain.
+    """
+    account_manager = get_account_manager(ctx)
+
+    def progress(phase, num):
+        click.echo("{}: {}".format(phase, num))
+
+    result = account_manager.fsck(repair=repair, processes=processes,
+                                  progress=progress)
+    for problem in result["problems"]:
+        click.echo("{}: {} {}".format(problem.head or "<storage>", problem.cid,
+                                      problem.message))
+    for name, cid in result["repaired"]:
+        if cid is None:
+            click.echo("{}: removed head".format(name))
+        else:
+            click.echo("{}: truncated to {}".format(name, cid))
+    for name in result["skipped"]:
+        click.echo("{}: skipped, it was moved by another process".format(name))
+    click.echo("{} blocks, {} chains checked, {} problems".format(
+               result["blocks"], result["chains"], len(result["problems"])))
+    if result["problems"] and not repair or result["skipped"]:
+        ctx.exit(1)
+
+
+@mycommand()
+@account_option_none
+@click.option("--archive", default=False, is_flag=True,
+              help="keep the compacted history referenced from the snapshot.")
+@click.pass_context
+def compact(ctx, account_name, archive):
+    """compact the peer chains of all or the specified account.
+
+    Each peer chain is replaced by a snapshot block followed by the
+    latest message, Autocrypt and gossip entries which determine the
+    peer state.  Older entries are no longer walked and, unless
+    archived, become garbage.  Their Message-IDs are kept in the
+    snapshot so that their mails are still recognized when seen again.
+    """
+    if account_name is None:
+        names = get_account_manager(ctx).list_account_names()
+    else:
+        names = [account_name]
+    for name in names:
+        num = get_account(ctx, name).compact(archive=archive)
+        click.echo("account {!r}: removed {} blocks from peer chains".format(name, num))
+
+
 @mycommand()
 @account_option_none
 @verbose_option
@@ -525,12 +667,17 @@ def _status_account(account, verbose=False):
     for uid in uids:
         kecho("^^ uid", uid)
 
+    stats = account.get_msgid_filter().get_stats()
+    kecho("msgid-filter", "{count} ids, {size} bytes, fp-rate {fp_rate}".format(**stats))
+    kecho("^^ lookups", "{negatives} negative, {positives} positive "
+                        "({false_positives} false)".format(**stats))
+
     if verbose:
         # print info on peers
-        peernames = account.get_peername_list()
+        peernames = account.get_peername_list(limit=1)
         if peernames:
             click.echo("  ----peers-----")
-            for name in peernames:
+            for name in account.iter_peernames():
                 pi = account.get_peerstate(name)
                 # when = time.ctime(pi.last_seen) if pi.last_seen else "never"
                 if pi.last_seen == pi.autocrypt_timestamp:
@@ -565,6 +712,10 @@ muacrypt_main.add_command(export_public_key)
 muacrypt_main.add_command(export_secret_key)
 muacrypt_main.add_command(bot_reply)
 muacrypt_main.add_command(destroy_all)
+muacrypt_main.add_command(migrate_storage)
+muacrypt_main.add_command(compact)
+muacrypt_main.add_command(gc)
+muacrypt_main.add_command(fsck)
 
 
 # we need a plugin manager early to add sub commands
@@ -32,6 +32,17 @@ def attrib_bytes_or_none():
                   default=None, converter=str2bytes)
 
 
+def attrib_text_list():
+    return attrib(validator=_text_list, default=attr.Factory(list), converter=list)
+
+
+def _text_list(instance, attribute, value):
+    for item in value:
+        if not isinstance(item, six.text_type):
+            raise TypeError("{!r} must be a list of text, got {!r}".format(
+                attribute.name, item))
+
+
 def str2bytes(x):
     if x is not None and not isinstance(x, bytes):
         return x.encode("ascii")
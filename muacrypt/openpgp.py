@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+
+""" in-process parsing of OpenPGP key packets (RFC 4880) for reading
+fingerprints, creation dates, algorithms and user IDs of keys
+without invoking gpg.  Only version 4 keys are supported.
+"""
+
+from __future__ import unicode_literals
+
+import base64
+import binascii
+import hashlib
+import struct
+from .mime import parse_email_addr
+
+PUBLIC_KEY_TAG = 6
+SECRET_KEY_TAG = 5
+PUBLIC_SUBKEY_TAG = 14
+SECRET_SUBKEY_TAG = 7
+USERID_TAG = 13
+SIGNATURE_TAG = 2
+
+# signature types
+CERTIFICATIONS = (0x10, 0x11, 0x12, 0x13)
+SUBKEY_BINDING = 0x18
+DIRECT_KEY = 0x1f
+KEY_REVOCATION = 0x20
+SUBKEY_REVOCATION = 0x28
+CERTIFICATION_REVOCATION = 0x30
+
+# signature subpacket types
+SIG_CREATION_TIME = 2
+ISSUER = 16
+KEY_FLAGS = 27
+ISSUER_FINGERPRINT = 33
+
+# key flags for encryption of communications and storage
+ENCRYPTION_FLAGS = 0x04 | 0x08
+# algorithms which can encrypt: RSA, RSA encrypt-only, Elgamal and ECDH
+_ENCRYPTION_ALGOS = (1, 2, 16, 18, 20)
+
+# number of MPIs making up the public key material of non-ECC algorithms:
+# RSA (1, 2, 3), Elgamal (16, 20) and DSA (17)
+_MPI_COUNTS = {1: 2, 2: 2, 3: 2, 16: 3, 17: 4, 20: 3}
+ECDH, ECDSA, EDDSA = 18, 19, 22
+
+# key lengths which gpg reports for elliptic curves, by hex-encoded OID
+_CURVE_BITS = {
+    "2b06010401da470f01": 255,  # Ed25519
+    "2b060104019755010501": 255,  # Curve25519
+    "2b6571": 448,  # Ed448
+    "2b656f": 448,  # X448
+    "2a8648ce3d030107": 256,  # NIST P-256
+    "2b81040022": 384,  # NIST P-384
+    "2b81040023": 521,  # NIST P-521
+    "2b2403030208010107": 256,  # brainpoolP256r1
+    "2b240303020801010b": 384,  # brainpoolP384r1
+    "2b240303020801010d": 512,  # brainpoolP512r1
+    "2b8104000a": 256,  # secp256k1
+}
+
+
+class ParseError(ValueError):
+    """ raised for keydata which can not be parsed. """
+
+
+class KeyInfo:
+    def __init__(self, type, bits, id, uid, date_created, fingerprint=None):
+        self.type = type
+        self.bits = int(bits)
+        self.id = id
+        self.uids = [uid] if uid else []
+        self.date_created = date_created
+        self.fingerprint = fingerprint
+
+    def match(self, other_id):
+        i = min(len(other_id), len(self.id))
+        return self.id[-i:].lower() == other_id[-i:].lower()
+
+    def __str__(self):
+        return "KeyInfo(id={id!r}, uids={uids!r}, bits={bits}, type={type})".format(
+            **self.__dict__)
+
+    __repr__ = __str__
+
+
+def dearmor(data):
+    """ return the binary packets of ASCII-armored data.  Binary data
+    is returned unchanged. """
+    if not data.lstrip().startswith(b"-----BEGIN PGP"):
+        return data
+    lines = [line.strip() for line in data.strip().splitlines()]
+    try:
+        body = lines[lines.index(b"") + 1:-1]
+    except ValueError:
+        raise ParseError("no empty line after armor headers")
+    # skip the "=" prefixed CRC24 checksum line
+    try:
+        return base64.b64decode(b"".join(line for line in body if not line.startswith(b"=")))
+    except (TypeError, binascii.Error) as e:
+        raise ParseError("invalid armored data: {}".format(e))
+
+
+def iter_packets(data):
+    """ yield (tag, body) tuples for the packets in binary data. """
+    data = bytearray(data)
+    pos = 0
+    while pos < len(data):
+        ctb = data[pos]
+        if not ctb & 0x80:
+            raise ParseError("invalid packet header at offset {}".format(pos))
+        pos += 1
+        if ctb & 0x40:
+            tag = ctb & 0x3f
+            chunks = []
+            partial = True
+            while partial:
+                length, partial, pos = _read_new_length(data, pos)
+                chunks.append(_take(data, pos, length))
+                pos += length
+            body = b"".join(chunks)
+        else:
+            tag = (ctb >> 2) & 0x0f
+            if ctb & 3 == 3:
+                # indeterminate length extends to the end of the data
+                length = len(data) - pos
+            else:
+                size = (1, 2, 4)[ctb & 3]
+                length = _read_int(data, pos, size)
+                pos += size
+            body = _take(data, pos, length)
+            pos += length
+        yield tag, body
+
+
+def parse_keyinfos(keydata):
+    """ return KeyInfo objects for the keys and subkeys in binary or
+    ASCII-armored keydata.  User IDs are attached to the preceding
+    primary key.  Secret key packets are parsed for their public part. """
+    keyinfos = []
+    primary = None
+    for tag, body in iter_packets(dearmor(keydata)):
+        if tag in (PUBLIC_KEY_TAG, SECRET_KEY_TAG, PUBLIC_SUBKEY_TAG, SECRET_SUBKEY_TAG):
+            keyinfos.append(parse_key(body))
+            if tag in (PUBLIC_KEY_TAG, SECRET_KEY_TAG):
+                primary = keyinfos[-1]
+        elif tag == USERID_TAG:
+            if primary is None:
+                raise ParseError("user ID packet before primary key packet")
+            primary.uids.append(body.decode("utf8", "replace"))
+    if not keyinfos:
+        raise ParseError("no key packets found")
+    return keyinfos
+
+
+def parse_key(body):
+    """ return a KeyInfo for the body of a version 4 public or secret
+    (sub)key packet. """
+    body = bytearray(body)
+    version = _take(body, 0, 1)[0:1]
+    if version != b"\x04":
+        raise ParseError("unsupported key version {!r}".format(version))
+    date_created = _read_int(body, 1, 4)
+    algo = _read_int(body, 5, 1)
+    pos = 6
+    if algo in _MPI_COUNTS:
+        bits = _read_int(body, pos, 2)
+        for i in range(_MPI_COUNTS[algo]):
+            pos = _skip_mpi(body, pos)
+    elif algo in (ECDH, ECDSA, EDDSA):
+        oid_length = _read_int(body, pos, 1)
+        oid = _take(body, pos + 1, oid_length)
+        bits = _CURVE_BITS.get(binascii.hexlify(oid).decode("ascii"), 0)
+        pos = _skip_mpi(body, pos + 1 + oid_length)
+        if algo == ECDH:
+            # KDF parameters
+            pos += 1 + len(_take(body, pos + 1, _read_int(body, pos, 1)))
+    else:
+        raise ParseError("unsupported public key algorithm {}".format(algo))
+    public = bytes(body[:pos])
+    fingerprint = hashlib.sha1(b"\x99" + struct.pack(">H", len(public)) + public)
+    fingerprint = fingerprint.hexdigest().upper()
+    return KeyInfo(type="{}".format(algo), bits=bits, id=fingerprint[-16:], uid=None,
+                   date_created="{}".format(date_created), fingerprint=fingerprint)
+
+
+class Signature:
+    def __init__(self, type, created, issuer, key_flags):
+        self.type = type
+        self.created = created
+        self.issuer = issuer
+        self.key_flags = key_flags
+
+
+def parse_signature(body):
+    """ return a Signature with the type, creation time, issuer key id or
+    fingerprint and key flags (or None) of a signature packet body. """
+    body = bytearray(body)
+    version = _read_int(body, 0, 1)
+    if version == 3:
+        return Signature(type=_read_int(body, 2, 1), created=_read_int(body, 3, 4),
+                         issuer=binascii.hexlify(_take(body, 7, 8)).decode("ascii").upper(),
+                         key_flags=None)
+    if version != 4:
+        raise ParseError("unsupported signature version {}".format(version))
+    sig = Signature(type=_read_int(body, 1, 1), created=0, issuer=None, key_flags=None)
+    pos = 4
+    # hashed and unhashed subpacket areas
+    for i in range(2):
+        end = pos + 2 + len(_take(body, pos + 2, _read_int(body, pos, 2)))
+        pos += 2
+        while pos < end:
+            length, pos = _read_subpacket_length(body, pos)
+            if length < 1 or pos + length > end:
+                raise ParseError("invalid signature subpacket length")
+            subtype = body[pos] & 0x7f
+            data = bytes(body[pos + 1:pos + length])
+            if subtype == SIG_CREATION_TIME:
+                sig.created = _read_int(data, 0, 4)
+            elif subtype in (ISSUER, ISSUER_FINGERPRINT) and sig.issuer is None:
+                # the fingerprint is prefixed with the key version
+                data = data if subtype == ISSUER else data[1:]
+                sig.issuer = binascii.hexlify(data).decode("ascii").upper()
+            elif subtype == KEY_FLAGS and data:
+                sig.key_flags = bytearray(data)[0]
+            pos += length
+    return sig
+
+
+def minimize_keydata(keydata, addrs=None):
+    """ return binary keydata with only the primary public key, its
+    self-signed user IDs and the newest encryption subkey, each with
+    its newest self-signature.  If addrs is given, only user IDs with
+    one of these e-mail addresses are kept unless none of them matches.
+    Signatures are not verified here, gpg checks them on import. """
+    packets = iter_packets(dearmor(keydata))
+    tag, primary = next(packets, (None, None))
+    if tag != PUBLIC_KEY_TAG:
+        raise ParseError("keydata does not start with a public key packet")
+    keyinfo = parse_key(primary)
+    components = [(tag, primary, [])]
+    for tag, body in packets:
+        if tag == PUBLIC_KEY_TAG:
+            break
+        if tag == SIGNATURE_TAG:
+            components[-1][2].append((parse_signature(body), body))
+        else:
+            components.append((tag, body, []))
+
+    def self_sigs(sigs, types):
+        return [(sig, body) for sig, body in sigs
+                if sig.type in types and
+                (sig.issuer is None or keyinfo.fingerprint.endswith(sig.issuer))]
+
+    def newest(sigs):
+        return max(sigs, key=lambda x: x[0].created)
+
+    out = [(PUBLIC_KEY_TAG, primary)]
+    out.extend((SIGNATURE_TAG, body) for sig, body in
+               self_sigs(components[0][2], (KEY_REVOCATION, DIRECT_KEY)))
+    uids = []
+    subkeys = []
+    for tag, body, sigs in components[1:]:
+        if tag == USERID_TAG:
+            certs = self_sigs(sigs, CERTIFICATIONS + (CERTIFICATION_REVOCATION,))
+            if certs and newest(certs)[0].type != CERTIFICATION_REVOCATION:
+                uids.append((body, newest(certs)[1]))
+        elif tag == PUBLIC_SUBKEY_TAG:
+            bindings = self_sigs(sigs, (SUBKEY_BINDING,))
+            if not bindings or self_sigs(sigs, (SUBKEY_REVOCATION,)):
+                continue
+            binding = newest(bindings)
+            subkey = parse_key(body)
+            if binding[0].key_flags is None:
+                can_encrypt = int(subkey.type) in _ENCRYPTION_ALGOS
+            else:
+                can_encrypt = binding[0].key_flags & ENCRYPTION_FLAGS
+            if can_encrypt:
+                subkeys.append((int(subkey.date_created), body, binding[1]))
+    if addrs:
+        matching = [uid for uid in uids
+                    if parse_email_addr(uid[0].decode("utf8", "replace")) in addrs]
+        uids = matching or uids
+    if not uids:
+        raise ParseError("no self-signed user ID found")
+    if not subkeys:
+        raise ParseError("no encryption subkey found")
+    for body, sig in uids:
+        out.extend([(USERID_TAG, body), (SIGNATURE_TAG, sig)])
+    created, body, sig = max(subkeys, key=lambda x: x[0])
+    out.extend([(PUBLIC_SUBKEY_TAG, body), (SIGNATURE_TAG, sig)])
+    return b"".join(encode_packet(tag, body) for tag, body in out)
+
+
+def encode_packet(tag, body):
+    """ return a new format packet with the given tag and body. """
+    length = len(body)
+    if length < 192:
+        header = struct.pack(">BB", 0xc0 | tag, length)
+    elif length < 8384:
+        length -= 192
+        header = struct.pack(">BBB", 0xc0 | tag, (length >> 8) + 192, length & 0xff)
+    else:
+        header = struct.pack(">BBI", 0xc0 | tag, 255, length)
+    return header + body
+
+
+def _read_subpacket_length(data, pos):
+    first = _read_int(data, pos, 1)
+    if first < 192:
+        return first, pos + 1
+    if first < 255:
+        return ((first - 192) << 8) + _read_int(data, pos + 1, 1) + 192, pos + 2
+    return _read_int(data, pos + 1, 4), pos + 5
+
+
+def _take(data, pos, length):
+    if pos + length > len(data):
+        raise ParseError("truncated packet data")
+    return bytes(data[pos:pos + length])
+
+
+def _read_int(data, pos, size):
+    value = 0
+    for c in bytearray(_take(data, pos, size)):
+        value = (value << 8) | c
+    return value
+
+
+def _read_new_length(data, pos):
+    """ return (length, partial, pos) for a new format length at pos. """
+    first = _read_int(data, pos, 1)
+    if first < 192:
+        return first, False, pos + 1
+    if first < 224:
+        return ((first - 192) << 8) + _read_int(data, pos + 1, 1) + 192, False, pos + 2
+    if first == 255:
+        return _read_int(data, pos + 1, 4), False, pos + 5
+    return 1 << (first & 0x1f), True, pos + 1
+
+
+def _skip_mpi(data, pos):
+    bits = _read_int(data, pos, 2)
+    return pos + 2 + len(_take(data, pos + 2, (bits + 7) // 8))
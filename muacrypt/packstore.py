@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+"""
+Packfile storage for immutable blocks.
+
+Instead of writing one file per block the PackBlockService appends
+blocks to segment files named ``NNNNNN.pack``.  Each record in a segment
+consists of the raw 32-byte cid, a 4-byte length and the serialized block.
+An on-disk offset index maps each cid to the (segment, offset, length)
+location of its record:
+
+- the segment which is currently appended to has an append-only
+  journal index ``NNNNNN.jidx`` which is read into memory;
+
+- once a segment exceeds its maximum size it is sealed by writing
+  a sorted ``NNNNNN.idx`` file which is binary-searched through mmap
+  on lookup and never read as a whole.
+
+Records are self-describing so that a torn append (e.g. a crash
+between writing the record and its index entry) is repaired
+on the next append.  Removing blocks copies the remaining records of
+each sealed segment which contains them to a new segment and removes
+the old one; readers verify the record header of each block they read
+and reload the list of segments if one was removed in the meantime.
+
+As blocks are appended after their parents, a read with read-ahead
+also reads the bytes before the requested record and keeps them so
+that walking a chain towards its root takes one read per window.
+"""
+from __future__ import unicode_literals, print_function
+
+import os
+import mmap
+import struct
+from binascii import hexlify, unhexlify
+from .chainstore import BlockService, fsync_path, locked
+
+
+SEGMENT_MAX_SIZE = 32 * 1024 * 1024
+
+# raw cid, length of serialized block
+_record_header = struct.Struct(">32sI")
+# raw cid, offset of serialized block in segment, length of serialized block
+_index_entry = struct.Struct(">32sQI")
+# per first cid byte: number of entries with a first byte less or equal
+_fanout = struct.Struct(">256I")
+
+
+class PackBlockService(BlockService):
+    """ Blockservice which appends blocks to packfile segments and
+    locates them through an on-disk offset index. """
+    def __init__(self, basedir, cache=None, segment_max_size=SEGMENT_MAX_SIZE,
+                 fsync="none", encoding="execnet", readahead=64, compress_min_size=0):
+        self._basedir = basedir
+        self._cache = cache
+        self.fsync = fsync
+        self.encoding = encoding
+        self.readahead = readahead
+        self.compress_min_size = compress_min_size
+        # segments with unflushed appends
+        self._unsynced = set()
+        self._segment_max_size = segment_max_size
+        # segno -> SealedIndex
+        self._sealed = {}
+        # raw cid -> (segno, offset, length) for not yet sealed segments
+        self._journal = {}
+        # segno -> number of bytes consumed from the journal index
+        self._journal_pos = {}
+        # segno -> end of the last indexed record
+        self._journal_end = {}
+        # segno -> open file for reading blocks
+        self._readers = {}
+        # (segno, offset, data) of the last read with read-ahead
+        self._buffer = None
+        if not os.path.exists(basedir):
+            os.makedirs(basedir)
+        self._refresh()
+
+    def _path(self, segno, ext):
+        return os.path.join(self._basedir, "{:06d}.{}".format(segno, ext))
+
+    def _list_segments(self):
+        segnos = []
+        for name in os.listdir(self._basedir):
+            base, ext = os.path.splitext(name)
+            if ext == ".pack" and base.isdigit():
+                segnos.append(int(base))
+        return sorted(segnos)
+
+    def _refresh(self):
+        """ pick up segments and index entries written by other
+        instances or processes. """
+        for segno in self._list_segments():
+            if segno in self._sealed:
+                continue
+            if os.path.exists(self._path(segno, "idx")):
+                self._sealed[segno] = SealedIndex(self._path(segno, "idx"))
+                self._forget_journal(segno)
+            else:
+                self._read_journal(segno)
+
+    def _read_journal(self, segno):
+        path = self._path(segno, "jidx")
+        pos = self._journal_pos.get(segno, 0)
+        if not os.path.exists(path) or os.path.getsize(path) <= pos:
+            return
+        with open(path, "rb") as f:
+            f.seek(pos)
+            data = f.read()
+        # a concurrent writer might not have finished its entry yet
+        num = len(data) // _index_entry.size
+        for i in range(num):
+            raw, offset, length = _index_entry.unpack_from(data, i * _index_entry.size)
+            self._journal[raw] = (segno, offset, length)
+            self._journal_end[segno] = max(self._journal_end.get(segno, 0),
+                                           offset + length)
+        self._journal_pos[segno] = pos + num * _index_entry.size
+
+    def _forget_journal(self, segno):
+        for raw, loc in list(self._journal.items()):
+            if loc[0] == segno:
+                del self._journal[raw]
+        self._journal_pos.pop(segno, None)
+        self._journal_end.pop(segno, None)
+
+    def _lookup(self, raw, exclude=None):
+        loc = self._journal.get(raw)
+        if loc is not None:
+            return loc
+        for segno in sorted(self._sealed, reverse=True):
+            if segno == exclude:
+                continue
+            loc = self._sealed[segno].find(raw)
+            if loc is not None:
+                return (segno,) + loc
+
+    def _lock(self):
+        return locked(os.path.join(self._basedir, "lock"))
+
+    def _store_serialized(self, cid, serialized):
+        raw = unhexlify(cid)
+        with self._lock():
+            self._refresh()
+            if self._lookup(raw) is not None:
+                return
+            segno, size = self._recover_active()
+            if size >= self._segment_max_size:
+                self._seal(segno)
+                segno += 1
+                size = 0
+            with open(self._path(segno, "pack"), "ab") as f:
+                f.write(_record_header.pack(raw, len(serialized)) + serialized)
+            offset = size + _record_header.size
+            self._append_index_entry(segno, raw, offset, len(serialized))
+        self._written(segno)
+
+    def _sync_keys(self, segnos):
+        for segno in segnos:
+            for ext in ("pack", "jidx"):
+                path = self._path(segno, ext)
+                # the journal index is gone if the segment was sealed
+                if os.path.exists(path):
+                    fsync_path(path)
+        fsync_path(self._basedir)
+
+    def _recover_active(self):
+        """ recover the segment which is appended to and return
+        its number and size.  Must be called with the lock held. """
+        segments = self._list_segments()
+        segno = segments[-1] if segments else 1
+        if os.path.exists(self._path(segno, "idx")):
+            # the last segment was sealed, appends go to a new one
+            return segno + 1, 0
+        pack_path = self._path(segno, "pack")
+        size = os.path.getsize(pack_path) if os.path.exists(pack_path) else 0
+        if size > self._journal_end.get(segno, 0):
+            size = self._recover(segno, size)
+        return segno, size
+
+    def _append_index_entry(self, segno, raw, offset, length):
+        with open(self._path(segno, "jidx"), "ab") as f:
+            f.write(_index_entry.pack(raw, offset, length))
+        self._journal[raw] = (segno, offset, length)
+        self._journal_pos[segno] = self._journal_pos.get(segno, 0) + _index_entry.size
+        self._journal_end[segno] = offset + length
+
+    def _recover(self, segno, size):
+        """ index records which were appended to the segment without
+        an index entry and cut off a trailing incomplete record.
+        Return the resulting segment size. """
+        pos = self._journal_end.get(segno, 0)
+        with open(self._path(segno, "pack"), "rb+") as f:
+            f.seek(pos)
+            while pos + _record_header.size <= size:
+                raw, length = _record_header.unpack(f.read(_record_header.size))
+                offset = pos + _record_header.size
+                if offset + length > size:
+                    break
+                f.seek(length, 1)
+                if self._lookup(raw) is None:
+                    self._append_index_entry(segno, raw, offset, length)
+                pos = offset + length
+            if pos < size:
+                f.truncate(pos)
+        return pos
+
+    def _seal(self, segno):
+        entries = sorted((raw, loc[1], loc[2]) for raw, loc in self._journal.items()
+                         if loc[0] == segno)
+        path = self._path(segno, "idx")
+        write_sealed_index(path, entries, fsync=self.fsync != "none")
+        self._sealed[segno] = SealedIndex(path)
+        self._forget_journal(segno)
+        os.remove(self._path(segno, "jidx"))
+
+    def _get_serialized(self, cid, readahead=1):
+        raw = unhexlify(cid)
+        loc = self._lookup(raw)
+        if loc is None:
+            self._refresh()
+            loc = self._lookup(raw)
+        if loc is None:
+            # the record might have been written without an index entry
+            with self._lock():
+                self._recover_active()
+            loc = self._lookup(raw)
+            if loc is None:
+                return None
+        serialized = self._read_record(raw, *loc, readahead=readahead)
+        if serialized is None:
+            # the segment was removed by remove_blocks()
+            self._reload_segment(loc[0])
+            loc = self._lookup(raw)
+            if loc is not None:
+                serialized = self._read_record(raw, *loc)
+        return serialized
+
+    def _read_record(self, raw, segno, offset, length, readahead=1):
+        """ return the serialized block of the record at offset
+        or None if the segment does not contain it there.  With readahead
+        greater than one the bytes of about as many records of the same
+        size before it are read as well and kept for subsequent calls. """
+        start = offset - _record_header.size
+        end = offset + length
+        buf = self._buffer
+        if buf is not None and buf[0] == segno and buf[1] <= start and \
+                end <= buf[1] + len(buf[2]):
+            data = buf[2][start - buf[1]:end - buf[1]]
+        else:
+            f = self._readers.get(segno)
+            if f is None:
+                try:
+                    f = self._readers[segno] = open(self._path(segno, "pack"), "rb")
+                except (IOError, OSError):
+                    return None
+            read_start = max(0, start - (readahead - 1) * (end - start))
+            f.seek(read_start)
+            data = f.read(end - read_start)
+            if readahead > 1:
+                self._buffer = (segno, read_start, data)
+            data = data[start - read_start:]
+        if data[:_record_header.size] == _record_header.pack(raw, length):
+            return data[_record_header.size:]
+
+    def close(self):
+        self._buffer = None
+        for f in self._readers.values():
+            f.close()
+        self._readers.clear()
+        for index in self._sealed.values():
+            index.close()
+        self._sealed.clear()
+        self._journal.clear()
+        self._journal_pos.clear()
+        self._journal_end.clear()
+
+    def _reload_segment(self, segno):
+        self._buffer = None
+        f = self._readers.pop(segno, None)
+        if f is not None:
+            f.close()
+        self._sealed.pop(segno, None)
+        self._forget_journal(segno)
+        self._refresh()
+
+    def remove_blocks(self, cids):
+        """ remove the blocks by rewriting the segments which contain
+        them and return the number of removed blocks. """
+        raws = set(unhexlify(cid) for cid in cids)
+        count = 0
+        with self._lock():
+            self._refresh()
+            self._remove_orphaned_indexes()
+            segno, size = self._recover_active()
+            if any(self._journal.get(raw, (None,))[0] == segno for raw in raws):
+                # only sealed segments are rewritten
+                self._seal(segno)
+            rewrites = []
+            for segno in sorted(self._sealed):
+                garbage = [raw for raw in self._sealed[segno].iter_raw_cids()
+                           if raw in raws]
+                if garbage:
+                    rewrites.append((segno, set(garbage)))
+                    count += len(garbage)
+            if rewrites:
+                active, size = self._recover_active()
+                # rewritten segments get numbers after the active
+                # one which must not be appended to afterwards
+                if size:
+                    self._seal(active)
+                elif os.path.exists(self._path(active, "pack")):
+                    self._remove_empty_segment(active)
+                for segno, garbage in rewrites:
+                    self._rewrite_segment(segno, garbage)
+        if self._cache is not None:
+            for cid in cids:
+                self._cache.discard(cid)
+        return count
+
+    def _remove_empty_segment(self, segno):
+        self._forget_journal(segno)
+        os.remove(self._path(segno, "pack"))
+        if os.path.exists(self._path(segno, "jidx")):
+            os.remove(self._path(segno, "jidx"))
+
+    def _remove_orphaned_indexes(self):
+        """ remove sealed indexes left without their segment by an
+        interrupted rewrite.  Must be called with the lock held. """
+        for name in os.listdir(self._basedir):
+            base, ext = os.path.splitext(name)
+            if ext == ".idx" and base.isdigit() and \
+                    not os.path.exists(self._path(int(base), "pack")):
+                os.remove(os.path.join(self._basedir, name))
+
+    def _rewrite_segment(self, segno, garbage):
+        """ copy the records of the sealed segment which are not garbage
+        to a new segment and remove the old one.  The new segment and its
+        index are complete before the segment becomes visible so that
+        readers (and a crash) see either segment with a matching index.
+        Must be called with the lock held. """
+        entries = []
+        new_segno = self._list_segments()[-1] + 1
+        new_path = self._path(new_segno, "pack")
+        tmp_path = new_path + ".tmp"
+        with open(self._path(segno, "pack"), "rb") as f, open(tmp_path, "wb") as out:
+            for raw, offset, length in self._sealed[segno].iter_entries():
+                # records might have been copied by an interrupted rewrite
+                if raw in garbage or self._lookup(raw, exclude=segno) is not None:
+                    continue
+                f.seek(offset)
+                out.write(_record_header.pack(raw, length) + f.read(length))
+                entries.append((raw, out.tell() - length, length))
+            if self.fsync != "none":
+                out.flush()
+                os.fsync(out.fileno())
+        if entries:
+            # the index is written first as segments are
+            # listed by their pack file
+            write_sealed_index(self._path(new_segno, "idx"), entries,
+                               fsync=self.fsync != "none")
+            os.rename(tmp_path, new_path)
+            if self.fsync != "none":
+                fsync_path(self._basedir)
+            self._sealed[new_segno] = SealedIndex(self._path(new_segno, "idx"))
+        else:
+            os.remove(tmp_path)
+        self._buffer = None
+        f = self._readers.pop(segno, None)
+        if f is not None:
+            f.close()
+        self._sealed.pop(segno).close()
+        # readers which find the pack gone reload the segment list
+        os.remove(self._path(segno, "pack"))
+        os.remove(self._path(segno, "idx"))
+        if self.fsync != "none":
+            fsync_path(self._basedir)
+
+    def iter_cids(self):
+        self._refresh()
+        for raw in list(self._journal):
+            yield hexlify(raw).decode("ascii")
+        for segno in sorted(self._sealed):
+            for raw in self._sealed[segno].iter_raw_cids():
+                yield hexlify(raw).decode("ascii")
+
+
+def write_sealed_index(path, entries, fsync=False):
+    """ atomically write a sorted list of (raw_cid, offset, length)
+    entries to a sealed index file. """
+    counts = [0] * 256
+    for raw, offset, length in entries:
+        counts[ord(raw[0:1])] += 1
+    fanout = []
+    total = 0
+    for count in counts:
+        total += count
+        fanout.append(total)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_fanout.pack(*fanout))
+        for entry in entries:
+            f.write(_index_entry.pack(*entry))
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+class SealedIndex:
+    """ read-only sorted offset index of a sealed segment. """
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._fanout = _fanout.unpack_from(self._map, 0)
+
+    def __len__(self):
+        return self._fanout[-1]
+
+    def close(self):
+        self._map.close()
+
+    def _raw_cid_at(self, i):
+        start = _fanout.size + i * _index_entry.size
+        return self._map[start:start + 32]
+
+    def find(self, raw):
+        """ return (offset, length) for the raw cid or None. """
+        first = ord(raw[0:1])
+        lo = self._fanout[first - 1] if first else 0
+        hi = self._fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._raw_cid_at(mid) < raw:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._fanout[first] and self._raw_cid_at(lo) == raw:
+            _, offset, length = _index_entry.unpack_from(
+                self._map, _fanout.size + lo * _index_entry.size)
+            return offset, length
+
+    def iter_raw_cids(self):
+        for i in range(len(self)):
+            yield self._raw_cid_at(i)
+
+    def iter_entries(self):
+        """ yield (raw_cid, offset, length) entries in cid order. """
+        for i in range(len(self)):
+            yield _index_entry.unpack_from(self._map, _fanout.size + i * _index_entry.size)
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+"""
+SQLite storage for blocks and heads.
+
+Blocks and heads of a state directory are stored in a single
+SQLite database which is opened in WAL mode so that several
+processes can safely read and write the same state directory
+concurrently.  Head names are the primary key of the heads table
+which makes prefix queries (e.g. for listing peers) index lookups.
+"""
+from __future__ import unicode_literals, print_function
+
+import sqlite3
+from contextlib import contextmanager
+import six
+from execnet.gateway_base import loads, dumps
+from .chainstore import BlockService, HeadTracker, HeadConflict, Block, _anycid
+
+
+class SQLiteStore:
+    """ shared SQLite connection for a SQLiteBlockService and
+    SQLiteHeadTracker pair.  With an fsync policy other than "none"
+    each committed transaction is flushed to stable storage. """
+    def __init__(self, path, timeout=60.0, fsync="none"):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous={}".format(
+            "NORMAL" if fsync == "none" else "FULL"))
+        self._depth = 0
+        with self.transaction():
+            self._conn.execute("CREATE TABLE IF NOT EXISTS blocks "
+                               "(cid TEXT PRIMARY KEY, data BLOB NOT NULL)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS heads "
+                               "(name TEXT PRIMARY KEY, cid TEXT NOT NULL)")
+
+    def execute(self, sql, args=()):
+        return self._conn.execute(sql, args)
+
+    def executemany(self, sql, seq):
+        return self._conn.executemany(sql, seq)
+
+    @contextmanager
+    def transaction(self):
+        """ run all statements of the with-block in one transaction
+        which takes the database write lock right away.  Nested
+        transactions become part of the outermost one. """
+        if self._depth:
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+            return
+        self._conn.execute("BEGIN IMMEDIATE")
+        self._depth = 1
+        try:
+            yield
+        except BaseException:
+            self._depth = 0
+            self._conn.execute("ROLLBACK")
+            raise
+        self._depth = 0
+        self._conn.execute("COMMIT")
+
+    def close(self):
+        self._conn.close()
+
+
+class SQLiteBlockService(BlockService):
+    """ Blockservice which stores blocks in a SQLite table.  Reads with
+    read-ahead fetch the rows inserted before the requested block in the
+    same query as blocks are mostly inserted after their parents. """
+    def __init__(self, store, cache=None, encoding="execnet", readahead=64,
+                 compress_min_size=0):
+        self._store = store
+        self._cache = cache
+        self.encoding = encoding
+        self.readahead = readahead
+        self.compress_min_size = compress_min_size
+        # cid -> serialized block of the last read with read-ahead
+        self._buffer = {}
+
+    def _store_serialized(self, cid, serialized):
+        self._store.execute("INSERT OR IGNORE INTO blocks (cid, data) VALUES (?, ?)",
+                            (cid, sqlite3.Binary(serialized)))
+
+    def _get_serialized(self, cid, readahead=1):
+        serialized = self._buffer.pop(cid, None)
+        if serialized is not None:
+            return serialized
+        if readahead > 1:
+            rows = self._store.execute(
+                "SELECT cid, data FROM blocks WHERE rowid <= "
+                "(SELECT rowid FROM blocks WHERE cid=?) ORDER BY rowid DESC LIMIT ?",
+                (cid, readahead)).fetchall()
+            self._buffer = dict((row[0], bytes(row[1])) for row in rows)
+            return self._buffer.pop(cid, None)
+        row = self._store.execute("SELECT data FROM blocks WHERE cid=?",
+                                  (cid,)).fetchone()
+        if row is not None:
+            return bytes(row[0])
+
+    def iter_cids(self):
+        for row in self._store.execute("SELECT cid FROM blocks").fetchall():
+            yield row[0]
+
+    def remove_blocks(self, cids):
+        count = 0
+        self._buffer = {}
+        with self._store.transaction():
+            for cid in cids:
+                if self._cache is not None:
+                    self._cache.discard(cid)
+                cursor = self._store.execute("DELETE FROM blocks WHERE cid=?", (cid,))
+                count += cursor.rowcount
+        return count
+
+    def transaction(self):
+        return self._store.transaction()
+
+
+class SQLiteHeadTracker(HeadTracker):
+    """ HeadTracker which stores heads in a SQLite table.  Compare-and-swap
+    upserts are checked right away because transactions hold the database
+    write lock from their start. """
+    def __init__(self, store):
+        self._store = store
+
+    def get_head_cid(self, account):
+        row = self._store.execute("SELECT cid FROM heads WHERE name=?",
+                                  (account,)).fetchone()
+        if row is not None:
+            return row[0]
+
+    def _select_prefix(self, columns, prefix):
+        if not prefix:
+            return self._store.execute(
+                "SELECT {} FROM heads ORDER BY name".format(columns))
+        return self._store.execute(
+            "SELECT {} FROM heads WHERE name >= ? AND name < ? ORDER BY name".format(columns),
+            (prefix, prefix_upper_bound(prefix)))
+
+    def _getheads(self, prefix=""):
+        return dict((name[len(prefix):], cid)
+                    for name, cid in self._select_prefix("name, cid", prefix))
+
+    def _names_page(self, prefix, last, limit):
+        if last is None:
+            last = prefix
+            op = ">="
+        else:
+            op = ">"
+        if prefix:
+            rows = self._store.execute(
+                "SELECT name FROM heads WHERE name {} ? AND name < ? "
+                "ORDER BY name LIMIT ?".format(op),
+                (last, prefix_upper_bound(prefix), limit))
+        else:
+            rows = self._store.execute(
+                "SELECT name FROM heads WHERE name {} ? ORDER BY name LIMIT ?".format(op),
+                (last, limit))
+        return [row[0] for row in rows]
+
+    def remove_if(self, cal):
+        with self._store.transaction():
+            names = [(name,) for name, cid in self._select_prefix("name, cid", "")
+                     if cal(name, cid)]
+            self._store.executemany("DELETE FROM heads WHERE name=?", names)
+
+    def upsert(self, account, cid, expected_cid=_anycid):
+        with self._store.transaction():
+            if expected_cid is not _anycid:
+                current = self.get_head_cid(account)
+                if current != expected_cid:
+                    raise HeadConflict("head {!r} was moved from {} to {}".format(
+                        account, expected_cid, current))
+            self.upsert_many([(account, cid)])
+
+    def upsert_many(self, items):
+        """ set heads from a list of (name, cid) pairs where
+        a cid of None removes the head. """
+        items = [(name, cid.cid if isinstance(cid, Block) else cid) for name, cid in items]
+        with self._store.transaction():
+            self._store.executemany(
+                "DELETE FROM heads WHERE name=?",
+                [(name,) for name, cid in items if cid is None])
+            self._store.executemany(
+                "INSERT OR REPLACE INTO heads (name, cid) VALUES (?, ?)",
+                [(name, cid) for name, cid in items if cid is not None])
+
+    def transaction(self):
+        return self._store.transaction()
+
+
+class SQLiteMap:
+    """ persistent mapping stored in a SQLite table which offers
+    the same methods as the chainstore.JournalMap. """
+    def __init__(self, store, table):
+        self._store = store
+        self._table = table
+        self._store.execute("CREATE TABLE IF NOT EXISTS {} "
+                            "(key TEXT PRIMARY KEY, value BLOB NOT NULL)".format(table))
+
+    def get(self, key, default=None):
+        row = self._store.execute("SELECT value FROM {} WHERE key=?".format(self._table),
+                                  (key,)).fetchone()
+        if row is None:
+            return default
+        return loads(bytes(row[0]))
+
+    def items(self):
+        rows = self._store.execute("SELECT key, value FROM {}".format(self._table))
+        return [(key, loads(bytes(value))) for key, value in rows.fetchall()]
+
+    def update(self, items):
+        """ set or (for None values) delete keys according to
+        the (key, value) pairs in items. """
+        with self._store.transaction():
+            for key, value in items:
+                if value is None:
+                    self._store.execute(
+                        "DELETE FROM {} WHERE key=?".format(self._table), (key,))
+                else:
+                    self._store.execute(
+                        "INSERT OR REPLACE INTO {} (key, value) VALUES (?, ?)".format(
+                            self._table), (key, sqlite3.Binary(dumps(value))))
+
+    def compact(self):
+        pass
+
+
+def prefix_upper_bound(prefix):
+    """ return the smallest string which is larger than all
+    strings starting with prefix. """
+    return prefix[:-1] + six.unichr(ord(prefix[-1]) + 1)
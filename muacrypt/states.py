@@ -10,11 +10,28 @@ crytographic hashes.
 from __future__ import unicode_literals, print_function
 
 import os
+import json
+import zlib
+import shutil
+import uuid
+import hashlib
 import logging
-from .chainstore import HeadTracker, BlockService, Chain
+import collections
+import multiprocessing
+from contextlib import contextmanager
+import six
+from .chainstore import (
+    HeadTracker, JournalHeadTracker, JournalMap, ShardedMap, BlockService, BlockCache, Chain,
+    copy_blocks, run_transaction, HeadConflict, FSYNC_POLICIES, BLOCK_LAYOUTS,
+)
+from .packstore import PackBlockService
+from .bloom import BloomFilter
+from . import blockcodec
+from .blockcodec import ENCODINGS
+from .sqlitestore import SQLiteStore, SQLiteBlockService, SQLiteHeadTracker, SQLiteMap
 from .myattr import (
     v, attr, attrs, attrib, attrib_text, attrib_bytes,
-    attrib_bytes_or_none, attrib_text_or_none, attrib_float,
+    attrib_bytes_or_none, attrib_text_or_none, attrib_text_list, attrib_float,
 )
 
 # ==================================================
@@ -22,6 +39,49 @@ from .myattr import (
 # =================================================
 
 
+STORAGE_BACKENDS = ("files", "pack", "sqlite")
+HEAD_TRACKERS = ("file", "journal")
+
+# storage options of directories which do not specify them
+LEGACY_STORAGE = dict(backend="files", heads="file", msgid_fp_rate=0.001,
+                      fsync="none", encoding="execnet", layout="flat", readahead=64,
+                      compress_min_size=0)
+# storage options of newly created directories
+DEFAULT_STORAGE = dict(backend="files", heads="file", msgid_fp_rate=0.001,
+                       fsync="commit", encoding="compact", layout="fanout",
+                       readahead=64, compress_min_size=0)
+# storage options which existing data doesn't depend on and
+# can thus be changed for existing directories without migration
+TUNABLE_STORAGE = ("msgid_fp_rate", "fsync", "encoding", "readahead",
+                   "compress_min_size")
+
+# initial number of Message-IDs a per-account Bloom filter is sized for
+MSGID_FILTER_CAPACITY = 1024
+
+
+def parse_storage_option(text):
+    """ return the (name, value) pair of a "name=value" string which
+    sets one of the TUNABLE_STORAGE options.  ValueError is raised for
+    other options and invalid values. """
+    name, sep, value = text.partition("=")
+    if not sep or name not in TUNABLE_STORAGE:
+        raise ValueError("expected NAME=VALUE with NAME one of {}, got {!r}".format(
+                         ", ".join(TUNABLE_STORAGE), text))
+    try:
+        value = type(DEFAULT_STORAGE[name])(value)
+    except ValueError:
+        raise ValueError("invalid value for {}: {!r}".format(name, value))
+    choices = dict(fsync=FSYNC_POLICIES, encoding=ENCODINGS).get(name)
+    if choices is not None and value not in choices:
+        raise ValueError("{} must be one of {}, got {!r}".format(
+                         name, ", ".join(choices), value))
+    if name == "msgid_fp_rate" and not 0 < value < 1:
+        raise ValueError("msgid_fp_rate must be between 0 and 1, got {!r}".format(value))
+    if name == "readahead" and value < 1 or name == "compress_min_size" and value < 0:
+        raise ValueError("invalid value for {}: {!r}".format(name, value))
+    return name, value
+
+
 class States:
     """ Persisting Muacrypt and per-account settings."""
     _account_pat = "."
@@ -29,34 +89,265 @@ class States:
     _oob_pat = "oob:{id}"
     _peer_pat = "peer:{id}:{addr}"
 
-    def __init__(self, dirpath):
+    def __init__(self, dirpath, storage=None, block_cache=None):
+        """ Open or create states in dirpath.
+
+        :param storage: dict of storage options for a new directory or
+            the name of a storage backend ("files", "pack" or "sqlite").
+            The "heads" option selects how heads are tracked ("file" or
+            "journal") with the "files" and "pack" backends while the
+            "sqlite" backend stores blocks and heads in one database.
+            Existing directories keep the options they were created or
+            last migrated with.  The "msgid_fp_rate" option sets the
+            false-positive rate of the per-account Message-ID filters
+            and can be changed for existing directories.  The "fsync"
+            option ("none", "commit" or "always") sets when written
+            blocks and heads are flushed to stable storage and can be
+            changed as well.  So can the "encoding" of new blocks
+            ("execnet" or "compact") as blocks in either encoding are
+            read transparently.  The "layout" option of the "files"
+            backend stores all blocks in one directory ("flat") or in
+            subdirectories per content address prefix ("fanout").  The
+            tunable "readahead" option sets how many blocks the "pack"
+            and "sqlite" backends read at once when walking a chain.
+            With a "compress_min_size" other than 0 new blocks and blobs
+            of at least that many bytes are stored zlib compressed.
+        :param block_cache: BlockCache instance for keeping decoded blocks
+            in memory.  By default a new cache with default limits is used.
+        """
         self.dirpath = dirpath
-        blockdir = os.path.join(dirpath, "blocks")
+        if not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        self.block_cache = block_cache if block_cache is not None else BlockCache()
+        self._sqlite = None
+        self.storage = self._init_storage_config(storage)
+        self._heads = self._make_headtracker(self.storage)
+        self._blocks = self._make_blockservice(self.storage)
+        self._views = self._make_sharded_map(self.storage, "views")
+        self._index = self._make_sharded_map(self.storage, "chainindex")
+        self._keyhandles = self._make_sharded_map(self.storage, "keyhandles")
+
+    @property
+    def _storage_config_path(self):
+        return os.path.join(self.dirpath, "storage.json")
+
+    def _init_storage_config(self, storage):
+        if isinstance(storage, six.string_types):
+            storage = dict(backend=storage)
+        storage = storage or {}
+        if os.path.exists(self._storage_config_path):
+            with open(self._storage_config_path) as f:
+                config = dict(LEGACY_STORAGE, **json.load(f))
+        elif os.path.exists(os.path.join(self.dirpath, "blocks")):
+            # directory created before storage options were configurable
+            config = dict(LEGACY_STORAGE)
+        else:
+            config = dict(DEFAULT_STORAGE, **storage)
+            self._write_storage_config(config)
+        for name, value in storage.items():
+            if name in TUNABLE_STORAGE and config[name] != value:
+                config[name] = value
+                self._write_storage_config(config)
+            elif config[name] != value:
+                raise ValueError("states directory {!r} uses {}={!r}, "
+                                 "migrate it to use {!r}".format(
+                                     self.dirpath, name, config[name], value))
+        return config
+
+    def _write_storage_config(self, config):
+        tmp_path = self._storage_config_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(config, f)
+        os.rename(tmp_path, self._storage_config_path)
+
+    def _get_sqlite_store(self):
+        if self._sqlite is None:
+            self._sqlite = SQLiteStore(os.path.join(self.dirpath, "states.sqlite"),
+                                       fsync=self.storage["fsync"])
+        return self._sqlite
+
+    def _make_headtracker(self, config):
+        if config["backend"] == "sqlite":
+            return SQLiteHeadTracker(self._get_sqlite_store())
+        assert config["heads"] in HEAD_TRACKERS, config["heads"]
+        assert config["fsync"] in FSYNC_POLICIES, config["fsync"]
+        path = os.path.join(self.dirpath, "heads")
+        if config["heads"] == "journal":
+            return JournalHeadTracker(path, fsync=config["fsync"])
+        return HeadTracker(path, fsync=config["fsync"])
+
+    def _make_map(self, config, name):
+        """ return persistent mapping for derived data like views
+        which can always be recomputed from chains. """
+        if config["backend"] == "sqlite":
+            return SQLiteMap(self._get_sqlite_store(), name)
+        return JournalMap(os.path.join(self.dirpath, name))
+
+    def _make_sharded_map(self, config, name):
+        """ return persistent mapping for derived data like the views and
+        the index of chain entries.  Outside of sqlite it is sharded by
+        the part of the keys before the first newline (the chain name)
+        so that a lookup only loads the items which share its shard. """
+        if config["backend"] == "sqlite":
+            return self._make_map(config, name)
+        # the unsharded mapping of earlier versions is recomputed on demand
+        for filename in (name, name + ".journal", name + ".lock"):
+            path = os.path.join(self.dirpath, filename)
+            if os.path.exists(path):
+                os.remove(path)
+        return ShardedMap(os.path.join(self.dirpath, name + ".d"))
+
+    def _make_blockservice(self, config):
+        backend = config["backend"]
+        assert backend in STORAGE_BACKENDS, backend
+        assert config["encoding"] in ENCODINGS, config["encoding"]
+        if backend == "sqlite":
+            return SQLiteBlockService(self._get_sqlite_store(), cache=self.block_cache,
+                                      encoding=config["encoding"],
+                                      readahead=config["readahead"],
+                                      compress_min_size=config["compress_min_size"])
+        blockdir = os.path.join(self.dirpath, "blocks" if backend == "files" else backend)
+        options = dict(cache=self.block_cache, fsync=config["fsync"],
+                       encoding=config["encoding"], readahead=config["readahead"],
+                       compress_min_size=config["compress_min_size"])
+        if backend == "pack":
+            return PackBlockService(blockdir, **options)
+        assert config["layout"] in BLOCK_LAYOUTS, config["layout"]
         if not os.path.exists(blockdir):
             os.makedirs(blockdir)
-        self._heads = HeadTracker(os.path.join(dirpath, "heads"))
-        self._blocks = BlockService(blockdir)
-
-    def _makechain(self, headname):
-        return Chain(self._blocks, self._heads, headname)
+        return BlockService(blockdir, fanout=config["layout"] == "fanout", **options)
+
+    def close(self):
+        """ release open files and database connections.  The instance
+        must not be used afterwards. """
+        self._blocks.close()
+        if self._sqlite is not None:
+            self._sqlite.close()
+            self._sqlite = None
+
+    def _remove_storage(self, config, blocks=True, heads=True):
+        backend = config["backend"]
+        if backend == "sqlite":
+            self._sqlite.close()
+            self._sqlite = None
+            for ext in ("", "-wal", "-shm"):
+                path = os.path.join(self.dirpath, "states.sqlite" + ext)
+                if os.path.exists(path):
+                    os.remove(path)
+            return
+        if blocks:
+            shutil.rmtree(os.path.join(self.dirpath, "blocks" if backend == "files" else backend))
+        if heads:
+            for name in ("heads", "heads.journal"):
+                path = os.path.join(self.dirpath, name)
+                if os.path.exists(path):
+                    os.remove(path)
+            for name in ("views.d", "chainindex.d"):
+                shutil.rmtree(os.path.join(self.dirpath, name), ignore_errors=True)
+
+    def migrate_storage(self, backend=None, heads=None, layout=None):
+        """ convert blocks and heads to the specified storage backend,
+        head tracking mode and block layout and return the number of
+        converted blocks.  The previous storage is removed after conversion.
+
+        Converting the block layout of the "files" backend is safe while
+        other processes use the directory and can be resumed by running
+        the same conversion again. """
+        old = self.storage
+        new = dict(old)
+        if backend is not None:
+            new["backend"] = backend
+        if heads is not None:
+            new["heads"] = heads
+        if layout is not None:
+            new["layout"] = layout
+        convert_layout = new["backend"] == "files" and layout is not None
+        if new == old:
+            # finish a previously interrupted layout conversion
+            return self._blocks.convert_layout() if convert_layout else 0
+        count = 0
+        copy_heads = "sqlite" in (old["backend"], new["backend"])
+        if new["backend"] != old["backend"]:
+            blocks = self._make_blockservice(new)
+            count = copy_blocks(self._blocks, blocks)
+        elif new["layout"] != old["layout"]:
+            blocks = self._make_blockservice(new)
+        else:
+            blocks = self._blocks
+        drop_journal = (not copy_heads and old["heads"] == "journal" and
+                        new["heads"] != "journal")
+        if drop_journal:
+            # the snapshot has the format of the plain heads file
+            self._heads._map.compact()
+        new_heads = self._make_headtracker(new)
+        if copy_heads:
+            new_heads.upsert_many(self._heads._getheads().items())
+        self.storage = new
+        self._write_storage_config(new)
+        if new["backend"] != old["backend"]:
+            self._remove_storage(old, heads=copy_heads)
+        if drop_journal:
+            os.remove(self._heads._map._journal_path)
+        if convert_layout:
+            # blocks stay readable while they are moved and new
+            # blocks are already written in the new layout
+            count += blocks.convert_layout()
+        self._blocks = blocks
+        self._heads = new_heads
+        # views and indexes are not copied but recomputed on demand
+        self._views = self._make_sharded_map(new, "views")
+        self._index = self._make_sharded_map(new, "chainindex")
+        self._keyhandles = self._make_sharded_map(new, "keyhandles")
+        return count
+
+    @contextmanager
+    def transaction(self):
+        """ return a context manager which collects block writes and head
+        moves and commits them together at the end of the outermost
+        transaction.  Blocks are flushed according to the "fsync" storage
+        option before the heads are moved to them. """
+        with self._heads.transaction(), self._blocks.transaction():
+            yield
+
+    def run_transaction(self, func, *args, **kwargs):
+        """ call func within a transaction and call it again if another
+        process moved one of the heads before the transaction could
+        commit so that neither process loses its update. """
+        return run_transaction(self.transaction, func, *args, **kwargs)
+
+    def _makechain(self, headname, index_keyfunc=None):
+        views, index = self._views, self._index
+        if isinstance(index, ShardedMap):
+            views, index = views.shard(headname), index.shard(headname)
+        return Chain(self._blocks, self._heads, headname, views=views,
+                     index=index, index_keyfunc=index_keyfunc)
 
     def get_accountmanager_state(self):
         chain = self._makechain(self._account_pat)
         return AccountManagerState(chain)
 
     def get_account_names(self):
-        return sorted(self._heads._getheads(prefix=self._own_pat.format(id="")))
+        return self._heads.get_names(prefix=self._own_pat.format(id=""))
 
-    def get_num_peers(self, account):
-        return len(self.get_peername_list())
+    def get_num_peers(self, account_name):
+        return sum(1 for addr in self.iter_peernames(account_name))
 
-    def get_peername_list(self, account_name):
+    def get_peername_list(self, account_name, after=None, limit=None):
+        """ return sorted list of peer addresses of the account or with
+        after and limit a page of the addresses which sort after the
+        given one. """
         prefix = self._peer_pat.format(id=account_name, addr="")
-        return sorted(self._heads._getheads(prefix=prefix))
+        return self._heads.get_names(prefix=prefix, after=after, limit=limit)
+
+    def iter_peernames(self, account_name):
+        """ yield sorted peer addresses of the account without
+        loading all of them at once. """
+        prefix = self._peer_pat.format(id=account_name, addr="")
+        return self._heads.iter_names(prefix=prefix)
 
     def get_peerstate(self, account_name, addr):
         head_name = self._peer_pat.format(id=account_name, addr=addr)
-        chain = self._makechain(head_name)
+        chain = self._makechain(head_name, index_keyfunc=_msg_index_keyfunc)
         return PeerState(chain)
 
     def get_ownstate(self, account_name):
@@ -72,12 +363,331 @@ class States:
         chain = self._makechain(head_name)
         return OOBState(chain)
 
+    def _msgid_filter_path(self, account_name):
+        return os.path.join(self.dirpath, "msgfilter", account_name + ".bloom")
+
+    def get_msgid_filter(self, account_name):
+        """ return the Bloom filter of Message-IDs which were processed
+        for the account.  It is (re)built from the peer chains if it does
+        not exist, is full or uses another false-positive rate. """
+        bloom = BloomFilter(self._msgid_filter_path(account_name))
+        if bloom.exists():
+            stats = bloom.get_stats()
+            if (stats["count"] <= stats["capacity"] and
+                    stats["fp_rate"] == self.storage["msgid_fp_rate"]):
+                return bloom
+            bloom.close()
+        return self.rebuild_msgid_filter(account_name)
+
+    def rebuild_msgid_filter(self, account_name):
+        """ write a new Message-ID filter for the account and return it. """
+        msg_ids = []
+        for addr in self.iter_peernames(account_name):
+            chain = self.get_peerstate(account_name, addr)._chain
+            for block in chain.iter_blocks():
+                if block.type == MsgEntry.TAG:
+                    msg_ids.append(block.args[0])
+                elif block.type == SnapshotEntry.TAG:
+                    msg_ids.extend(block.args[2])
+        path = self._msgid_filter_path(account_name)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        return BloomFilter.create(path, max(MSGID_FILTER_CAPACITY, 2 * len(msg_ids)),
+                                  self.storage["msgid_fp_rate"], keys=msg_ids)
+
+    def get_imported_keyhandle(self, account_name, keydata, keyring):
+        """ return the keyhandle under which keydata was imported into
+        the account's keyring or None if it is unknown or the keyring
+        signature differs from the one recorded after our last import. """
+        state = self._keyhandles.get("keyring:" + account_name)
+        if state is None or state[0] != keyring:
+            return None
+        entry = self._keyhandles.get(_keyhandle_key(account_name, keydata))
+        if entry is not None and entry[1] == state[1]:
+            return entry[0]
+
+    def set_imported_keyhandle(self, account_name, keydata, keyhandle, before, after):
+        """ remember the keyhandle of keydata whose import changed the
+        keyring signature from ``before`` to ``after``.  If the keyring
+        was changed by others since our last import all keyhandles which
+        were remembered for the account are invalidated. """
+        state = self._keyhandles.get("keyring:" + account_name)
+        if state is None or state[0] != before:
+            generation = six.text_type(uuid.uuid4().hex)
+        else:
+            generation = state[1]
+        key = _keyhandle_key(account_name, keydata)
+        # entries of earlier generations can never match again.  They are
+        # dropped from the shard which is written anyway (or, with sqlite,
+        # from the whole table when a new generation starts) so that the
+        # cache doesn't grow with every change of the keyring.
+        if isinstance(self._keyhandles, ShardedMap):
+            candidates = self._keyhandles.shard(key).items()
+        elif state is None or generation != state[1]:
+            candidates = self._keyhandles.items()
+        else:
+            candidates = []
+        prefix = "keyring:{}:".format(account_name)
+        stale = [(name, None) for name, value in candidates
+                 if name.startswith(prefix) and value[1] != generation]
+        self._keyhandles.update(stale + [
+            ("keyring:" + account_name, [after, generation]),
+            (key, [keyhandle, generation]),
+        ])
+
     def remove_account(self, account_name):
         def match_account(key, value):
             l = key.split(":", 2)
             if l[0] in ("own", "peer") and l[1] == account_name:
                 return True
         self._heads.remove_if(match_account)
+        for derived in (self._views, self._index):
+            derived.update((key, None) for key, value in derived.items()
+                           if match_account(key, value))
+        self._keyhandles.update((key, None) for key, value in self._keyhandles.items()
+                                if key.split(":", 2)[1] == account_name)
+        path = self._msgid_filter_path(account_name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def collect_garbage(self, dry_run=False, archive=False, progress=None):
+        """ remove blocks and blobs which are not reachable from any head
+        and return a dict with the number of "reachable", unreachable
+        ("garbage") and "removed" content addresses.
+
+        Reachable blocks are never touched so that concurrent readers
+        are not affected.  Blocks stored after garbage collection
+        started are kept and heads moved while marking are marked
+        again before sweeping.  Blocks of a transaction which another
+        process has not committed yet are not referenced by a head
+        though and would be removed, so no other process may write to
+        the state directory while garbage is collected.
+
+        :param dry_run: only count unreachable blocks.
+        :param archive: copy unreachable blocks to the "gc-archive"
+            block directory before removing them.
+        :param progress: callable which is called with the phase
+            ("mark" or "sweep") and the number of processed blocks.
+        """
+        candidates = set(self._blocks.iter_cids())
+        marked = set()
+        heads = self._heads._getheads()
+        self._mark_reachable(heads.values(), marked, progress)
+        if dry_run:
+            garbage = candidates - marked
+            return dict(reachable=len(marked), garbage=len(garbage), removed=0)
+        # only the sweep runs in a transaction which holds the
+        # write lock of the sqlite backend
+        with self.transaction():
+            new_heads = self._heads._getheads()
+            if new_heads != heads:
+                self._mark_reachable(new_heads.values(), marked, progress)
+            garbage = sorted(candidates - marked)
+            removed = 0
+            if garbage:
+                if archive:
+                    archive_dir = os.path.join(self.dirpath, "gc-archive")
+                    if not os.path.exists(archive_dir):
+                        os.makedirs(archive_dir)
+                    target = BlockService(archive_dir, fanout=True)
+                    for cid in garbage:
+                        target._store_serialized(cid, self._blocks._get_serialized(cid))
+                for i in range(0, len(garbage), 1000):
+                    removed += self._blocks.remove_blocks(garbage[i:i + 1000])
+                    if progress is not None:
+                        progress("sweep", removed)
+        return dict(reachable=len(marked), garbage=len(garbage), removed=removed)
+
+    def _mark_reachable(self, cids, marked, progress=None):
+        """ add the cids of all blocks and blobs reachable from
+        the given block cids to the marked set. """
+        stack = list(cids)
+        num = 0
+        while stack:
+            cid = stack.pop()
+            if cid in marked:
+                continue
+            block = self._blocks.get_block(cid)
+            if block is None:
+                continue
+            marked.add(cid)
+            parents, blobs = _block_refs(block)
+            stack.extend(parents)
+            marked.update(blobs)
+            num += 1
+            if progress is not None and num % 1000 == 0:
+                progress("mark", num)
+
+    def fsck(self, repair=False, processes=None, progress=None):
+        """ check the integrity of stored blocks and chains.
+
+        The content of each stored block and blob is hashed (by a pool
+        of worker processes if there are many) and compared with its
+        content address.  Each chain is walked from its head checking
+        that all blocks and blobs it references exist and are intact
+        and that each block is a valid entry of its type.
+
+        :param repair: move the head of each broken chain to its newest
+            block below the last problem so that the chain ends with
+            valid blocks, or remove the head if no valid block is left.
+            Stored data which doesn't match its address is removed.
+        :param processes: number of hashing processes, by default the
+            number of CPUs.  With 1 everything is hashed in-process.
+        :param progress: callable which is called with the phase
+            ("hash" or "chains") and the number of processed items.
+        :returns: dict with the number of "blocks" and "chains" checked,
+            the list of FsckProblem "problems", the list of "repaired"
+            (head name, new head cid or None) pairs and the list of
+            "skipped" head names which other writers kept moving so
+            that they could not be repaired.
+        """
+        # blocks are checked as stored, not as they were cached
+        self.block_cache.clear()
+        cids = list(self._blocks.iter_cids())
+        corrupt = self._find_corrupt(cids, processes, progress)
+        problems = [FsckProblem(None, cid, "content does not match its address")
+                    for cid in sorted(corrupt)]
+        repaired = []
+        skipped = []
+        heads = sorted(self._heads._getheads().items())
+        for num, (name, head) in enumerate(heads):
+            chain_problems, valid = self._check_chain(name, head, corrupt)
+            problems.extend(chain_problems)
+            if repair and chain_problems:
+                try:
+                    valid = self.run_transaction(
+                        self._repair_chain, name, head, valid, corrupt)
+                except HeadConflict:
+                    skipped.append(name)
+                else:
+                    repaired.append((name, valid))
+            if progress is not None:
+                progress("chains", num + 1)
+        if repair and corrupt:
+            self._blocks.remove_blocks(sorted(corrupt))
+        return dict(blocks=len(cids), chains=len(heads), problems=problems,
+                    repaired=repaired, skipped=skipped)
+
+    def _repair_chain(self, name, head, valid, corrupt):
+        """ move the head of the chain which was checked at head to
+        valid (removing it for None) and return the new head cid.
+        If another writer moved the head since, the chain is checked
+        again from its current head. """
+        current = self._heads.get_head_cid(name)
+        if current != head:
+            problems, valid = self._check_chain(name, current, corrupt)
+            if not problems:
+                return current
+        self._heads.upsert(name, valid, expected_cid=current)
+        return valid
+
+    _fsck_chunk_size = 256
+
+    def _find_corrupt(self, cids, processes, progress):
+        """ return the set of cids whose stored data doesn't match. """
+        def chunks():
+            for i in range(0, len(cids), self._fsck_chunk_size):
+                items = []
+                for cid in cids[i:i + self._fsck_chunk_size]:
+                    data = self._blocks._get_serialized(cid)
+                    # blocks removed by a concurrent gc are skipped
+                    if data is not None:
+                        items.append((cid, data))
+                yield items
+
+        corrupt = set()
+        done = [0]
+
+        def collect(result):
+            corrupt.update(result)
+            done[0] += 1
+            if progress is not None:
+                progress("hash", min(done[0] * self._fsck_chunk_size, len(cids)))
+
+        if processes == 1 or len(cids) <= self._fsck_chunk_size:
+            for result in six.moves.map(_corrupt_cids, chunks()):
+                collect(result)
+            return corrupt
+        # chunks are read in this thread as storage connections (sqlite)
+        # may not be used from the pool's task feeder thread.  Only a
+        # few chunks are submitted ahead to bound memory usage.
+        processes = processes or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(processes)
+        pending = collections.deque()
+        try:
+            for items in chunks():
+                pending.append(pool.apply_async(_corrupt_cids, (items,)))
+                if len(pending) > 2 * processes:
+                    collect(pending.popleft().get())
+            while pending:
+                collect(pending.popleft().get())
+        finally:
+            pool.close()
+            pool.join()
+        return corrupt
+
+    def _check_chain(self, name, head, corrupt):
+        """ return the problems found in the chain and the cid of its
+        newest block below which no problems were found (or None). """
+        chain = self._makechain(name)
+        problems = []
+        valid = child = None
+        # the parent of a corrupted block might lead back up the chain
+        seen = set()
+        cid = head
+        while cid and cid not in seen:
+            seen.add(cid)
+            block, message = self._check_block(chain, cid, corrupt)
+            if message is not None:
+                problems.append(FsckProblem(name, cid, message))
+                valid = None
+                # the parent is taken from the skip list of the intact
+                # child if possible as the broken block can't be trusted
+                if child is not None and child._meta and len(child._meta["skip"]) > 1:
+                    cid = child._meta["skip"][1]
+                else:
+                    cid = block.parent_cid if block is not None else None
+                child = None
+                continue
+            if valid is None:
+                valid = cid
+            child = block
+            cid = block.parent_cid
+        return problems, valid
+
+    def _check_block(self, chain, cid, corrupt):
+        """ return the block (or None) and a problem message (or None). """
+        try:
+            block = self._blocks.get_block(cid)
+        except Exception as e:
+            return None, "undecodable block: {}".format(e)
+        if block is None:
+            return None, "missing block"
+        if cid in corrupt:
+            return block, "corrupted block"
+        entryclass = _entry_classes.get(block.type)
+        if entryclass is None:
+            return block, "unknown entry type {!r}".format(block.type)
+        num_fields = len(attr.fields(entryclass))
+        if len(block.args) != num_fields:
+            return block, "invalid {} entry: {} instead of {} fields".format(
+                block.type, len(block.args), num_fields)
+        for blob in _block_refs(block)[1]:
+            if blob in corrupt:
+                return block, "corrupted blob {}".format(blob)
+            if self._blocks.get_blob(blob) is None:
+                return block, "missing blob {}".format(blob)
+        try:
+            chain._make_entry(entryclass, block.args)
+        except (TypeError, ValueError) as e:
+            return block, "invalid {} entry: {}".format(block.type, e)
+        return block, None
+
+    def compact_peer_chains(self, account_name, archive=False):
+        """ compact the chain of each peer of the account (see
+        PeerState.compact) and return the number of removed blocks. """
+        return sum(self.get_peerstate(account_name, addr).compact(archive=archive)
+                   for addr in self.iter_peernames(account_name))
 
 # ===========================================================
 # PeerState for keeping track of incoming messages per peer
@@ -87,6 +697,7 @@ class States:
 @attr.s
 class MsgEntry(object):
     TAG = "msg"
+    BLOB_FIELDS = ("keydata",)
     msg_id = attrib_text()
     msg_date = attrib_float()
     prefer_encrypt = attrib(validator=v.in_(['nopreference', 'mutual']))
@@ -97,12 +708,28 @@ class MsgEntry(object):
 @attr.s
 class MsgGossipEntry(object):
     TAG = "mge"
+    BLOB_FIELDS = ("keydata",)
     msg_id = attrib_text()
     msg_date = attrib_float()
     keydata = attrib_bytes()
     keyhandle = attrib_text()
 
 
+@attr.s
+class SnapshotEntry(object):
+    TAG = "snap"
+    # fields which reference the head of another chain
+    CHAIN_FIELDS = ("archive_cid",)
+    # number of blocks of the compacted chain
+    num_blocks = attrib(validator=v.instance_of(six.integer_types))
+    # head of the compacted history if it was archived
+    archive_cid = attrib_text_or_none()
+    # Message-IDs of the compacted message and gossip entries
+    # so that they are still recognized when seen again
+    msg_ids = attrib_text_list()
+    gossip_msg_ids = attrib_text_list()
+
+
 @attrs
 class PeerState(object):
     """Synthesized Autocrypt state from parsing messages from a peer. """
@@ -117,67 +744,137 @@ class PeerState(object):
     def addr(self):
         return self._chain.name.split(":", 2)[-1]
 
+    # the view is a materialized summary of the latest entries of the
+    # chain so that the properties below don't need to walk the chain.
+    _empty_view = dict(
+        head=None,
+        msg_cid=None, msg_date=0.0,
+        ac_cid=None, ac_date=0.0, ac_keyhandle='', ac_prefer_encrypt='',
+        gossip_cid=None, gossip_keyhandle='',
+    )
+
+    def _view(self):
+        view = self._chain.get_view()
+        if view is None:
+            view = self.rebuild_view()
+        return view
+
+    def rebuild_view(self):
+        """ recompute the view from the chain, store and return it. """
+        view = dict(self._empty_view)
+        for block in self._chain.iter_blocks():
+            if view["head"] is None:
+                view["head"] = block.cid
+            self._update_view(view, block, overwrite=False)
+            if view["msg_cid"] and view["ac_cid"] and view["gossip_cid"]:
+                break
+        if view["head"] is not None:
+            self._chain.set_view(view)
+        return view
+
+    def verify_view(self):
+        """ return True if the stored view matches the chain. """
+        view = self._chain.get_view()
+        return view is None or view == self.rebuild_view()
+
+    def _update_view(self, view, block, overwrite=True):
+        if block.type == MsgEntry.TAG:
+            msg_id, msg_date, prefer_encrypt, keydata, keyhandle = block.args
+            if overwrite or view["msg_cid"] is None:
+                view.update(msg_cid=block.cid, msg_date=msg_date)
+            if keydata and (overwrite or view["ac_cid"] is None):
+                view.update(ac_cid=block.cid, ac_date=msg_date,
+                            ac_keyhandle=keyhandle, ac_prefer_encrypt=prefer_encrypt)
+        elif block.type == MsgGossipEntry.TAG:
+            msg_id, msg_date, keydata, keyhandle = block.args
+            if overwrite or view["gossip_cid"] is None:
+                view.update(gossip_cid=block.cid, gossip_keyhandle=keyhandle)
+
     @property
     def last_seen(self):
-        return getattr(self._latest_msg_entry(), "msg_date", 0.0)
+        return self._view()["msg_date"]
 
     @property
     def autocrypt_timestamp(self):
-        return getattr(self._latest_ac_entry(), "msg_date", 0.0)
+        return self._view()["ac_date"]
 
     @property
     def public_keyhandle(self):
-        return getattr(self.entry_for_encryption(), "keyhandle", '')
+        view = self._view()
+        return view["ac_keyhandle"] or view["gossip_keyhandle"]
 
     @property
     def public_keydata(self):
         return getattr(self.entry_for_encryption(), "keydata", b'')
 
     def has_direct_key(self):
-        return bool(getattr(self._latest_ac_entry(), "keyhandle", ''))
+        return bool(self._view()["ac_keyhandle"])
 
     def entry_for_encryption(self):
-        direct = self._latest_ac_entry()
+        view = self._view()
         # TODO: perform propper checks on usability of ac entry here
-        if getattr(direct, "keyhandle", None):
-            return direct
-        else:
-            return self.latest_gossip_entry()
+        if view["ac_keyhandle"]:
+            return self._chain.get_entry(view["ac_cid"], MsgEntry)
+        elif view["gossip_cid"]:
+            return self._chain.get_entry(view["gossip_cid"], MsgGossipEntry)
 
     @property
     def prefer_encrypt(self):
-        return getattr(self.entry_for_encryption(), "prefer_encrypt", '')
+        view = self._view()
+        # gossip entries carry no prefer_encrypt setting
+        return view["ac_prefer_encrypt"] if view["ac_keyhandle"] else ''
 
     def _latest_ac_entry(self):
         """ Return latest message with Autocrypt header. """
-        for entry in self._chain.iter_entries(MsgEntry):
-            if entry.keydata:
-                return entry
+        cid = self._view()["ac_cid"]
+        if cid:
+            return self._chain.get_entry(cid, MsgEntry)
 
     def latest_gossip_entry(self):
         """ Return latest gossip entry. """
-        return self._chain.latest_entry_of(MsgGossipEntry)
+        cid = self._view()["gossip_cid"]
+        if cid:
+            return self._chain.get_entry(cid, MsgGossipEntry)
 
     def _latest_msg_entry(self):
         """ Return latest message with or without Autocrypt header. """
-        return self._chain.latest_entry_of(MsgEntry)
+        cid = self._view()["msg_cid"]
+        if cid:
+            return self._chain.get_entry(cid, MsgEntry)
 
     def has_message(self, msg_id):
-        return self.get_message_entry(msg_id) is not None
+        return self._lookup_message(msg_id, MsgEntry) is not None
 
     def get_message_entry(self, msg_id, class_=MsgEntry):
-        # XXX make this less expensive
-        for entry in self._chain.iter_entries(class_):
-            if entry.msg_id == msg_id:
-                return entry
+        """ return the latest class_ entry of the message or None if there
+        is none or it was compacted into the snapshot. """
+        block = self._lookup_message(msg_id, class_)
+        if block is not None and block.type == class_.TAG:
+            return self._chain._make_entry(class_, block.args)
+
+    def _lookup_message(self, msg_id, class_):
+        """ return the block of the latest class_ entry of the message
+        or the snapshot block it was compacted into or None. """
+        cid = self._chain.lookup(_msg_index_key(class_.TAG, msg_id))
+        if cid is not None:
+            return self._chain.get_block(cid)
 
     # methods which modify/add state
     def update_from_msg(self, msg_id, effective_date, prefer_encrypt,
                         keydata, keyhandle):
+        self._chain.run_transaction(self._update_from_msg, msg_id, effective_date,
+                                    prefer_encrypt, keydata, keyhandle)
+
+    def _update_from_msg(self, msg_id, effective_date, prefer_encrypt,
+                         keydata, keyhandle):
         if effective_date < self.autocrypt_timestamp:
             return
-        entry = self.get_message_entry(msg_id)
-        if entry is not None:
+        block = self._lookup_message(msg_id, MsgEntry)
+        if block is not None:
+            if block.type == SnapshotEntry.TAG:
+                # processed before the chain was compacted
+                return
+            entry = self._chain._make_entry(MsgEntry, block.args)
             if (entry.msg_date == effective_date and
                     entry.keydata == keydata and
                     entry.keyhandle == keyhandle and
@@ -199,11 +896,19 @@ class PeerState(object):
         )
 
     def update_from_msg_gossip(self, msg_id, effective_date, keydata, keyhandle):
+        self._chain.run_transaction(self._update_from_msg_gossip, msg_id,
+                                    effective_date, keydata, keyhandle)
+
+    def _update_from_msg_gossip(self, msg_id, effective_date, keydata, keyhandle):
         if effective_date < self.autocrypt_timestamp:
             return
         assert keydata
-        entry = self.get_message_entry(msg_id, class_=MsgGossipEntry)
-        if entry is not None:
+        block = self._lookup_message(msg_id, MsgGossipEntry)
+        if block is not None:
+            if block.type == SnapshotEntry.TAG:
+                # processed before the chain was compacted
+                return
+            entry = self._chain._make_entry(MsgGossipEntry, block.args)
             if (entry.msg_date == effective_date and
                     entry.keydata == keydata and
                     entry.keyhandle == keyhandle):
@@ -213,25 +918,92 @@ class PeerState(object):
             keydata=keydata, keyhandle=keyhandle,
         )
 
+    def _append_entry(self, entry):
+        view = self._view()
+        block = self._chain.append_entry(entry)
+        # if another writer moved the head in between
+        # the view is rebuilt on next access
+        if block.parent_cid == view["head"]:
+            view = dict(view, head=block.cid)
+            self._update_view(view, block)
+            self._chain.set_view(view)
+
     def _append_ac_entry(self, msg_id, msg_date, prefer_encrypt, keydata, keyhandle):
         """append an Autocrypt message entry. """
-        self._chain.append_entry(MsgEntry(
+        self._append_entry(MsgEntry(
             msg_id=msg_id, msg_date=msg_date, prefer_encrypt=prefer_encrypt,
             keydata=keydata, keyhandle=keyhandle))
 
     def _append_ac_gossip_entry(self, msg_id, msg_date, keydata, keyhandle):
         """append an Autocrypt gossip entry. """
-        self._chain.append_entry(MsgGossipEntry(
+        self._append_entry(MsgGossipEntry(
             msg_id=msg_id, msg_date=msg_date,
             keydata=keydata, keyhandle=keyhandle))
 
     def _append_noac_entry(self, msg_id, msg_date):
         """append a non-Autocrypt message entry. """
-        self._chain.append_entry(MsgEntry(
+        self._append_entry(MsgEntry(
             msg_id=msg_id, msg_date=msg_date,
             prefer_encrypt="nopreference", keyhandle="", keydata=b""
         ))
 
+    def compact(self, archive=False):
+        """ replace the chain with a snapshot block followed by the latest
+        message, Autocrypt and gossip entries which determine this state
+        and return the number of removed blocks.  The snapshot lists the
+        Message-IDs of the removed entries so that processing their
+        messages again doesn't change the state.  With archive=True the
+        snapshot references the previous head so that the history is
+        kept instead of becoming garbage. """
+        return self._chain.run_transaction(self._compact, archive)
+
+    def _compact(self, archive):
+        view = self._view()
+        blocks = {}
+        for cid in (view["msg_cid"], view["ac_cid"], view["gossip_cid"]):
+            if cid is not None:
+                blocks[cid] = self._chain.get_block(cid)
+        num_blocks = len(self._chain)
+        if num_blocks <= len(blocks) + 1:
+            return 0
+        msg_ids, gossip_msg_ids = set(), set()
+        for block in self._chain.iter_blocks():
+            if block.cid in blocks:
+                continue
+            if block.type == MsgEntry.TAG:
+                msg_ids.add(block.args[0])
+            elif block.type == MsgGossipEntry.TAG:
+                gossip_msg_ids.add(block.args[0])
+            elif block.type == SnapshotEntry.TAG:
+                msg_ids.update(block.args[2])
+                gossip_msg_ids.update(block.args[3])
+        entryclasses = {MsgEntry.TAG: MsgEntry, MsgGossipEntry.TAG: MsgGossipEntry}
+        entries = [SnapshotEntry(
+            archive_cid=view["head"] if archive else None, num_blocks=num_blocks,
+            msg_ids=sorted(msg_ids), gossip_msg_ids=sorted(gossip_msg_ids))]
+        for block in sorted(blocks.values(), key=lambda block: block.height):
+            entries.append(self._chain.get_entry(block.cid, entryclasses[block.type]))
+        self._chain.reset(entries)
+        self.rebuild_view()
+        return num_blocks - len(entries)
+
+
+def _msg_index_key(tag, msg_id):
+    return "{}:{}".format(tag, msg_id)
+
+
+def _msg_index_keyfunc(block):
+    if block.type in (MsgEntry.TAG, MsgGossipEntry.TAG):
+        return [_msg_index_key(block.type, block.args[0])]
+    if block.type == SnapshotEntry.TAG:
+        return ([_msg_index_key(MsgEntry.TAG, msg_id) for msg_id in block.args[2]] +
+                [_msg_index_key(MsgGossipEntry.TAG, msg_id) for msg_id in block.args[3]])
+    return []
+
+
+def _keyhandle_key(account_name, keydata):
+    return "keyring:{}:{}".format(account_name, hashlib.sha256(keydata).hexdigest())
+
 
 # ===========================================================
 # OwnState keeps track of own crypto settings
@@ -316,6 +1088,25 @@ class OwnState(object):
     def is_configured(self):
         return self._latest_config() and self._latest_keygen()
 
+    # exports of the own key are cached in the view of the own chain
+    # so that a new keygen or config entry invalidates them.
+    def get_export(self, name):
+        """ return the value stored with set_export() for the current
+        head of the own chain or None. """
+        view = self._chain.get_view()
+        if view is not None:
+            return view["exports"].get(name)
+
+    def set_export(self, name, value):
+        """ store a value which was derived from the current own key
+        and config. """
+        head = self._chain.get_head_cid()
+        if head is None:
+            return
+        view = self._chain.get_view() or dict(head=head, exports={})
+        view = dict(view, exports=dict(view["exports"], **{name: value}))
+        self._chain.set_view(view)
+
 
 # ===========================================================
 # OOBChain keeps track of out-of-band verifications
@@ -382,3 +1173,56 @@ class AccountManagerState(object):
     def set_version(self, version):
         assert not self._latest_config()
         self._chain.append_entry(AConfigEntry(version=version))
+
+
+# ===========================================================
+# references between blocks for garbage collection and fsck
+# ===========================================================
+
+_entry_classes = dict((cls.TAG, cls) for cls in (
+    MsgEntry, MsgGossipEntry, SnapshotEntry, KeygenEntry, OwnConfigEntry,
+    VerificationEntry, AConfigEntry,
+))
+
+
+def _block_refs(block):
+    """ return the lists of block and blob cids which a block references. """
+    parents = [block.parent_cid] if block.parent_cid else []
+    blobs = []
+    entryclass = _entry_classes.get(block.type)
+    if entryclass is not None:
+        names = [a.name for a in attr.fields(entryclass)]
+        for name in getattr(entryclass, "CHAIN_FIELDS", ()):
+            value = block.args[names.index(name)]
+            if value:
+                parents.append(value)
+        for name in getattr(entryclass, "BLOB_FIELDS", ()):
+            value = block.args[names.index(name)]
+            # blocks written before blobs were introduced contain the bytes
+            if value and isinstance(value, six.text_type):
+                blobs.append(value)
+    return parents, blobs
+
+
+@attr.s
+class FsckProblem(object):
+    """ a problem found by States.fsck() in the chain with the given
+    head name (None for stored data) at the block or blob cid. """
+    head = attrib()
+    cid = attrib()
+    message = attrib()
+
+
+def _corrupt_cids(items):
+    """ return the cids of the (cid, stored data) items whose data
+    does not hash to the cid.  Runs in fsck worker processes. """
+    corrupt = []
+    for cid, data in items:
+        try:
+            data = blockcodec.decompress(data)
+        except zlib.error:
+            corrupt.append(cid)
+            continue
+        if hashlib.sha256(data).hexdigest() != cid:
+            corrupt.append(cid)
+    return corrupt
@@ -295,21 +295,29 @@ class DirCache:
 @pytest.fixture
 def account_maker(tmpdir, gpgpath):
     """ return a function which creates a new account, by default initialized.
-    pass init=False to the function to avoid initizialtion.
+    pass init=False to the function to avoid initizialtion.  With
+    secret_keydata the account uses that key instead of a generated one.
     """
     # we have to be careful to not generate too long paths
     # because gpg-2.1.11 chokes while trying to start gpg-agent
     count = itertools.count()
 
-    def maker(email_regex=u'.*', gpgmode=u'own', gpgbin=gpgpath):
+    def maker(email_regex=u'.*', gpgmode=u'own', gpgbin=gpgpath, secret_keydata=None):
         i = next(count)
         bname = u"ac%d" % i
         basedir = tmpdir.mkdir(bname).strpath
         states = States(basedir)
         account = Account(states, bname, plugin_manager=make_plugin_manager())
         account.addr = u"%d@x.org" % (i, )
+        keyhandle = None
+        if secret_keydata is not None:
+            # use the given key instead of generating one which
+            # keeps the account independent of gpg's key generation
+            assert gpgmode == "own"
+            bingpg = BinGPG(states.get_own_gpghome(bname), gpgpath=gpgbin)
+            keyhandle = bingpg.import_keydata(secret_keydata)
         account.create(name=bname, email_regex=u".*", gpgmode=gpgmode, gpgbin=gpgbin,
-                       keyhandle=None)
+                       keyhandle=keyhandle)
         account._fulladdr = "%s <%s>" % (bname, account.addr)
         account.plugin_manager.hook.instantiate_account(
             plugin_manager=account.plugin_manager,
@@ -42,6 +42,17 @@ class TestAccount:
         assert acc.export_public_key()
         assert acc.export_secret_key()
 
+    def test_make_ac_header_cached(self, account_maker, datadir, monkeypatch):
+        acc1 = account_maker(secret_keydata=datadir.read_bytes("testbot.secretkey"))
+        header = acc1.make_ac_header(acc1.addr)
+        monkeypatch.setattr(acc1.bingpg, "get_public_keydata", None)
+        assert acc1.make_ac_header(acc1.addr) == header
+        other = acc1.make_ac_header("other@example.org")
+        assert other.replace("other@example.org", acc1.addr) == header
+        monkeypatch.undo()
+        acc1.modify(prefer_encrypt="mutual")
+        assert "prefer-encrypt=mutual" in acc1.make_ac_header(acc1.addr)
+
     def test_parse_incoming_mail_broken_ac_header(self, account_maker):
         acc1 = account_maker()
         msg = mime.gen_mail_msg(
@@ -166,6 +177,25 @@ class TestAccount:
         assert r.peerstate.last_seen == fixed_time
         assert r.msg_date == fixed_time
 
+    def test_parse_incoming_mails_skips_known_key_import(self, account_maker, datadir,
+                                                         monkeypatch):
+        acc2 = account_maker(secret_keydata=datadir.read_bytes("testbot.secretkey"))
+        imports = []
+        import_keydata = acc2.bingpg.import_keydata
+        monkeypatch.setattr(acc2.bingpg, "import_keydata",
+                            lambda keydata: imports.append(keydata) or import_keydata(keydata))
+        msg = mime.parse_message_from_file(datadir.open("rsa2048-simple.eml"))
+        kh = acc2.process_incoming(msg).peerstate.public_keyhandle
+        assert kh and acc2.bingpg.list_public_keyinfos(kh)
+        msg.replace_header("Message-Id", "<other@example.org>")
+        assert acc2.process_incoming(msg).peerstate.public_keyhandle == kh
+        assert len(imports) == 1
+        # changing the keyring invalidates known keyhandles
+        import_keydata(datadir.read_bytes("test1_autocrypt_org.key"))
+        msg.replace_header("Message-Id", "<third@example.org>")
+        assert acc2.process_incoming(msg).peerstate.public_keyhandle == kh
+        assert len(imports) == 2
+
     def test_parse_incoming_mails_replace_by_date(self, account_maker):
         acc1, acc2, acc3 = account_maker(), account_maker(), account_maker()
         addr = acc1.addr
@@ -430,6 +460,21 @@ class TestAccountManager:
         mc.remove()
         assert not mc.exists()
 
+    @pytest.mark.parametrize("backend", ["pack", "sqlite"])
+    def test_remove_keeps_storage(self, tmpdir, backend):
+        tmpdir = tmpdir.strpath
+        mc = AccountManager(tmpdir, plugin_manager=make_plugin_manager(),
+                            storage=backend)
+        mc.init()
+        mc.remove()
+        assert not mc.exists()
+        assert mc.storage["backend"] == backend
+        mc.init()
+        mc2 = AccountManager(tmpdir, plugin_manager=make_plugin_manager(),
+                             storage=backend)
+        assert mc2.exists()
+        assert mc2.storage["backend"] == backend
+
     def test_account_header_defaults(self, manager_maker):
         account_manager = manager_maker(init=False)
         addr = "hello@xyz.org"
@@ -6,6 +6,7 @@ from __future__ import unicode_literals
 import os
 import pytest
 from muacrypt.bingpg import cached_property, BinGPG, KeyInfo
+from muacrypt import mime
 
 
 def test_cached_property_object():
@@ -65,11 +66,38 @@ def test_bingpg_native(bingpg_maker, monkeypatch):
     pytest.fail("did not find handle %r" % keyhandle)
 
 
+def test_keyring_signature(tmpdir):
+    bingpg = BinGPG(homedir=tmpdir.strpath)
+    assert bingpg.get_keyring_signature() == []
+    tmpdir.join("pubring.kbx").write("1")
+    signature = bingpg.get_keyring_signature()
+    assert signature == bingpg.get_keyring_signature()
+    tmpdir.join("pubring.kbx").write("12")
+    assert bingpg.get_keyring_signature() != signature
+
+
 class TestBinGPG:
     def test_failed_invocation_outerr(self, bingpg2):
         with pytest.raises(bingpg2.InvocationFailure):
             bingpg2._gpg_outerr(["qwe"])
 
+    def test_import_keydata_many(self, bingpg, bingpg2, datadir, monkeypatch):
+        keydatas = []
+        for name in ("25519-simple.eml", "rsa2048-simple.eml", "rsa4096-simple.eml"):
+            msg = mime.parse_message_from_file(datadir.open(name))
+            keydatas.append(mime.parse_one_ac_header_from_msg(msg).keydata)
+        keyhandles = [bingpg2.import_keydata(keydata) for keydata in keydatas]
+        calls = []
+        gpg_outerr = bingpg._gpg_outerr
+        monkeypatch.setattr(bingpg, "_gpg_outerr",
+                            lambda argv, **kw: calls.append(argv) or gpg_outerr(argv, **kw))
+        assert bingpg.import_keydata_many(keydatas) == keyhandles
+        assert len(calls) == 1
+        # broken keydata makes gpg fail and the keys are imported separately
+        assert bingpg.import_keydata_many([keydatas[1], b"123"]) == [keyhandles[1], None]
+        assert len(calls) == 4
+        assert bingpg.import_keydata_many([]) == []
+
     def test_gen_key_and_check_packets(self, bingpg):
         keyhandle = bingpg.gen_secret_key(emailadr="hello@xyz.org")
         keydata = bingpg.get_secret_keydata(keyhandle)
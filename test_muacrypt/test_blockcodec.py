@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+
+from __future__ import unicode_literals, print_function
+
+import hashlib
+import pytest
+from execnet.gateway_base import dumps
+from muacrypt import blockcodec
+
+
+cid = hashlib.sha256(b"1").hexdigest()
+
+
+def test_roundtrip():
+    for obj in [
+        None, True, False, 0, 1, -1, 2 ** 70, -300, 17.5, b"", b"\x00\xff" * 100,
+        "", "h\xe4llo", cid, cid.upper(), cid[:-1], [], (), {},
+        [dict(height=3, root=cid, skip=[cid, cid]), "msg", cid, 1.5, "<id@x>", b"key", ""],
+        ["nested", ("tuple", [1, {"a": None}])],
+    ]:
+        serialized = blockcodec.encode(obj)
+        assert serialized[:1] == blockcodec.MAGIC
+        decoded = blockcodec.decode(serialized)
+        assert decoded == obj
+        assert type(decoded) is type(obj)
+
+
+def test_decode_execnet():
+    obj = ["msg", None, 1.5, b"key"]
+    assert blockcodec.decode(dumps(obj)) == obj
+    assert blockcodec.encode(obj, "execnet") == dumps(obj)
+
+
+def test_smaller_than_execnet():
+    data = [dict(height=2, root=cid, skip=[cid]), "msg", cid, 1.5,
+            "<id@example.org>", 1.5, "mutual", cid, "ABCDEF0123456789"]
+    assert len(blockcodec.encode(data)) < len(dumps(data)) / 2
+
+
+def test_invalid():
+    with pytest.raises(ValueError):
+        blockcodec.decode(blockcodec.MAGIC + b"\x02N")
+    with pytest.raises(ValueError):
+        blockcodec.decode(blockcodec.encode([1]) + b"N")
+    with pytest.raises(TypeError):
+        blockcodec.encode(object())
+
+
+def test_compress():
+    data = blockcodec.encode(["msg", None, 1.5, b"key" * 100])
+    compressed = blockcodec.compress(data, 100)
+    assert compressed[:2] == blockcodec.COMPRESSED
+    assert len(compressed) < len(data)
+    assert blockcodec.decompress(compressed) == data
+    assert blockcodec.decode(compressed) == ["msg", None, 1.5, b"key" * 100]
+    # too small, disabled or incompressible data is kept as is
+    assert blockcodec.compress(data, 10000) == data
+    assert blockcodec.compress(data, 0) == data
+    random = hashlib.sha256(b"1").digest() + hashlib.sha256(b"2").digest()
+    assert blockcodec.compress(random, 1) == random
+    assert blockcodec.decompress(data) == data
+
+
+def test_compress_escapes_header():
+    data = blockcodec.COMPRESSED + b"raw blob"
+    stored = blockcodec.compress(data, 0)
+    assert stored != data
+    assert blockcodec.decompress(stored) == data
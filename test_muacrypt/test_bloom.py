@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+
+from __future__ import unicode_literals, print_function
+
+from muacrypt.bloom import BloomFilter, optimal_params
+
+
+def test_optimal_params():
+    num_bits, num_hashes = optimal_params(1000, 0.01)
+    assert 9000 < num_bits < 10000
+    assert num_hashes == 7
+
+
+class TestBloomFilter:
+    def test_add_and_contains(self, tmpdir):
+        path = tmpdir.join("f.bloom").strpath
+        bloom = BloomFilter.create(path, 100, 0.001, keys=["<a@x>"])
+        bloom.add("<b@x>")
+        assert "<a@x>" in bloom
+        assert "<b@x>" in bloom
+        assert "<c@x>" not in bloom
+        other = BloomFilter(path)
+        assert "<b@x>" in other
+        assert other.get_stats()["count"] == 2
+
+    def test_false_positive_rate(self, tmpdir):
+        bloom = BloomFilter.create(tmpdir.join("f.bloom").strpath, 1000, 0.01,
+                                   keys=["<{}@x>".format(i) for i in range(1000)])
+        false = sum("<{}@y>".format(i) in bloom for i in range(2000))
+        assert false < 2000 * 0.03
+
+    def test_stats(self, tmpdir):
+        path = tmpdir.join("f.bloom").strpath
+        bloom = BloomFilter.create(path, 10, 0.01)
+        bloom.add("<a@x>")
+        assert bloom.check("<a@x>")
+        assert not bloom.check("<b@x>")
+        bloom.record_false_positive()
+        stats = BloomFilter(path).get_stats()
+        assert stats["count"] == 1
+        assert stats["capacity"] == 10
+        assert stats["positives"] == 1
+        assert stats["negatives"] == 1
+        assert stats["false_positives"] == 1
+
+    def test_replaced_file_is_remapped(self, tmpdir):
+        path = tmpdir.join("f.bloom").strpath
+        bloom = BloomFilter.create(path, 10, 0.01)
+        assert "<a@x>" not in bloom
+        BloomFilter.create(path, 10, 0.01, keys=["<a@x>"])
+        assert "<a@x>" in bloom
@@ -3,10 +3,16 @@
 
 from __future__ import unicode_literals, print_function
 
+import os
 import time
 import hashlib
 import pytest
-from muacrypt.chainstore import BlockService, HeadTracker
+from execnet.gateway_base import dumps
+from muacrypt import blockcodec
+from muacrypt.chainstore import (
+    BlockService, BlockCache, HeadTracker, JournalHeadTracker, HeadConflict,
+    ChainStates, JournalMap, ShardedMap, fcntl,
+)
 
 
 class TestBlockService:
@@ -44,6 +50,132 @@ class TestBlockService:
         assert block.timestamp <= time.time()
         assert block.parent is None
 
+    def test_blobs(self, bs):
+        cid = bs.store_blob(b"keydata")
+        assert cid == hashlib.sha256(b"keydata").hexdigest()
+        assert bs.store_blob(b"keydata") == cid
+        assert bs.get_blob(cid) == b"keydata"
+        assert list(bs.iter_cids()) == [cid]
+
+    def test_fanout_layout(self, tmpdir):
+        bs = BlockService(tmpdir.strpath, fanout=True)
+        block = bs.store_block("genesis", ["hello"])
+        assert tmpdir.join(block.cid[:2], block.cid[2:]).exists()
+        assert not tmpdir.join(block.cid).exists()
+        assert list(bs.iter_cids()) == [block.cid]
+        assert BlockService(tmpdir.strpath).get_block(block.cid).args == ["hello"]
+
+    def test_convert_layout(self, tmpdir):
+        flat = BlockService(tmpdir.strpath)
+        block1 = flat.store_block("genesis", ["hello"])
+        fanout = BlockService(tmpdir.strpath, fanout=True)
+        block2 = fanout.store_block("x", ["world"], parent=block1.cid)
+        # a block stored in both layouts by processes using different layouts
+        tmpdir.join(block2.cid).write_binary(fanout._get_serialized(block2.cid))
+        assert sorted(fanout.iter_cids()) == sorted([block1.cid] + [block2.cid] * 2)
+        assert fanout.convert_layout() == 2
+        assert fanout.convert_layout() == 0
+        assert sorted(os.listdir(tmpdir.strpath)) == sorted(
+            set([block1.cid[:2], block2.cid[:2]]))
+        assert flat.get_block(block2.cid).parent.args == ["hello"]
+        assert flat.convert_layout() == 2
+        assert sorted(os.listdir(tmpdir.strpath)) == sorted([block1.cid, block2.cid])
+
+    def test_compression(self, tmpdir):
+        bs = BlockService(tmpdir.strpath, compress_min_size=200, encoding="compact")
+        keydata = b"key data " * 100
+        blob_cid = bs.store_blob(keydata)
+        assert blob_cid == hashlib.sha256(keydata).hexdigest()
+        block = bs.store_block("keygen", [keydata, "4567"])
+        small = bs.store_block("x", ["hello"], parent=block.cid)
+        # addresses are computed over the uncompressed data
+        serialized = blockcodec.encode([block._meta, block.type, None, block.timestamp,
+                                        keydata, "4567"], "compact")
+        assert block.cid == hashlib.sha256(serialized).hexdigest()
+        assert tmpdir.join(block.cid).size() < len(serialized)
+        assert tmpdir.join(blob_cid).size() < len(keydata)
+        assert bs._get_serialized(small.cid)[:2] != blockcodec.COMPRESSED
+        # compressed data is read regardless of the setting
+        reader = BlockService(tmpdir.strpath)
+        assert reader.get_blob(blob_cid) == keydata
+        assert [b.args for b in reader.get_block(small.cid)] == [["hello"], [keydata, "4567"]]
+
+    def test_heights_and_ancestors(self, bs):
+        blocks = [bs.store_block("genesis", [0])]
+        for i in range(1, 40):
+            blocks.append(bs.store_block("x", [i], parent=blocks[-1].cid))
+        head = bs.get_block(blocks[-1].cid)
+        assert head.height == 40
+        assert head.root_cid == blocks[0].cid
+        assert head.get_last_parent() == blocks[0]
+        for distance in (0, 1, 2, 5, 16, 31, 39):
+            assert head.get_ancestor(distance) == blocks[39 - distance]
+        assert head.get_ancestor(40) is None
+        assert head.contains_cid(blocks[7].cid)
+        assert not blocks[7].contains_cid(head.cid)
+        other = bs.store_block("genesis", [1])
+        assert not head.contains_cid(other.cid)
+
+    def test_blocks_without_metadata(self, bs):
+        parent = None
+        for i in range(5):
+            # blocks written by earlier versions
+            serialized = dumps(["x", parent, time.time(), i])
+            parent = hashlib.sha256(serialized).hexdigest()
+            bs._store_serialized(parent, serialized)
+        old = bs.get_block(parent)
+        assert old.args == [4]
+        assert old.height == 5
+        blocks = [old]
+        for i in range(5, 12):
+            blocks.append(bs.store_block("x", [i], parent=blocks[-1].cid))
+        head = blocks[-1]
+        assert head.height == 12
+        assert head.get_last_parent().args == [0]
+        assert head.get_ancestor(10).args == [1]
+        assert head.contains_cid(old.cid)
+        assert [b.args[0] for b in head] == list(reversed(range(12)))
+
+
+class TestBlockCache:
+    @pytest.fixture
+    def bs(self, tmpdir):
+        return BlockService(tmpdir.mkdir("blocks").strpath, cache=BlockCache())
+
+    def test_get_block_hits_cache(self, bs):
+        # storing a block reads its parent so use an uncached writer
+        writer = BlockService(bs._basedir)
+        block1 = writer.store_block("genesis", ["hello"])
+        block2 = writer.store_block("something", ["world"], parent=block1.cid)
+        assert list(bs.get_block(block2.cid)) == [block2, block1]
+        assert bs._cache.misses == 2 and bs._cache.hits == 0
+        assert list(bs.get_block(block2.cid)) == [block2, block1]
+        assert bs._cache.misses == 2 and bs._cache.hits == 2
+        assert bs._cache.stats()["entries"] == 2
+
+    def test_bytes_cid(self, bs):
+        block = bs.store_block("genesis", ["hello"])
+        assert bs.get_block(block.cid.encode("ascii")) is bs.get_block(block.cid)
+
+    def test_lru_eviction_by_entries(self, bs):
+        bs._cache.max_entries = 2
+        blocks = [bs.store_block("x", [i]) for i in range(3)]
+        assert len(bs._cache) == 2
+        assert bs._cache.get(blocks[0].cid) is None
+        assert bs._cache.get(blocks[1].cid) is blocks[1]
+        bs.store_block("x", [4])
+        assert bs._cache.get(blocks[1].cid) is blocks[1]
+        assert bs._cache.get(blocks[2].cid) is None
+
+    def test_lru_eviction_by_bytes(self, bs):
+        bs._cache.max_bytes = 200
+        bs.store_block("x", ["a" * 80])
+        bs.store_block("x", ["b" * 80])
+        assert len(bs._cache) == 1
+        assert bs._cache.size_bytes <= 200
+        bs.store_block("x", ["c" * 300])
+        assert len(bs._cache) == 1
+
 
 class TestHeadTracker:
     @pytest.fixture
@@ -60,3 +192,230 @@ class TestHeadTracker:
         assert ht.get_head_cid("id1") == cid1
         ht.upsert("id1", cid2)
         assert ht.get_head_cid("id1") == cid2
+
+    def test_transaction_writes_once(self, ht, monkeypatch):
+        writes = []
+        monkeypatch.setattr(ht, "_write", lambda items, expected=None: writes.append(items))
+        with ht.transaction():
+            ht.upsert("id1", "1")
+            with ht.transaction():
+                ht.upsert("id2", "2")
+            ht.upsert("id1", "3")
+            ht.remove_if(lambda name, cid: name == "id2")
+            assert ht.get_head_cid("id1") == "3"
+            assert ht.get_names() == ["id1"]
+            assert not writes
+        assert sorted(writes[0]) == [("id1", "3"), ("id2", None)]
+
+    def test_transaction_rollback(self, ht):
+        ht.upsert("id1", "1")
+        with pytest.raises(ValueError):
+            with ht.transaction():
+                ht.upsert("id1", "2")
+                raise ValueError()
+        assert ht.get_head_cid("id1") == "1"
+
+    def test_fsync(self, tmpdir, monkeypatch):
+        synced = []
+        monkeypatch.setattr(os, "fsync", lambda fd: synced.append(fd))
+        ht = HeadTracker(tmpdir.join("heads").strpath, fsync="commit")
+        bs = BlockService(tmpdir.mkdir("blocks").strpath, fsync="commit")
+        with ht.transaction(), bs.transaction():
+            bs.store_block("genesis", ["hello"])
+            bs.store_block("genesis", ["world"])
+            assert not synced
+            ht.upsert("id1", "1")
+        # two blocks and their directory, heads and their directory
+        assert len(synced) == 5
+
+
+@pytest.mark.parametrize("cls", [HeadTracker, JournalHeadTracker])
+def test_names_pages(tmpdir, cls):
+    path = tmpdir.join("heads").strpath
+    ht = cls(path)
+    ht._names_page_size = 3
+    ht.upsert_many([("peer:1:{}@x.org".format(i), "cid") for i in range(10)])
+    ht.upsert_many([("own:1", "cid"), ("peer:10:a@x.org", "cid")])
+    names = ["{}@x.org".format(i) for i in range(10)]
+    assert ht.get_names("peer:1:") == names
+    assert ht.get_names("peer:1:", limit=4) == names[:4]
+    assert ht.get_names("peer:1:", after=names[3], limit=4) == names[4:8]
+    assert ht.get_names("peer:1:", after=names[8]) == names[9:]
+    assert ht.get_names("peer:2:") == []
+    assert ht.get_names() == sorted(["own:1", "peer:10:a@x.org"] +
+                                    ["peer:1:" + name for name in names])
+    # names added and removed by another instance while iterating
+    iterator = ht.iter_names("peer:1:")
+    assert [next(iterator) for i in range(4)] == names[:4]
+    other = cls(path)
+    other.upsert("peer:1:5a@x.org", "cid")
+    other.remove_if(lambda name, cid: name == "peer:1:2@x.org")
+    other.remove_if(lambda name, cid: name == "peer:1:6@x.org")
+    assert list(iterator) == names[4:6] + ["5a@x.org"] + names[7:]
+
+
+@pytest.mark.parametrize("cls", [HeadTracker, JournalHeadTracker])
+def test_compare_and_swap(tmpdir, cls):
+    path = tmpdir.join("heads").strpath
+    ht1, ht2 = cls(path), cls(path)
+    ht1.upsert("id1", "cid1", expected_cid=None)
+    with pytest.raises(HeadConflict):
+        ht2.upsert("id1", "cid2", expected_cid=None)
+    ht2.upsert("id1", "cid2", expected_cid="cid1")
+    # within a transaction the first expectation is checked on commit
+    with pytest.raises(HeadConflict):
+        with ht1.transaction():
+            ht1.upsert("id1", "cid3", expected_cid="cid1")
+            ht1.upsert("id1", "cid4", expected_cid="cid3")
+            ht1.upsert("id2", "cid5")
+    assert ht1._getheads() == {"id1": "cid2"}
+    with ht1.transaction():
+        ht1.upsert("id1", "cid3", expected_cid="cid2")
+        ht2.upsert("id2", "cid5")
+    assert ht2._getheads() == {"id1": "cid3", "id2": "cid5"}
+
+
+@pytest.mark.parametrize("cls", [HeadTracker, JournalHeadTracker])
+def test_new_head_block_retries_on_conflict(tmpdir, cls):
+    bsdir = tmpdir.mkdir("blocks").strpath
+    path = tmpdir.join("heads").strpath
+    bs = BlockService(bsdir)
+    cs1 = ChainStates(bs, cls(path), "id1")
+    cs2 = ChainStates(BlockService(bsdir), cls(path), "id1")
+    cs1.new_head_block("msg", [1])
+    store_block = bs.store_block
+    moved = []
+
+    def store_block_and_move_head(*args, **kwargs):
+        # another writer appends after our block was stored
+        if not moved:
+            moved.append(cs2.new_head_block("msg", [2]))
+        return store_block(*args, **kwargs)
+
+    bs.store_block = store_block_and_move_head
+    block = cs1.new_head_block("msg", [3])
+    assert block.parent_cid == moved[0].cid
+    assert [x.args for x in cs2.iter_blocks()] == [[3], [2], [1]]
+
+
+def _append_blocks(bsdir, path, num):
+    try:
+        cs = ChainStates(BlockService(bsdir), JournalHeadTracker(path), "id1")
+        for i in range(num):
+            cs.new_head_block("msg", [os.getpid(), i])
+    finally:
+        os._exit(0)
+
+
+@pytest.mark.skipif(fcntl is None or not hasattr(os, "fork"),
+                    reason="needs fcntl and fork")
+def test_concurrent_writers_lose_no_updates(tmpdir):
+    bsdir = tmpdir.mkdir("blocks").strpath
+    path = tmpdir.join("heads").strpath
+    pids = []
+    for i in range(4):
+        pid = os.fork()
+        if pid == 0:
+            _append_blocks(bsdir, path, 25)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    cs = ChainStates(BlockService(bsdir), JournalHeadTracker(path), "id1")
+    assert cs.get_head_block().height == 100
+
+
+def _update_map(path, num):
+    try:
+        m = JournalMap(path, min_compact_size=200)
+        for i in range(num):
+            m.update([("{}-{}".format(os.getpid(), i), i)])
+    finally:
+        os._exit(0)
+
+
+@pytest.mark.skipif(fcntl is None or not hasattr(os, "fork"),
+                    reason="needs fcntl and fork")
+def test_concurrent_map_updates_lose_no_records(tmpdir):
+    path = tmpdir.join("map").strpath
+    pids = []
+    for i in range(4):
+        pid = os.fork()
+        if pid == 0:
+            _update_map(path, 50)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    # journals were compacted while other processes appended
+    assert len(JournalMap(path).items()) == 200
+
+
+class TestJournalHeadTracker:
+    @pytest.fixture
+    def path(self, tmpdir):
+        return tmpdir.join("heads").strpath
+
+    def test_upsert_get_remove(self, path):
+        ht = JournalHeadTracker(path)
+        assert not ht.get_head_cid("id1")
+        ht.upsert("id1", "cid1")
+        ht.upsert("id2", "cid2")
+        ht.upsert("id1", "cid3")
+        assert ht.get_head_cid("id1") == "cid3"
+        assert ht._getheads(prefix="id") == {"1": "cid3", "2": "cid2"}
+        ht.remove_if(lambda name, cid: name == "id2")
+        assert ht._getheads() == {"id1": "cid3"}
+        ht2 = JournalHeadTracker(path)
+        assert ht2._getheads() == {"id1": "cid3"}
+
+    def test_compaction(self, path):
+        ht = JournalHeadTracker(path, min_compact_size=1000)
+        for i in range(100):
+            ht.upsert("id%d" % (i % 10), "cid%d" % i)
+        assert os.path.getsize(path + ".journal") <= 1000
+        assert os.path.exists(path)
+        ht2 = JournalHeadTracker(path)
+        assert ht2._getheads() == dict(("id%d" % i, "cid%d" % (90 + i)) for i in range(10))
+        # the snapshot is compatible with the plain HeadTracker
+        ht.upsert("id0", "cid0")
+        ht._map.compact()
+        assert HeadTracker(path).get_head_cid("id0") == "cid0"
+
+    def test_sees_updates_from_other_instance(self, path):
+        ht1 = JournalHeadTracker(path, min_compact_size=100)
+        ht2 = JournalHeadTracker(path, min_compact_size=100)
+        ht1.upsert("id1", "cid1")
+        assert ht2.get_head_cid("id1") == "cid1"
+        for i in range(20):
+            ht2.upsert("id2", "cid%d" % i)
+        assert ht1.get_head_cid("id2") == "cid19"
+        assert ht1.get_head_cid("id1") == "cid1"
+
+    def test_ignores_incomplete_record(self, path):
+        ht = JournalHeadTracker(path)
+        ht.upsert("id1", "cid1")
+        with open(path + ".journal", "ab") as f:
+            f.write(b"\x00\x00\x01\x00xyz")
+        ht2 = JournalHeadTracker(path)
+        assert ht2.get_head_cid("id1") == "cid1"
+        ht2.upsert("id2", "cid2")
+        assert JournalHeadTracker(path)._getheads() == {"id1": "cid1", "id2": "cid2"}
+
+
+class TestShardedMap:
+    def test_update_get_items(self, tmpdir):
+        m = ShardedMap(tmpdir.strpath, num_shards=8)
+        m.update([("c1", "h1"), ("c1\nk1", "v1"), ("c2\nk1", "v2")])
+        assert m.get("c1\nk1") == "v1"
+        assert m.shard("c1\nk1") is m.shard("c1")
+        assert m.shard("c1").get("c1") == "h1"
+        m.update([("c2\nk1", None)])
+        m2 = ShardedMap(tmpdir.strpath, num_shards=8)
+        assert m2.get("c2\nk1") is None
+        assert sorted(m2.items()) == [("c1", "h1"), ("c1\nk1", "v1")]
+
+    def test_get_loads_one_shard(self, tmpdir):
+        m = ShardedMap(tmpdir.strpath, num_shards=8)
+        m.update(("c%d\nk" % i, i) for i in range(100))
+        m2 = ShardedMap(tmpdir.strpath, num_shards=8)
+        assert m2.get("c17\nk") == 17
+        assert len(m2._shards) == 1
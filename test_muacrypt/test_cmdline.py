@@ -3,6 +3,7 @@
 
 from __future__ import print_function, unicode_literals
 import os
+import json
 import re
 import six
 import pytest
@@ -79,6 +80,69 @@ def check_ascii(out):
         out.decode("ascii")
 
 
+def test_migrate_storage(mycmd):
+    mycmd.run_ok(["migrate-storage", "pack"], """
+        *migrated*blocks*pack*
+    """)
+    mycmd.run_ok(["migrate-storage", "pack"], """
+        *migrated 0 blocks*pack*
+    """)
+    mycmd.run_ok(["migrate-storage", "--heads=journal"], """
+        *migrated 0 blocks*pack*heads*journal*
+    """)
+    mycmd.run_ok(["migrate-storage", "files", "--layout=fanout"], """
+        *migrated*blocks*files*layout*fanout*
+    """)
+    mycmd.run_fail(["migrate-storage", "xyz"])
+
+
+def test_storage_option(mycmd):
+    mycmd.run_ok(["--storage=sqlite", "migrate-storage"], """
+        *migrated 0 blocks*sqlite*
+    """)
+    mycmd.run_fail(["--storage=pack", "migrate-storage"], """
+        *uses backend=*sqlite*migrate*
+    """)
+
+
+def test_storage_option_tunable(mycmd):
+    mycmd.run_ok(["--storage-option", "fsync=always", "--storage-option=readahead=8",
+                  "migrate-storage"], """
+        *migrated 0 blocks*
+    """)
+    with open(os.path.join(mycmd.account_dir, "storage.json")) as f:
+        storage = json.load(f)
+    assert storage["fsync"] == "always"
+    assert storage["readahead"] == 8
+    mycmd.run_fail(["--storage-option", "layout=flat", "migrate-storage"], """
+        *NAME=VALUE*msgid_fp_rate*
+    """)
+    mycmd.run_fail(["--storage-option", "fsync=sometimes", "migrate-storage"], """
+        *fsync must be one of*
+    """)
+    mycmd.run_fail(["--storage-option", "msgid_fp_rate=2", "migrate-storage"], """
+        *msgid_fp_rate must be between 0 and 1*
+    """)
+
+
+def test_gc(mycmd):
+    mycmd.run_ok(["gc", "--dry-run"], """
+        *reachable, 0 unreachable, 0 removed*
+    """)
+    mycmd.run_ok(["gc", "--archive"], """
+        *reachable, 0 unreachable, 0 removed*
+    """)
+
+
+def test_fsck(mycmd):
+    mycmd.run_ok(["fsck"], """
+        *blocks, * chains checked, 0 problems*
+    """)
+    mycmd.run_ok(["fsck", "--repair", "--processes=1"], """
+        *0 problems*
+    """)
+
+
 class TestProcessIncoming:
     def test_process_incoming(self, mycmd, datadir):
         mycmd.run_ok(["add-account", "-a", "account1", "--email-regex=some@example.org"])
@@ -163,6 +227,10 @@ class TestScandir:
         linematch(out, """
             *already known*
         """)
+        mycmd.run_ok(["compact", "--archive"], """
+            *account1*removed 0 blocks*
+            *account2*removed 0 blocks*
+        """)
         out = mycmd.run_ok(["scandir-incoming", "--reparse", str(maildir)])
         linematch(out, """
             *found Autocrypt*
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+
+from __future__ import unicode_literals
+
+import struct
+from binascii import unhexlify
+import pytest
+from muacrypt import mime
+from muacrypt.openpgp import (
+    parse_keyinfos, iter_packets, dearmor, minimize_keydata, encode_packet, ParseError,
+)
+
+
+def ac_keydata(datadir, name):
+    msg = mime.parse_message_from_file(datadir.open(name))
+    return mime.parse_one_ac_header_from_msg(msg).keydata
+
+
+@pytest.fixture(params=["25519-simple.eml", "rsa2048-simple.eml", "rsa4096-simple.eml",
+                        "test1_autocrypt_org.key"])
+def keydata(request, datadir):
+    if request.param.endswith(".key"):
+        return datadir.read_bytes(request.param)
+    return ac_keydata(datadir, request.param)
+
+
+def test_parse_ed25519_key(datadir):
+    pub, sub = parse_keyinfos(ac_keydata(datadir, "25519-simple.eml"))
+    assert pub.fingerprint == "26AA6751FD7668C42FA4924AFC744DA9FE73C3D4"
+    assert pub.id == "FC744DA9FE73C3D4"
+    assert (pub.type, pub.bits, pub.date_created) == ("22", 255, "1481971693")
+    assert pub.uids == ["alice@testsuite.autocrypt.org"]
+    assert sub.fingerprint == "4CF9C821B4871398AEFA96B2C844E3CB6CE55B79"
+    assert (sub.type, sub.bits, sub.date_created) == ("18", 255, "1481971694")
+    assert sub.uids == []
+
+
+def test_parse_armored_rsa_key(datadir):
+    pub, sub = parse_keyinfos(datadir.read_bytes("test1_autocrypt_org.key"))
+    assert pub.fingerprint == "C370976B8C6548AAB80AC66DEA8A4CC32DEB7CB5"
+    assert (pub.type, pub.bits, pub.date_created) == ("1", 2048, "1542214312")
+    assert pub.uids == ["test1@autocrypt.org"]
+    assert sub.id == "4E067FF58E596EBB"
+
+
+def test_parse_secret_key(datadir):
+    keyinfos = parse_keyinfos(datadir.read_bytes("testbot.secretkey"))
+    assert len(keyinfos) >= 2
+    assert keyinfos[0].uids
+    assert all(len(k.fingerprint) == 40 for k in keyinfos)
+
+
+@pytest.mark.parametrize("header", [
+    b"\xb4\x05",  # old format, one octet length
+    b"\xb5\x00\x05",  # old format, two octet length
+    b"\xb6\x00\x00\x00\x05",  # old format, four octet length
+    b"\xb7",  # old format, indeterminate length
+    b"\xcd\x05",  # new format, one octet length
+    b"\xcd\xff\x00\x00\x00\x05",  # new format, five octet length
+])
+def test_packet_lengths(header):
+    assert list(iter_packets(header + b"a@b.c")) == [(13, b"a@b.c")]
+
+
+def test_packet_partial_lengths():
+    body = b"x" * 200
+    # partial chunks of 2 and 1 octets followed by a two octet length
+    data = b"\xcd\xe1xx\xe0x" + b"\xc0\x05" + body[:197]
+    assert list(iter_packets(data)) == [(13, body)]
+
+
+@pytest.mark.parametrize("data", [b"", b"123", b"\xb4\x05a@b", b"\xb4\x05a@b.c",
+                                  b"\x99\x00\x01\x03"])
+def test_invalid_keydata(data):
+    with pytest.raises(ParseError):
+        parse_keyinfos(data)
+
+
+def test_dearmor_binary_unchanged():
+    assert dearmor(b"\x99\x00") == b"\x99\x00"
+
+
+def test_matches_gpg(bingpg, keydata):
+    keyhandle = bingpg.import_keydata(keydata)
+    keyinfos = parse_keyinfos(keydata)
+    assert keyinfos[0].id == keyhandle
+    gpg_keyinfos = bingpg.list_public_keyinfos(keyhandle)
+    assert len(gpg_keyinfos) == len(keyinfos)
+    for parsed, listed in zip(keyinfos, gpg_keyinfos):
+        assert parsed.fingerprint == listed.fingerprint
+        assert parsed.id == listed.id
+        assert parsed.type == listed.type
+        assert parsed.bits == listed.bits
+        assert parsed.date_created == listed.date_created
+        assert parsed.uids == listed.uids
+
+
+def make_sig(sigtype, created, issuer, key_flags=None):
+    hashed = struct.pack(">BBI", 5, 2, created) + struct.pack(">BBB", 22, 33, 4)
+    hashed += unhexlify(issuer)
+    if key_flags is not None:
+        hashed += struct.pack(">BBB", 2, 27, key_flags)
+    return (struct.pack(">BBBBH", 4, sigtype, 22, 8, len(hashed)) + hashed +
+            struct.pack(">HH", 0, 0) + b"\x00\x08\xff")
+
+
+class TestMinimize:
+    @pytest.fixture
+    def key(self, datadir):
+        packets = list(iter_packets(ac_keydata(datadir, "25519-simple.eml")))
+        primary, subkey = packets[0][1], packets[3][1]
+        fpr = parse_keyinfos(encode_packet(6, primary))[0].fingerprint
+        # a copy of the encryption subkey created later
+        newer_subkey = subkey[:1] + struct.pack(">I", 1500000000) + subkey[5:]
+        packets = [
+            (6, primary),
+            (13, b"old@example.org"), (2, make_sig(0x13, 100, fpr)),
+            (2, make_sig(0x30, 200, fpr)),
+            (13, b"alice@example.org"), (2, make_sig(0x13, 100, fpr)),
+            (2, make_sig(0x13, 300, fpr)),
+            (13, b"bob@example.org"), (2, make_sig(0x10, 100, "AB" * 20)),
+            (13, b"Carol <carol@example.org>"), (2, make_sig(0x13, 100, fpr)),
+            (14, subkey), (2, make_sig(0x18, 100, fpr, key_flags=0x0c)),
+            (14, newer_subkey), (2, make_sig(0x18, 100, fpr, key_flags=0x0c)),
+            (14, primary), (2, make_sig(0x18, 200, fpr, key_flags=0x02)),
+        ]
+        return packets
+
+    def test_selects_packets(self, key):
+        keydata = b"".join(encode_packet(tag, body) for tag, body in key)
+        assert list(iter_packets(minimize_keydata(keydata))) == [
+            key[0], key[4], key[6], key[9], key[10], key[13], key[14]]
+        assert list(iter_packets(minimize_keydata(keydata, ["carol@example.org"]))) == [
+            key[0], key[9], key[10], key[13], key[14]]
+        minimized = minimize_keydata(keydata, ["nobody@example.org"])
+        assert parse_keyinfos(minimized)[0].uids == [
+            "alice@example.org", "Carol <carol@example.org>"]
+
+    def test_requires_encryption_subkey(self, key):
+        keydata = b"".join(encode_packet(tag, body) for tag, body in key[:11] + key[15:])
+        with pytest.raises(ParseError):
+            minimize_keydata(keydata)
+
+    def test_requires_public_key(self, datadir):
+        with pytest.raises(ParseError):
+            minimize_keydata(datadir.read_bytes("testbot.secretkey"))
+
+    @pytest.mark.parametrize("length", [10, 191, 192, 8383, 8384, 70000])
+    def test_encode_packet(self, length):
+        body = b"x" * length
+        assert list(iter_packets(encode_packet(13, body))) == [(13, body)]
+
+    def test_import_minimized(self, bingpg, bingpg2, keydata, monkeypatch):
+        keyhandle = bingpg2.import_keydata(keydata)
+        calls = []
+        gpg_outerr = bingpg._gpg_outerr
+        monkeypatch.setattr(bingpg, "_gpg_outerr",
+                            lambda argv, **kw: calls.append(argv) or gpg_outerr(argv, **kw))
+        assert bingpg.import_keydata(keydata, minimize=True) == keyhandle
+        assert len(calls) == 1
+        monkeypatch.undo()
+        assert [k.fingerprint for k in bingpg.list_public_keyinfos(keyhandle)] == \
+            [k.fingerprint for k in bingpg2.list_public_keyinfos(keyhandle)]
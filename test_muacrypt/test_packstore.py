@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+
+from __future__ import unicode_literals, print_function
+
+import os
+import pytest
+from muacrypt.chainstore import BlockService, copy_blocks
+from muacrypt import packstore
+from muacrypt.packstore import PackBlockService
+
+
+@pytest.fixture
+def packdir(tmpdir):
+    return tmpdir.join("pack").strpath
+
+
+class TestPackBlockService:
+    def test_store_and_get(self, packdir):
+        bs = PackBlockService(packdir)
+        block1 = bs.store_block("genesis", ["hello", b"world"])
+        block2 = bs.store_block("msg", [42], parent=block1.cid)
+        assert bs.get_block(block2.cid).args == [42]
+        assert bs.get_block(block2.cid).parent == block1
+        assert bs.get_block(block1.cid).args == ["hello", b"world"]
+        assert bs.get_block("00" * 32) is None
+        assert sorted(bs.iter_cids()) == sorted([block1.cid, block2.cid])
+
+    def test_other_instance_sees_blocks(self, packdir):
+        bs1 = PackBlockService(packdir)
+        bs2 = PackBlockService(packdir)
+        block = bs1.store_block("genesis", ["hello"])
+        assert bs2.get_block(block.cid).args == ["hello"]
+
+    def test_sealed_segments(self, packdir):
+        bs = PackBlockService(packdir, segment_max_size=200)
+        blocks = [bs.store_block("msg", ["x" * 50, i]) for i in range(20)]
+        assert len([x for x in os.listdir(packdir) if x.endswith(".idx")]) > 1
+        bs2 = PackBlockService(packdir)
+        for block in blocks:
+            assert bs.get_block(block.cid).args == block.args
+            assert bs2.get_block(block.cid).args == block.args
+        assert sorted(bs2.iter_cids()) == sorted(b.cid for b in blocks)
+
+    def test_remove_blocks(self, packdir):
+        bs = PackBlockService(packdir, segment_max_size=200)
+        blocks = [bs.store_block("msg", ["x" * 50, i]) for i in range(20)]
+        reader = PackBlockService(packdir)
+        assert reader.get_block(blocks[0].cid).args == blocks[0].args
+        garbage = [block.cid for block in blocks[::2]]
+        assert bs.remove_blocks(garbage) == 10
+        assert sorted(bs.iter_cids()) == sorted(b.cid for b in blocks[1::2])
+        # the reader loaded the segments before they were rewritten
+        for block in blocks[1::2]:
+            assert reader.get_block(block.cid).args == block.args
+        new = bs.store_block("msg", ["new"])
+        assert PackBlockService(packdir).get_block(new.cid).args == ["new"]
+        assert bs.remove_blocks([b.cid for b in blocks[1::2]] + [new.cid]) == 11
+        assert list(PackBlockService(packdir).iter_cids()) == []
+
+    def test_remove_blocks_interrupted(self, packdir, monkeypatch):
+        bs = PackBlockService(packdir, segment_max_size=200)
+        blocks = [bs.store_block("msg", ["x" * 50, i]) for i in range(20)]
+        old_packs = set(x for x in os.listdir(packdir) if x.endswith(".pack"))
+
+        def crash(path):
+            raise KeyboardInterrupt()
+
+        # crash after the first rewritten segment was published
+        monkeypatch.setattr(packstore.os, "remove", crash)
+        with pytest.raises(KeyboardInterrupt):
+            bs.remove_blocks([blocks[0].cid])
+        monkeypatch.undo()
+        # old segments were not modified in place
+        for name in old_packs:
+            assert os.path.exists(os.path.join(packdir, name))
+        bs2 = PackBlockService(packdir)
+        for block in blocks:
+            assert bs2.get_block(block.cid).args == block.args
+        assert bs2.remove_blocks([blocks[0].cid]) == 1
+        assert sorted(bs2.iter_cids()) == sorted(b.cid for b in blocks[1:])
+        new = bs2.store_block("msg", ["new"])
+        assert PackBlockService(packdir).get_block(new.cid).args == ["new"]
+
+    def test_store_same_block_twice(self, packdir):
+        bs = PackBlockService(packdir)
+        block = bs.store_block("genesis", ["hello"])
+        bs._store_serialized(block.cid, bs._get_serialized(block.cid))
+        assert len(list(bs.iter_cids())) == 1
+        assert os.path.getsize(os.path.join(packdir, "000001.jidx")) == 44
+
+    def test_recover_unindexed_and_torn_records(self, packdir):
+        bs = PackBlockService(packdir)
+        block1 = bs.store_block("genesis", ["hello"])
+        # simulate a crash after writing a record but before indexing it
+        jidx = os.path.join(packdir, "000001.jidx")
+        with open(jidx, "rb") as f:
+            data = f.read()
+        with open(jidx, "wb") as f:
+            f.write(data[:0])
+        with open(os.path.join(packdir, "000001.pack"), "ab") as f:
+            f.write(b"\x00" * 10)
+        bs = PackBlockService(packdir)
+        block2 = bs.store_block("msg", ["world"], parent=block1.cid)
+        assert [b.args for b in bs.get_block(block2.cid)] == [["world"], ["hello"]]
+
+    @pytest.mark.parametrize("readahead", [1, 64])
+    def test_readahead(self, packdir, monkeypatch, readahead):
+        bs = PackBlockService(packdir, segment_max_size=10000)
+        heads = [None, None]
+        for i in range(200):
+            # two interleaved chains
+            heads[i % 2] = bs.store_block("msg", ["x" * 20, i], parent=heads[i % 2]).cid
+        reads = []
+
+        class CountingFile:
+            def __init__(self, f):
+                self._f = f
+                self.seek = f.seek
+                self.close = f.close
+
+            def read(self, size):
+                reads.append(size)
+                return self._f.read(size)
+
+        def counting_open(path, mode):
+            f = open(path, mode)
+            return CountingFile(f) if path.endswith(".pack") else f
+
+        monkeypatch.setattr(packstore, "open", counting_open, raising=False)
+        bs = PackBlockService(packdir, readahead=readahead)
+        for i, head in enumerate(heads):
+            blocks = list(bs.get_block(head))
+            assert [block.args[1] for block in blocks] == list(range(198 + i, -1, -2))
+        if readahead == 1:
+            assert len(reads) == 200
+        else:
+            assert len(reads) < 40
+
+    def test_readahead_after_rewrite(self, packdir):
+        bs = PackBlockService(packdir, segment_max_size=200)
+        blocks = [bs.store_block("msg", ["x" * 50, i]) for i in range(20)]
+        reader = PackBlockService(packdir)
+        assert reader.get_block(blocks[10].cid, readahead=8).args == blocks[10].args
+        bs.remove_blocks([block.cid for block in blocks[::2]])
+        # the buffered bytes are outdated once a segment is rewritten
+        for block in blocks[9::-2]:
+            assert reader.get_block(block.cid, readahead=8).args == block.args
+
+
+def test_copy_blocks(tmpdir, packdir):
+    files = BlockService(tmpdir.mkdir("blocks").strpath)
+    block1 = files.store_block("genesis", ["hello"])
+    block2 = files.store_block("msg", ["world"], parent=block1.cid)
+    pack = PackBlockService(packdir)
+    assert copy_blocks(files, pack) == 2
+    assert [b.args for b in pack.get_block(block2.cid)] == [["world"], ["hello"]]
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+
+from __future__ import unicode_literals, print_function
+
+import pytest
+from muacrypt.chainstore import HeadConflict
+from muacrypt.sqlitestore import (
+    SQLiteStore, SQLiteBlockService, SQLiteHeadTracker, prefix_upper_bound,
+)
+
+
+@pytest.fixture
+def store(tmpdir):
+    return SQLiteStore(tmpdir.join("states.sqlite").strpath)
+
+
+class TestSQLiteBlockService:
+    def test_store_and_get(self, store):
+        bs = SQLiteBlockService(store)
+        block1 = bs.store_block("genesis", ["hello", b"world"])
+        block2 = bs.store_block("msg", [42], parent=block1.cid)
+        assert [b.args for b in bs.get_block(block2.cid)] == [[42], ["hello", b"world"]]
+        assert bs.get_block("00" * 32) is None
+        assert sorted(bs.iter_cids()) == sorted([block1.cid, block2.cid])
+
+    @pytest.mark.parametrize("readahead", [1, 64])
+    def test_readahead(self, store, readahead):
+        bs = SQLiteBlockService(store)
+        heads = [None, None]
+        for i in range(200):
+            # two interleaved chains
+            heads[i % 2] = bs.store_block("msg", [i], parent=heads[i % 2]).cid
+        queries = []
+        execute = store.execute
+        store.execute = lambda sql, args=(): queries.append(sql) or execute(sql, args)
+        bs = SQLiteBlockService(store, readahead=readahead)
+        for i, head in enumerate(heads):
+            blocks = list(bs.get_block(head))
+            assert [block.args[0] for block in blocks] == list(range(198 + i, -1, -2))
+        if readahead == 1:
+            assert len(queries) == 200
+        else:
+            assert len(queries) < 20
+
+    def test_transaction_rollback(self, store):
+        bs = SQLiteBlockService(store)
+        with pytest.raises(ValueError):
+            with store.transaction():
+                block = bs.store_block("genesis", ["hello"])
+                with store.transaction():
+                    bs.store_block("msg", ["world"], parent=block.cid)
+                raise ValueError()
+        assert list(bs.iter_cids()) == []
+
+
+class TestSQLiteHeadTracker:
+    def test_upsert_and_prefix(self, store):
+        ht = SQLiteHeadTracker(store)
+        assert ht.get_head_cid("own:1") is None
+        ht.upsert("own:1", "cid1")
+        ht.upsert_many([("peer:1:a@a.org", "cid2"), ("peer:1:b@b.org", "cid3"),
+                        ("peer:10:c@c.org", "cid4")])
+        ht.upsert("own:1", "cid5")
+        assert ht.get_head_cid("own:1") == "cid5"
+        assert ht.get_names("peer:1:") == ["a@a.org", "b@b.org"]
+        assert ht._getheads("own:") == {"1": "cid5"}
+        ht.remove_if(lambda name, cid: name.startswith("peer:1:"))
+        assert ht.get_names() == ["own:1", "peer:10:c@c.org"]
+
+    def test_names_pages(self, store):
+        ht = SQLiteHeadTracker(store)
+        ht._names_page_size = 3
+        names = ["{}@x.org".format(i) for i in range(10)]
+        ht.upsert_many([("peer:1:" + name, "cid") for name in names])
+        ht.upsert_many([("own:1", "cid"), ("peer:10:a@x.org", "cid")])
+        assert ht.get_names("peer:1:") == names
+        assert ht.get_names("peer:1:", after=names[3], limit=4) == names[4:8]
+        assert list(ht.iter_names("peer:1:", after=names[7])) == names[8:]
+        assert ht.get_names(after="own:1", limit=2) == ["peer:10:a@x.org", "peer:1:0@x.org"]
+
+    def test_compare_and_swap(self, store):
+        ht1 = SQLiteHeadTracker(store)
+        ht2 = SQLiteHeadTracker(SQLiteStore(store.path))
+        ht1.upsert("own:1", "cid1", expected_cid=None)
+        with pytest.raises(HeadConflict):
+            ht2.upsert("own:1", "cid2", expected_cid=None)
+        with pytest.raises(HeadConflict):
+            with store.transaction():
+                ht1.upsert("peer:1:a@a.org", "cid3")
+                ht1.upsert("own:1", "cid4", expected_cid="cid0")
+        ht2.upsert("own:1", "cid2", expected_cid="cid1")
+        assert ht1._getheads() == {"own:1": "cid2"}
+        # a cid of None removes the head
+        ht1.upsert("own:1", None, expected_cid="cid2")
+        assert ht2._getheads() == {}
+
+    def test_other_connection_sees_heads(self, store):
+        SQLiteHeadTracker(store).upsert("own:1", "cid1")
+        store2 = SQLiteStore(store.path)
+        assert SQLiteHeadTracker(store2).get_head_cid("own:1") == "cid1"
+
+
+def test_prefix_upper_bound():
+    assert prefix_upper_bound("peer:1:") == "peer:1;"
+    assert "peer:1:" < prefix_upper_bound("peer:1:")
+    assert "peer:1:￿" < prefix_upper_bound("peer:1:")
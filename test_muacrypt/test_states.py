@@ -1,7 +1,11 @@
 from __future__ import unicode_literals, print_function
 
+import os
 import pytest
-from muacrypt.states import States
+from muacrypt.chainstore import BlockService, HeadConflict
+from muacrypt.states import (
+    States, MsgEntry, MsgGossipEntry, SnapshotEntry, FsckProblem, _keyhandle_key,
+)
 
 
 @pytest.fixture
@@ -54,3 +58,635 @@ class TestPeerState:
         )
         assert peerstate._latest_msg_entry().msg_date == 70.0
         assert peerstate._latest_ac_entry().msg_date == 70.0
+
+    @pytest.mark.parametrize("storage", ["files", "sqlite"])
+    def test_view_follows_appends(self, tmpdir, storage):
+        states = States(tmpdir.strpath, storage=storage)
+        peerstate = states.get_peerstate("id1", "name1@123")
+        peerstate._append_ac_entry(
+            msg_id='hello', msg_date=17.0, prefer_encrypt='mutual',
+            keydata=b'123', keyhandle='4567')
+        peerstate._append_ac_gossip_entry(
+            msg_id='gossip', msg_date=18.0, keydata=b'890', keyhandle='abcd')
+        peerstate._append_noac_entry(msg_id='world', msg_date=50.0)
+        assert peerstate.verify_view()
+        peerstate = States(tmpdir.strpath).get_peerstate("id1", "name1@123")
+        assert peerstate.last_seen == 50.0
+        assert peerstate.autocrypt_timestamp == 17.0
+        assert peerstate.public_keyhandle == '4567'
+        assert peerstate.public_keydata == b'123'
+        assert peerstate.prefer_encrypt == 'mutual'
+        assert peerstate.latest_gossip_entry().keyhandle == 'abcd'
+
+    def test_view_rebuilt_after_foreign_append(self, tmpdir):
+        peerstate1 = States(tmpdir.strpath).get_peerstate("id1", "name1@123")
+        peerstate2 = States(tmpdir.strpath).get_peerstate("id1", "name1@123")
+        peerstate1._append_noac_entry(msg_id='hello', msg_date=17.0)
+        assert peerstate2.last_seen == 17.0
+        peerstate1._append_noac_entry(msg_id='world', msg_date=18.0)
+        peerstate2._append_ac_gossip_entry(
+            msg_id='gossip', msg_date=19.0, keydata=b'890', keyhandle='abcd')
+        assert peerstate1.last_seen == 18.0
+        assert peerstate1.public_keyhandle == 'abcd'
+        assert peerstate1.verify_view()
+
+    @pytest.mark.parametrize("heads", ["file", "journal"])
+    def test_transaction_retried_after_foreign_append(self, tmpdir, heads):
+        states1 = States(tmpdir.strpath, storage=dict(heads=heads))
+        states2 = States(tmpdir.strpath)
+        calls = []
+
+        def update():
+            calls.append(1)
+            peerstate = states1.get_peerstate("id1", "a@a.org")
+            peerstate.update_from_msg('hello', 17.0, 'mutual', b'123', '4567')
+            if len(calls) == 1:
+                # another process appends before the transaction commits
+                states2.get_peerstate("id1", "a@a.org").update_from_msg(
+                    'world', 18.0, 'nopreference', None, None)
+
+        states1.run_transaction(update)
+        assert len(calls) == 2
+        peerstate = States(tmpdir.strpath).get_peerstate("id1", "a@a.org")
+        # the retried update is appended on top of the other one
+        entries = peerstate._chain.iter_entries(MsgEntry)
+        assert [entry.msg_id for entry in entries] == ['hello', 'world']
+        assert peerstate.autocrypt_timestamp == 17.0
+        assert peerstate.verify_view()
+
+    @pytest.mark.parametrize("storage", ["files", "sqlite"])
+    def test_message_index(self, tmpdir, storage):
+        peerstate1 = States(tmpdir.strpath, storage=storage).get_peerstate("id1", "a@a.org")
+        peerstate2 = States(tmpdir.strpath).get_peerstate("id1", "a@a.org")
+        peerstate1._append_noac_entry(msg_id='hello', msg_date=17.0)
+        peerstate1._append_ac_gossip_entry(
+            msg_id='hello', msg_date=18.0, keydata=b'890', keyhandle='abcd')
+        assert peerstate2.has_message('hello')
+        assert not peerstate2.has_message('world')
+        peerstate1._append_noac_entry(msg_id='world', msg_date=19.0)
+        peerstate1._append_noac_entry(msg_id='hello', msg_date=20.0)
+        assert peerstate2.has_message('world')
+        assert peerstate2.get_message_entry('hello').msg_date == 20.0
+        entry = peerstate2.get_message_entry('hello', class_=MsgGossipEntry)
+        assert entry.keyhandle == 'abcd'
+
+    def test_message_index_is_sharded(self, tmpdir):
+        states = States(tmpdir.strpath)
+        for i in range(20):
+            peerstate = states.get_peerstate("id1", "a{}@a.org".format(i))
+            peerstate._append_noac_entry(msg_id='m{}'.format(i), msg_date=17.0)
+        states2 = States(tmpdir.strpath)
+        assert states2.get_peerstate("id1", "a3@a.org").has_message('m3')
+        # only the shard of the peer chain was loaded
+        assert len(states2._index._shards) == 1
+
+    def test_views_are_sharded(self, tmpdir):
+        states = States(tmpdir.strpath)
+        for i in range(20):
+            peerstate = states.get_peerstate("id1", "a{}@a.org".format(i))
+            peerstate._append_noac_entry(msg_id='m{}'.format(i), msg_date=17.0 + i)
+        assert not os.path.exists(tmpdir.join("views").strpath)
+        states2 = States(tmpdir.strpath)
+        peerstate = states2.get_peerstate("id1", "a3@a.org")
+        assert peerstate.last_seen == 20.0
+        assert peerstate._chain.get_view() is not None
+        # only the shard with the view of the peer chain was loaded
+        assert len(states2._views._shards) == 1
+
+    def test_keydata_stored_once(self, states):
+        peerstate = states.get_peerstate("id1", "a@a.org")
+        for i in range(3):
+            peerstate._append_ac_entry(
+                msg_id='m{}'.format(i), msg_date=17.0 + i, prefer_encrypt='mutual',
+                keydata=b'123', keyhandle='4567')
+        peerstate._append_ac_gossip_entry(
+            msg_id='gossip', msg_date=21.0, keydata=b'123', keyhandle='4567')
+        blocks = peerstate._chain.iter_blocks()
+        cids = set(block.args[-2] for block in blocks)
+        assert cids == set([states._blocks.store_blob(b'123')])
+        assert len(list(states._blocks.iter_cids())) == 5
+        assert peerstate.get_message_entry('m1').keydata == b'123'
+        assert peerstate.public_keydata == b'123'
+
+    @pytest.mark.parametrize("archive", [False, True])
+    def test_compact(self, states, archive):
+        peerstate = states.get_peerstate("id1", "a@a.org")
+        peerstate._append_ac_entry(
+            msg_id='ac1', msg_date=17.0, prefer_encrypt='mutual',
+            keydata=b'123', keyhandle='4567')
+        peerstate._append_ac_gossip_entry(
+            msg_id='gossip', msg_date=18.0, keydata=b'456', keyhandle='89ab')
+        peerstate._append_ac_entry(
+            msg_id='ac2', msg_date=19.0, prefer_encrypt='nopreference',
+            keydata=b'123', keyhandle='4567')
+        for i in range(10):
+            peerstate._append_noac_entry(msg_id='m{}'.format(i), msg_date=20.0 + i)
+        old_head = peerstate._chain.get_head_cid()
+        assert peerstate.compact(archive=archive) == 13 - 4
+        assert peerstate.compact(archive=archive) == 0
+
+        peerstate = States(states.dirpath).get_peerstate("id1", "a@a.org")
+        assert peerstate.verify_view()
+        assert len(peerstate._chain) == 4
+        snapshot = list(peerstate._chain.iter_entries(SnapshotEntry))[0]
+        assert snapshot.num_blocks == 13
+        assert snapshot.archive_cid == (old_head if archive else None)
+        assert peerstate.last_seen == 29.0
+        assert peerstate.autocrypt_timestamp == 19.0
+        assert peerstate.prefer_encrypt == 'nopreference'
+        assert peerstate.public_keydata == b'123'
+        assert peerstate.latest_gossip_entry().keydata == b'456'
+        assert snapshot.msg_ids == ['ac1'] + ['m{}'.format(i) for i in range(9)]
+        assert snapshot.gossip_msg_ids == []
+        assert peerstate.has_message('m9')
+        assert peerstate.has_message('m8')
+        assert peerstate.has_message('ac1')
+        assert peerstate.get_message_entry('m8') is None
+        assert not peerstate.has_message('m11')
+
+        peerstate._append_noac_entry(msg_id='m10', msg_date=40.0)
+        assert peerstate.has_message('m10')
+        assert peerstate.last_seen == 40.0
+        assert states.compact_peer_chains("id1") == 1
+
+    def test_reprocess_after_compact(self, states):
+        peerstate = states.get_peerstate("id1", "a@a.org")
+        peerstate.update_from_msg_gossip('g1', 20.0, b'123', 'KH1')
+        peerstate.update_from_msg_gossip('g2', 30.0, b'456', 'KH2')
+        for i in range(3):
+            peerstate.update_from_msg('m{}'.format(i), 31.0 + i, 'nopreference', b'', '')
+        assert peerstate.compact() == 2
+        peerstate = States(states.dirpath).get_peerstate("id1", "a@a.org")
+        head = peerstate._chain.get_head_cid()
+        peerstate.update_from_msg_gossip('g1', 20.0, b'123', 'KH1')
+        peerstate.update_from_msg('m0', 31.0, 'nopreference', b'', '')
+        assert peerstate._chain.get_head_cid() == head
+        assert peerstate.public_keyhandle == 'KH2'
+        # ids of earlier snapshots are kept when compacting again
+        peerstate.update_from_msg('m3', 40.0, 'nopreference', b'', '')
+        assert peerstate.compact() == 1
+        assert peerstate.has_message('m0') and peerstate.has_message('m2')
+        states.get_msgid_filter("id1").close()
+        assert states.rebuild_msgid_filter("id1").check('m0')
+
+    def test_inline_keydata_of_old_blocks(self, states):
+        peerstate = states.get_peerstate("id1", "a@a.org")
+        peerstate._chain._chainstore.new_head_block(
+            MsgEntry.TAG, ['hello', 17.0, 'mutual', b'123', '4567'])
+        assert peerstate.public_keydata == b'123'
+        assert peerstate._latest_ac_entry().keydata == b'123'
+
+
+class TestGarbageCollection:
+    @pytest.mark.parametrize("backend", ["files", "pack", "sqlite"])
+    def test_collect_garbage(self, tmpdir, backend):
+        states = States(tmpdir.strpath, storage=backend)
+        for account in ("id1", "id2"):
+            peerstate = states.get_peerstate(account, "a@a.org")
+            peerstate._append_ac_entry(
+                msg_id='ac1', msg_date=17.0, prefer_encrypt='mutual',
+                keydata=b'old' + account.encode("ascii"), keyhandle='4567')
+            peerstate._append_ac_entry(
+                msg_id='ac2', msg_date=18.0, prefer_encrypt='mutual',
+                keydata=b'new' + account.encode("ascii"), keyhandle='4567')
+            peerstate._append_noac_entry(msg_id='noac1', msg_date=19.0)
+            peerstate._append_noac_entry(msg_id='noac2', msg_date=20.0)
+        # 2 * (4 blocks + 2 blobs)
+        assert states.collect_garbage() == dict(reachable=12, garbage=0, removed=0)
+        states.get_peerstate("id1", "a@a.org").compact()
+        states.remove_account("id2")
+        # snapshot, ac2, noac2 and the keydata of ac2 remain
+        assert states.collect_garbage(dry_run=True) == dict(
+            reachable=4, garbage=11, removed=0)
+        progress = []
+        stats = states.collect_garbage(progress=lambda *args: progress.append(args))
+        assert stats == dict(reachable=4, garbage=11, removed=11)
+        assert progress == [("sweep", 11)]
+        assert len(list(states._blocks.iter_cids())) == 4
+        peerstate = States(tmpdir.strpath).get_peerstate("id1", "a@a.org")
+        assert peerstate.verify_view()
+        assert peerstate.public_keydata == b'newid1'
+        assert states.collect_garbage()["garbage"] == 0
+
+    def test_mark_does_not_lock(self, tmpdir, monkeypatch):
+        states = States(tmpdir.strpath, storage="sqlite")
+        peerstate = states.get_peerstate("id1", "a@a.org")
+        peerstate._append_noac_entry(msg_id='noac1', msg_date=19.0)
+        mark_reachable = states._mark_reachable
+        calls = []
+
+        def mark_and_write(cids, marked, progress=None):
+            if not calls:
+                # another process can append while blocks are marked
+                other = States(tmpdir.strpath).get_peerstate("id1", "a@a.org")
+                other._append_noac_entry(msg_id='noac2', msg_date=20.0)
+            calls.append(states._sqlite._depth)
+            return mark_reachable(cids, marked, progress)
+
+        monkeypatch.setattr(states, "_mark_reachable", mark_and_write)
+        stats = states.collect_garbage()
+        # the moved head was marked again within the sweep transaction
+        assert calls[0] == 0 and calls[1] > 0
+        assert stats["removed"] == 0
+        assert peerstate.has_message('noac2')
+
+    def test_archived_history_is_reachable(self, states):
+        peerstate = states.get_peerstate("id1", "a@a.org")
+        peerstate._append_ac_entry(
+            msg_id='ac1', msg_date=17.0, prefer_encrypt='mutual',
+            keydata=b'old', keyhandle='4567')
+        peerstate._append_noac_entry(msg_id='noac0', msg_date=18.0)
+        peerstate._append_noac_entry(msg_id='noac1', msg_date=19.0)
+        peerstate._append_noac_entry(msg_id='noac2', msg_date=20.0)
+        assert peerstate.compact(archive=True) == 1
+        assert states.collect_garbage() == dict(reachable=8, garbage=0, removed=0)
+        peerstate._append_noac_entry(msg_id='noac3', msg_date=21.0)
+        assert peerstate.compact() == 1
+        stats = states.collect_garbage(archive=True)
+        assert stats == dict(reachable=4, garbage=8, removed=8)
+        archive = BlockService(os.path.join(states.dirpath, "gc-archive"), fanout=True)
+        assert len(list(archive.iter_cids())) == 8
+        assert peerstate.public_keydata == b'old'
+
+
+class TestFsck:
+    def make_chain(self, states):
+        peerstate = states.get_peerstate("id1", "a@a.org")
+        peerstate._append_ac_entry(
+            msg_id='ac1', msg_date=17.0, prefer_encrypt='mutual',
+            keydata=b'123', keyhandle='4567')
+        for i in range(4):
+            peerstate._append_noac_entry(msg_id='m{}'.format(i), msg_date=18.0 + i)
+        # head first
+        return [block.cid for block in peerstate._chain._chainstore.iter_blocks()]
+
+    @pytest.mark.parametrize("processes", [1, 2])
+    def test_clean(self, states, processes):
+        self.make_chain(states)
+        states._fsck_chunk_size = 2
+        progress = []
+        result = states.fsck(processes=processes,
+                             progress=lambda *args: progress.append(args))
+        assert result == dict(blocks=6, chains=1, problems=[], repaired=[], skipped=[])
+        assert ("hash", 6) in progress
+        assert progress[-1] == ("chains", 1)
+
+    @pytest.mark.parametrize("backend", ["files", "pack", "sqlite"])
+    def test_many_blocks_in_processes(self, tmpdir, backend):
+        states = States(tmpdir.strpath, storage=backend)
+        peerstate = states.get_peerstate("id1", "a@a.org")
+        with states.transaction():
+            for i in range(states._fsck_chunk_size + 50):
+                peerstate._append_noac_entry(msg_id='m{}'.format(i), msg_date=1.0 + i)
+        result = states.fsck(processes=2)
+        assert result == dict(blocks=states._fsck_chunk_size + 50, chains=1,
+                              problems=[], repaired=[], skipped=[])
+
+    @pytest.mark.parametrize("processes", [1, 2])
+    def test_corrupted_block(self, states, processes):
+        cids = self.make_chain(states)
+        path = states._blocks._find_path(cids[2])
+        with open(states._blocks._find_path(cids[3]), "rb") as f:
+            data = f.read()
+        with open(path, "wb") as f:
+            f.write(data)
+        states = States(states.dirpath)
+        states._fsck_chunk_size = 2
+        result = states.fsck(processes=processes)
+        assert result["problems"] == [
+            FsckProblem(None, cids[2], "content does not match its address"),
+            FsckProblem("peer:id1:a@a.org", cids[2], "corrupted block"),
+        ]
+        assert result["repaired"] == []
+        result = states.fsck(repair=True, processes=processes)
+        assert result["repaired"] == [("peer:id1:a@a.org", cids[3])]
+        assert not os.path.exists(path)
+        assert states.fsck() == dict(blocks=5, chains=1, problems=[], repaired=[], skipped=[])
+        peerstate = States(states.dirpath).get_peerstate("id1", "a@a.org")
+        assert peerstate.last_seen == 18.0
+        assert not peerstate.has_message('m1')
+        assert peerstate.verify_view()
+
+    def test_repair_after_concurrent_append(self, states, monkeypatch):
+        cids = self.make_chain(states)
+        os.remove(states._blocks._find_path(cids[2]))
+        check_chain = states._check_chain
+
+        def check_and_append(name, head, corrupt):
+            result = check_chain(name, head, corrupt)
+            if head == cids[0]:
+                # another process appends after the chain was checked
+                other = States(states.dirpath).get_peerstate("id1", "a@a.org")
+                other._append_noac_entry(msg_id='m9', msg_date=30.0)
+            return result
+
+        monkeypatch.setattr(states, "_check_chain", check_and_append)
+        result = states.fsck(repair=True)
+        # the chain was checked again including the appended block
+        assert result["repaired"] == [("peer:id1:a@a.org", cids[3])]
+        assert result["skipped"] == []
+        assert states.get_peerstate("id1", "a@a.org")._chain.get_head_cid() == cids[3]
+
+    def test_repair_skips_conflicting_head(self, states, monkeypatch):
+        cids = self.make_chain(states)
+        os.remove(states._blocks._find_path(cids[2]))
+
+        def conflict(*args, **kwargs):
+            raise HeadConflict("moved")
+
+        monkeypatch.setattr(states._heads, "upsert", conflict)
+        result = states.fsck(repair=True)
+        assert result["repaired"] == []
+        assert result["skipped"] == ["peer:id1:a@a.org"]
+
+    def test_missing_block_and_blob(self, states):
+        cids = self.make_chain(states)
+        blob = states._blocks.store_blob(b'123')
+        os.remove(states._blocks._find_path(cids[1]))
+        problems = states.fsck()["problems"]
+        assert problems == [FsckProblem("peer:id1:a@a.org", cids[1], "missing block")]
+        os.remove(states._blocks._find_path(blob))
+        result = states.fsck(repair=True)
+        assert result["problems"] == [
+            FsckProblem("peer:id1:a@a.org", cids[1], "missing block"),
+            FsckProblem("peer:id1:a@a.org", cids[4], "missing blob {}".format(blob)),
+        ]
+        # no valid block is left below the problems
+        assert result["repaired"] == [("peer:id1:a@a.org", None)]
+        assert states.get_peername_list("id1") == []
+
+    def test_invalid_entries(self, states):
+        cids = self.make_chain(states)
+        chainstore = states.get_peerstate("id1", "a@a.org")._chain._chainstore
+        block1 = chainstore.new_head_block(MsgEntry.TAG, ['m4', 30.0, 'bogus', b'', ''])
+        block2 = chainstore.new_head_block(MsgEntry.TAG, ['m5'])
+        result = states.fsck(repair=True)
+        assert [problem.cid for problem in result["problems"]] == [block2.cid, block1.cid]
+        assert result["problems"][0].message.startswith("invalid msg entry")
+        assert result["repaired"] == [("peer:id1:a@a.org", cids[0])]
+        assert states.fsck()["problems"] == []
+
+
+class TestChainIndex:
+    def test_latest_entry_of_type(self, states):
+        peerstate = states.get_peerstate("id1", "a@a.org")
+        peerstate._append_ac_gossip_entry(
+            msg_id='gossip', msg_date=16.0, keydata=b'123', keyhandle='4567')
+        for i in range(5):
+            peerstate._append_noac_entry(msg_id='m{}'.format(i), msg_date=17.0 + i)
+        states = States(states.dirpath)
+        chain = states.get_peerstate("id1", "a@a.org")._chain
+        assert chain.latest_entry_of(MsgGossipEntry).msg_id == 'gossip'
+        assert chain.latest_entry_of(MsgEntry).msg_id == 'm4'
+        # only the two blocks were loaded
+        assert states.block_cache.misses == 2
+        assert len(chain) == 6
+
+    def test_own_config(self, states):
+        ownstate = states.get_ownstate("id1")
+        ownstate.new_config("id1", 'nopreference', '.*', 'system', 'gpg')
+        ownstate.append_keygen(b'123', '4567')
+        ownstate.change_config(prefer_encrypt='mutual')
+        ownstate = States(states.dirpath).get_ownstate("id1")
+        assert ownstate.prefer_encrypt == 'mutual'
+        assert ownstate.keyhandle == '4567'
+
+    def test_own_exports_invalidated(self, states):
+        ownstate = states.get_ownstate("id1")
+        ownstate.set_export("public_keydata", b'123')
+        assert ownstate.get_export("public_keydata") is None
+        ownstate.new_config("id1", 'nopreference', '.*', 'system', 'gpg')
+        ownstate.append_keygen(b'123', '4567')
+        ownstate.set_export("public_keydata", b'123')
+        ownstate.set_export("ac_header:a@a.org", 'addr=a@a.org; keydata=MTIz')
+        ownstate = States(states.dirpath).get_ownstate("id1")
+        assert ownstate.get_export("public_keydata") == b'123'
+        assert ownstate.get_export("ac_header:a@a.org") == 'addr=a@a.org; keydata=MTIz'
+        assert ownstate.get_export("ac_header:b@b.org") is None
+        assert not ownstate.change_config(prefer_encrypt='nopreference')
+        assert ownstate.get_export("public_keydata") == b'123'
+        ownstate.change_config(prefer_encrypt='mutual')
+        assert ownstate.get_export("ac_header:a@a.org") is None
+        ownstate.set_export("public_keydata", b'123')
+        ownstate.append_keygen(b'456', '89ab')
+        assert ownstate.get_export("public_keydata") is None
+
+    def test_removed_chain_is_reindexed(self, states):
+        states.get_peerstate("id1", "a@a.org")._append_ac_gossip_entry(
+            msg_id='gossip', msg_date=16.0, keydata=b'123', keyhandle='4567')
+        states._heads.remove_if(lambda name, cid: True)
+        peerstate = states.get_peerstate("id1", "a@a.org")
+        peerstate._append_noac_entry(msg_id='hello', msg_date=17.0)
+        assert peerstate._chain.latest_entry_of(MsgGossipEntry) is None
+        assert not peerstate.get_message_entry('gossip', MsgGossipEntry)
+
+
+class TestMsgIdFilter:
+    def test_rebuilt_from_chains(self, states):
+        states.get_peerstate("id1", "a@a.org")._append_noac_entry(
+            msg_id="hello", msg_date=17.0)
+        bloom = states.get_msgid_filter("id1")
+        assert "hello" in bloom
+        assert "world" not in bloom
+        assert "hello" not in states.get_msgid_filter("id2")
+        bloom.add("world")
+        assert "world" in states.get_msgid_filter("id1")
+        states.remove_account("id1")
+        assert "world" not in states.get_msgid_filter("id1")
+
+    def test_grows_and_changes_fp_rate(self, tmpdir, monkeypatch):
+        monkeypatch.setattr("muacrypt.states.MSGID_FILTER_CAPACITY", 4)
+        states = States(tmpdir.strpath)
+        peerstate = states.get_peerstate("id1", "a@a.org")
+        for i in range(5):
+            peerstate._append_noac_entry(msg_id="m{}".format(i), msg_date=17.0 + i)
+            states.get_msgid_filter("id1").add("m{}".format(i))
+        assert states.get_msgid_filter("id1").capacity == 10
+        states = States(tmpdir.strpath, storage=dict(msgid_fp_rate=0.01))
+        assert States(tmpdir.strpath).storage["msgid_fp_rate"] == 0.01
+        bloom = states.get_msgid_filter("id1")
+        assert bloom.fp_rate == 0.01
+        assert all("m{}".format(i) in bloom for i in range(5))
+
+
+class TestImportedKeyhandles:
+    def test_remembered_until_keyring_changes(self, states):
+        assert states.get_imported_keyhandle("id1", b"123", ["ring1"]) is None
+        states.set_imported_keyhandle("id1", b"123", "AB12", ["ring0"], ["ring1"])
+        assert states.get_imported_keyhandle("id1", b"123", ["ring1"]) == "AB12"
+        assert states.get_imported_keyhandle("id1", b"456", ["ring1"]) is None
+        assert states.get_imported_keyhandle("id2", b"123", ["ring1"]) is None
+        # our own import keeps earlier keyhandles valid
+        states.set_imported_keyhandle("id1", b"456", "CD34", ["ring1"], ["ring2"])
+        assert states.get_imported_keyhandle("id1", b"123", ["ring2"]) == "AB12"
+        assert states.get_imported_keyhandle("id1", b"456", ["ring2"]) == "CD34"
+        assert States(states.dirpath).get_imported_keyhandle(
+            "id1", b"123", ["ring2"]) == "AB12"
+        # a modification by others invalidates all keyhandles
+        assert states.get_imported_keyhandle("id1", b"123", ["ring3"]) is None
+        states.set_imported_keyhandle("id1", b"456", "CD34", ["ring3"], ["ring4"])
+        assert states.get_imported_keyhandle("id1", b"456", ["ring4"]) == "CD34"
+        assert states.get_imported_keyhandle("id1", b"123", ["ring4"]) is None
+
+    @pytest.mark.parametrize("backend", ["files", "sqlite"])
+    def test_stale_generations_are_dropped(self, tmpdir, backend):
+        states = States(tmpdir.strpath, storage=backend)
+        keyhandles = states._keyhandles
+        if backend == "sqlite":
+            newkey = b"new"
+        else:
+            assert not os.path.exists(tmpdir.join("keyhandles").strpath)
+            # a new key which shares the shard with an old one
+            shard_num = keyhandles._shard_num(_keyhandle_key("id1", b"old0"))
+            newkey = next(keydata for keydata in (str(i).encode("ascii") for i in range(10000))
+                          if keyhandles._shard_num(_keyhandle_key("id1", keydata)) == shard_num)
+            keyhandles = keyhandles.shard(_keyhandle_key("id1", newkey))
+        for i in range(3):
+            states.set_imported_keyhandle("id1", "old{}".format(i).encode("ascii"), "AB12",
+                                          ["ring{}".format(i)], ["ring{}".format(i + 1)])
+        states.set_imported_keyhandle("id2", b"old0", "AB12", [], ["ring1"])
+        # the keyring was changed by others
+        states.set_imported_keyhandle("id1", newkey, "CD34", ["other"], ["ring5"])
+        assert states.get_imported_keyhandle("id1", newkey, ["ring5"]) == "CD34"
+        names = [name for name, value in keyhandles.items()]
+        assert _keyhandle_key("id1", b"old0") not in names
+        # entries of other accounts are kept
+        assert states.get_imported_keyhandle("id2", b"old0", ["ring1"]) == "AB12"
+
+    def test_remove_account(self, states):
+        states.set_imported_keyhandle("id1", b"123", "AB12", [], ["ring1"])
+        states.set_imported_keyhandle("id2", b"123", "AB12", [], ["ring1"])
+        states.remove_account("id1")
+        assert states.get_imported_keyhandle("id1", b"123", ["ring1"]) is None
+        assert states.get_imported_keyhandle("id2", b"123", ["ring1"]) == "AB12"
+
+
+class TestStorage:
+    def test_pack_storage(self, tmpdir):
+        states = States(tmpdir.strpath, storage="pack")
+        states.get_peerstate("id1", "a@a.org")._append_noac_entry(
+            msg_id="hello", msg_date=17.0)
+        states = States(tmpdir.strpath)
+        assert states.storage["backend"] == "pack"
+        assert states.get_peerstate("id1", "a@a.org").last_seen == 17.0
+        with pytest.raises(ValueError):
+            States(tmpdir.strpath, storage="files")
+
+    def test_readahead_option(self, tmpdir):
+        states = States(tmpdir.strpath, storage="pack")
+        assert states._blocks.readahead == 64
+        states = States(tmpdir.strpath, storage=dict(readahead=8))
+        assert States(tmpdir.strpath)._blocks.readahead == 8
+
+    def test_compress_option(self, tmpdir):
+        states = States(tmpdir.strpath, storage=dict(backend="pack", compress_min_size=256))
+        peerstate = states.get_peerstate("id1", "a@a.org")
+        peerstate._append_ac_entry(
+            msg_id='hello', msg_date=17.0, prefer_encrypt='mutual',
+            keydata=b'123' * 1000, keyhandle='4567')
+        blob_cid = states._blocks.store_blob(b'123' * 1000)
+        assert len(states._blocks._get_serialized(blob_cid)) < 100
+        states = States(tmpdir.strpath, storage=dict(compress_min_size=0))
+        assert states.get_peerstate("id1", "a@a.org").public_keydata == b'123' * 1000
+
+    def test_migrate_storage(self, states):
+        peerstate = states.get_peerstate("id1", "a@a.org")
+        peerstate._append_noac_entry(msg_id="hello", msg_date=17.0)
+        peerstate._append_noac_entry(msg_id="world", msg_date=18.0)
+        assert states.migrate_storage("pack") == 2
+        assert states.migrate_storage("pack") == 0
+        states = States(states.dirpath)
+        assert states.storage["backend"] == "pack"
+        peerstate = states.get_peerstate("id1", "a@a.org")
+        assert peerstate.has_message("hello")
+        assert peerstate.last_seen == 18.0
+
+    def test_migrate_layout(self, tmpdir):
+        states = States(tmpdir.strpath, storage=dict(layout="flat"))
+        peerstate = states.get_peerstate("id1", "a@a.org")
+        peerstate._append_noac_entry(msg_id="hello", msg_date=17.0)
+        blockdir = tmpdir.join("blocks")
+        assert all(len(name) == 64 for name in os.listdir(blockdir.strpath))
+        assert states.migrate_storage(layout="fanout") == 1
+        assert all(len(name) == 2 for name in os.listdir(blockdir.strpath))
+        assert states.migrate_storage(layout="fanout") == 0
+        states = States(tmpdir.strpath)
+        assert states.storage["layout"] == "fanout"
+        peerstate = states.get_peerstate("id1", "a@a.org")
+        assert peerstate.has_message("hello")
+        peerstate._append_noac_entry(msg_id="world", msg_date=18.0)
+        assert len(os.listdir(blockdir.strpath)) <= 2
+
+    def test_journal_heads(self, tmpdir):
+        states = States(tmpdir.strpath, storage=dict(heads="journal"))
+        states.get_peerstate("id1", "a@a.org")._append_noac_entry(
+            msg_id="hello", msg_date=17.0)
+        assert os.path.exists(tmpdir.join("heads.journal").strpath)
+        states = States(tmpdir.strpath)
+        assert states.get_peername_list("id1") == ["a@a.org"]
+        states.migrate_storage(heads="file")
+        assert not os.path.exists(tmpdir.join("heads.journal").strpath)
+        assert States(tmpdir.strpath).get_peerstate("id1", "a@a.org").last_seen == 17.0
+
+    def test_sqlite_storage(self, tmpdir):
+        states = States(tmpdir.strpath, storage="sqlite")
+        states.get_peerstate("id1", "b@b.org")._append_noac_entry(
+            msg_id="hello", msg_date=17.0)
+        states.get_peerstate("id1", "a@a.org")._append_noac_entry(
+            msg_id="hello", msg_date=18.0)
+        states = States(tmpdir.strpath)
+        assert states.get_peername_list("id1") == ["a@a.org", "b@b.org"]
+        assert states.get_peername_list("id1", after="a@a.org") == ["b@b.org"]
+        assert states.get_num_peers("id1") == 2
+        assert states.get_peerstate("id1", "b@b.org").last_seen == 17.0
+
+    @pytest.mark.parametrize("backends", [
+        ("files", "sqlite", "pack"),
+        ("pack", "sqlite", "files"),
+    ])
+    def test_migrate_storage_sqlite(self, tmpdir, backends):
+        states = States(tmpdir.strpath, storage=backends[0])
+        states.get_peerstate("id1", "a@a.org")._append_noac_entry(
+            msg_id="hello", msg_date=17.0)
+        for backend in backends[1:]:
+            assert states.migrate_storage(backend) == 1
+            states = States(tmpdir.strpath)
+            assert states.storage["backend"] == backend
+            assert states.get_peername_list("id1") == ["a@a.org"]
+            assert states.get_peerstate("id1", "a@a.org").has_message("hello")
+
+    @pytest.mark.parametrize("backend", ["files", "pack", "sqlite"])
+    def test_transaction(self, tmpdir, backend):
+        states = States(tmpdir.strpath, storage=dict(backend=backend, fsync="always"))
+        peerstate = states.get_peerstate("id1", "a@a.org")
+        with states.transaction():
+            peerstate._append_noac_entry(msg_id="hello", msg_date=17.0)
+            peerstate._append_noac_entry(msg_id="world", msg_date=18.0)
+        with pytest.raises(ValueError):
+            with states.transaction():
+                peerstate._append_noac_entry(msg_id="lost", msg_date=19.0)
+                assert peerstate.last_seen == 19.0
+                raise ValueError()
+        peerstate = States(tmpdir.strpath).get_peerstate("id1", "a@a.org")
+        assert peerstate.last_seen == 18.0
+        assert not peerstate.has_message("lost")
+        assert len(peerstate._chain) == 2
+
+    def test_fsync_option(self, tmpdir):
+        assert States(tmpdir.strpath).storage["fsync"] == "commit"
+        States(tmpdir.strpath, storage=dict(fsync="none"))
+        assert States(tmpdir.strpath).storage["fsync"] == "none"
+
+    @pytest.mark.parametrize("backend", ["files", "pack", "sqlite"])
+    def test_mixed_encodings(self, tmpdir, backend):
+        states = States(tmpdir.strpath, storage=dict(backend=backend, encoding="execnet"))
+        states.get_peerstate("id1", "a@a.org")._append_noac_entry(
+            msg_id="hello", msg_date=17.0)
+        states = States(tmpdir.strpath, storage=dict(encoding="compact"))
+        assert states.storage["encoding"] == "compact"
+        peerstate = states.get_peerstate("id1", "a@a.org")
+        peerstate._append_noac_entry(msg_id="world", msg_date=18.0)
+        peerstate = States(tmpdir.strpath).get_peerstate("id1", "a@a.org")
+        assert peerstate.has_message("hello")
+        assert peerstate.has_message("world")
+        assert len(peerstate._chain) == 2